@@ -0,0 +1,377 @@
+"""Garbage collection of cache locations, evicting the least recently used task
+directories until the cache is within a size or age limit."""
+
+import argparse
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+import typing as ty
+from pathlib import Path
+import attrs
+from .helpers import ResultIndex, result_cache
+from .helpers_file import BlobStore
+
+logger = logging.getLogger("pydra.gc")
+
+TASK = "task"
+PICKLE = "pickle"
+SCRIPT = "script"
+INFO = "info"
+
+
+@attrs.define
+class CacheEntry:
+    """An entry of a cache location that can be evicted.
+
+    Parameters
+    ----------
+    path : Path
+        path of the task directory or file
+    kind : str
+        "task" for task directories, "pickle" for the pickled tasks in `pkl_files`,
+        "script" for the directories of the scripts submitted by the workers and
+        "info" for the `_info.json` files of the tasks being run
+    size : int
+        total size of the files in bytes
+    last_access : float
+        latest access or modification time of the files (seconds since the epoch)
+    locked : bool
+        whether the entry is in use by a task being run (i.e. has a live lock file)
+    kept : bool
+        whether the entry is referenced by one of the tasks passed to `collect_garbage`
+    """
+
+    path: Path
+    kind: str
+    size: int
+    last_access: float
+    locked: bool = False
+    kept: bool = False
+
+    @property
+    def evictable(self) -> bool:
+        return not (self.locked or self.kept)
+
+
+@attrs.define
+class GarbageReport:
+    """The statistics of a cache location and the entries evicted from it.
+
+    Parameters
+    ----------
+    location : Path
+        the cache location
+    entries : list[CacheEntry]
+        all entries of the location, least recently used first
+    evicted : list[CacheEntry]
+        the entries evicted from the location (or that would have been if dry_run)
+    dry_run : bool
+        whether the entries were only reported and not removed
+    pruned_blobs : list[tuple[Path, int]]
+        the paths and sizes of the blobs of the location's store (see `BlobStore`)
+        that were pruned after the entries were evicted
+    """
+
+    location: Path
+    entries: ty.List[CacheEntry] = attrs.field(factory=list)
+    evicted: ty.List[CacheEntry] = attrs.field(factory=list)
+    dry_run: bool = False
+    pruned_blobs: ty.List[ty.Tuple[Path, int]] = attrs.field(factory=list)
+
+    @property
+    def total_size(self) -> int:
+        return sum(e.size for e in self.entries)
+
+    @property
+    def reclaimed(self) -> int:
+        return sum(e.size for e in self.evicted)
+
+    def summary(self) -> str:
+        """Human-readable summary of the report"""
+        lines = [
+            f"{self.location}: {len(self.entries)} entries, "
+            f"{format_size(self.total_size)}"
+        ]
+        for entry in self.evicted:
+            lines.append(
+                f"  {'would evict' if self.dry_run else 'evicted'} "
+                f"{entry.path.relative_to(self.location)} ({format_size(entry.size)}, "
+                f"last accessed {time.ctime(entry.last_access)})"
+            )
+        lines.append(
+            f"  {'reclaimable' if self.dry_run else 'reclaimed'}: "
+            f"{format_size(self.reclaimed)} in {len(self.evicted)} entries"
+        )
+        if self.pruned_blobs:
+            lines.append(
+                f"  {'unlinked' if self.dry_run else 'pruned'} blobs: "
+                f"{format_size(sum(s for _, s in self.pruned_blobs))} in "
+                f"{len(self.pruned_blobs)} files"
+            )
+        return "\n".join(lines)
+
+
+def cache_entries(location: os.PathLike) -> ty.List[CacheEntry]:
+    """
+    Walk a cache location and collect the statistics of the entries that can be
+    evicted from it, least recently used first.
+
+    Task directories are locked while their `<checksum>.lock` or
+    `<checksum>_save.lock` file exists. Since the pickled tasks, the worker scripts and
+    the `_info.json` files can't be associated with their tasks, they are all locked
+    while any task is being run in the location.
+
+    Parameters
+    ----------
+    location : os.PathLike
+        the cache location
+
+    Returns
+    -------
+    entries : list[CacheEntry]
+        the entries of the location, least recently used first
+    """
+    location = Path(location)
+    locks = set()
+    paths = []
+    for entry in os.scandir(location):
+        if entry.name.endswith(".lock"):
+            if entry.name != ResultIndex.MANIFEST_NAME + ".lock":
+                locks.add(entry.name[: -len(".lock")])
+        elif (
+            entry.name.startswith(ResultIndex.MANIFEST_NAME)
+            or entry.name == BlobStore.DIR_NAME
+        ):
+            continue
+        elif entry.is_dir(follow_symlinks=False):
+            if entry.name == "pkl_files":
+                paths.extend((Path(e.path), PICKLE) for e in os.scandir(entry.path))
+            elif entry.name.endswith("_scripts"):
+                paths.extend((Path(e.path), SCRIPT) for e in os.scandir(entry.path))
+            else:
+                paths.append((Path(entry.path), TASK))
+        elif entry.name.endswith("_info.json"):
+            paths.append((Path(entry.path), INFO))
+    entries = []
+    for path, kind in paths:
+        size, last_access = _usage(path)
+        if kind == TASK:
+            locked = path.name in locks or f"{path.name}_save" in locks
+        else:
+            locked = bool(locks)
+        entries.append(CacheEntry(path, kind, size, last_access, locked=locked))
+    return sorted(entries, key=lambda e: e.last_access)
+
+
+def referenced_checksums(task) -> ty.Set[str]:
+    """
+    The checksums, i.e. the names of the task directories, of a task (of each of its
+    states if it is split) and, for workflows that have been run, of their nodes.
+
+    Parameters
+    ----------
+    task : TaskBase
+        the task or workflow
+
+    Returns
+    -------
+    checksums : set[str]
+        the referenced checksums
+    """
+    from .core import is_workflow
+
+    checksums = set()
+    try:
+        if task.state:
+            checksums.update(task.checksum_states())
+        else:
+            checksums.add(task.checksum)
+    except Exception as e:
+        # e.g. the inputs haven't been resolved as the task hasn't been run
+        logger.debug("Couldn't calculate the checksums of '%s': %s", task.name, e)
+    if is_workflow(task) and not task.state:
+        try:
+            for node in task.graph.sorted_nodes:
+                try:
+                    # the inputs connected to other nodes are retrieved from their
+                    # results, as when the workflow is run
+                    node.inputs.retrieve_values(task)
+                except Exception as e:
+                    logger.debug(
+                        "Couldn't retrieve the inputs of '%s': %s", node.name, e
+                    )
+                    continue
+                checksums.update(referenced_checksums(node))
+        finally:
+            task._reset()
+    return checksums
+
+
+def collect_garbage(
+    location: os.PathLike,
+    max_size: ty.Optional[int] = None,
+    max_age: ty.Optional[float] = None,
+    keep: ty.Iterable[ty.Any] = (),
+    dry_run: bool = False,
+) -> GarbageReport:
+    """
+    Evict the least recently used entries (see `cache_entries`) of a cache location
+    until its size is within `max_size` and none of them were last accessed more than
+    `max_age` ago. Locked entries and those referenced by the tasks in `keep` are never
+    evicted, so the limits may not be met.
+
+    Parameters
+    ----------
+    location : os.PathLike
+        the cache location
+    max_size : int, optional
+        the maximum total size of the entries of the location in bytes
+    max_age : float, optional
+        the maximum time since the entries were last accessed in seconds
+    keep : iterable of TaskBase or str
+        tasks or workflows (see `referenced_checksums`), or checksums, whose task
+        directories are kept
+    dry_run : bool
+        if True, the entries that would be evicted are only reported
+
+    Returns
+    -------
+    report : GarbageReport
+        the statistics of the location and the entries evicted from it
+    """
+    location = Path(location)
+    kept = set()
+    for item in keep:
+        kept.update([item] if isinstance(item, str) else referenced_checksums(item))
+    report = GarbageReport(location, cache_entries(location), dry_run=dry_run)
+    size = report.total_size
+    now = time.time()
+    for entry in report.entries:
+        entry.kept = entry.kind == TASK and entry.path.name in kept
+    for entry in report.entries:
+        if not entry.evictable:
+            continue
+        too_big = max_size is not None and size > max_size
+        too_old = max_age is not None and now - entry.last_access > max_age
+        if not (too_big or too_old):
+            # the entries are sorted least recently used first, so none of the
+            # remaining ones need to be evicted either
+            break
+        report.evicted.append(entry)
+        size -= entry.size
+    if not dry_run and report.evicted:
+        for entry in report.evicted:
+            logger.debug("Evicting %s", entry.path)
+            if entry.path.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                entry.path.unlink(missing_ok=True)
+            if entry.kind == TASK:
+                result_cache.invalidate(entry.path)
+        ResultIndex.for_location(location).compact()
+    # the blobs that are no longer linked to from any task directory
+    report.pruned_blobs = BlobStore(location).prune(dry_run=dry_run)
+    return report
+
+
+_SIZE_UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+_AGE_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_size(size: str) -> int:
+    """Parse a size in bytes, with an optional K, M, G or T suffix (powers of 1024),
+    e.g. "10G" """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*", size.lower())
+    if not match:
+        raise ValueError(f"Unrecognised size '{size}'")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def parse_age(age: str) -> float:
+    """Parse an age in seconds, with an optional s, m, h, d or w suffix, e.g. "30d" """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*", age.lower())
+    if not match:
+        raise ValueError(f"Unrecognised age '{age}'")
+    return float(match.group(1)) * _AGE_UNITS[match.group(2)]
+
+
+def format_size(size: int) -> str:
+    """Format a size in bytes with a binary unit, e.g. "1.5 GiB" """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.4g} {unit}"
+        size /= 1024
+    return f"{size:.4g} TiB"
+
+
+def main(argv: ty.Optional[ty.Sequence[str]] = None) -> int:
+    """Entry point of the `pydra-cache-gc` console script"""
+    parser = argparse.ArgumentParser(
+        prog="pydra-cache-gc",
+        description=(
+            "Evict the least recently used task directories from pydra cache "
+            "locations until they are within a size or age limit"
+        ),
+    )
+    parser.add_argument("locations", nargs="+", type=Path, help="cache locations")
+    parser.add_argument(
+        "--max-size", type=parse_size, help="maximum size of each location, e.g. 10G"
+    )
+    parser.add_argument(
+        "--max-age",
+        type=parse_age,
+        help="maximum time since the entries were last accessed, e.g. 30d",
+    )
+    parser.add_argument(
+        "--keep",
+        action="append",
+        default=[],
+        metavar="CHECKSUM",
+        help="checksum (i.e. task directory name) to keep, can be repeated",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the entries that would be evicted",
+    )
+    args = parser.parse_args(argv)
+    if args.max_size is None and args.max_age is None:
+        parser.error("at least one of --max-size and --max-age is required")
+    for location in args.locations:
+        if not location.is_dir():
+            parser.error(f"cache location '{location}' doesn't exist")
+        report = collect_garbage(
+            location,
+            max_size=args.max_size,
+            max_age=args.max_age,
+            keep=args.keep,
+            dry_run=args.dry_run,
+        )
+        print(report.summary())
+    return 0
+
+
+def _usage(path: Path) -> ty.Tuple[int, float]:
+    """total size and latest access time of the files under a path"""
+    stat = path.lstat()
+    if not path.is_dir() or path.is_symlink():
+        return stat.st_size, max(stat.st_atime, stat.st_mtime)
+    # the access times of directories are updated by walking them, so only their
+    # modification times are used
+    size, last_access = 0, stat.st_mtime
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            last_access = max(last_access, stat.st_atime, stat.st_mtime)
+    return size, last_access
+
+
+if __name__ == "__main__":
+    sys.exit(main())
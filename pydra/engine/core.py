@@ -9,7 +9,7 @@ import os
 import sys
 from pathlib import Path
 import typing as ty
-from copy import deepcopy, copy
+from copy import deepcopy
 from uuid import uuid4
 from filelock import SoftFileLock
 import shutil
@@ -22,6 +22,7 @@ from . import helpers_state as hlpst
 from .specs import (
     File,
     BaseSpec,
+    InputHashMemo,
     RuntimeSpec,
     Result,
     SpecInfo,
@@ -37,15 +38,25 @@ from .helpers import (
     create_checksum,
     print_help,
     load_result,
+    load_results,
+    result_cache,
+    cache_tiers,
     save,
     ensure_list,
     record_error,
+    StatePayload,
     PydraFileLock,
     parse_copyfile,
 )
-from ..utils.hash import hash_function
+from ..utils.hash import (
+    hash_function,
+    hash_change_check_default,
+    HashProfile,
+    activate_hash_profile,
+)
 from .helpers_file import copy_nested_files, template_update
 from .graph import DiGraph
+from .remote_cache import fetch_result, upload_result
 from .audit import Audit
 from ..utils.messenger import AuditFlag
 from ..utils.typing import TypeParser
@@ -206,6 +217,19 @@ class TaskBase:
         self.task_rerun = rerun
 
         self.plugin = None
+        # the policy used to select the strategies to hash the files in the inputs with
+        # (see pydra.utils.hash.FileHashPolicy), inherited from the workflow/submitter
+        # if None
+        self.file_hash_policy = None
+        # the number of states run by each call of the worker, or the target runtime of
+        # each call in seconds, if the states of the task are run in chunks (see
+        # `Submitter.expand_runnable`), which override those of the submitter
+        self.chunk_size = None
+        self.chunk_runtime = None
+        # memo of the input field hashes, kept on the task so it outlives the copies of
+        # the inputs made when they are updated
+        self.input_hash_memo = InputHashMemo()
+        self._flattened_inputs = {}
         self.hooks = TaskHook()
         self._errored = False
         self._lzout = None
@@ -223,13 +247,23 @@ class TaskBase:
                 k = k[1:]
             inputs[k] = v
         state["inputs"] = inputs
+        # the memoized hashes are pickled along with the inputs they were calculated
+        # from so they can be reused by the process the task is run in
+        state["_flattened_inputs"] = {}
         return state
 
     def __setstate__(self, state):
         state["input_spec"] = cp.loads(state["input_spec"])
         state["output_spec"] = cp.loads(state["output_spec"])
-        state["inputs"] = make_klass(state["input_spec"])(**state["inputs"])
+        pickled_inputs = state["inputs"]
+        state["inputs"] = make_klass(state["input_spec"])(**pickled_inputs)
         self.__dict__.update(state)
+        for field in attr.fields(type(self.inputs)):
+            name = field.name[1:] if field.name.startswith("_") else field.name
+            if name in pickled_inputs:
+                self.input_hash_memo.rebind(
+                    field.name, pickled_inputs[name], getattr(self.inputs, field.name)
+                )
 
     @cached_property
     def lzout(self):
@@ -258,7 +292,9 @@ class TaskBase:
         and to create nodes checksums needed for graph checksums
         (before the tasks have inputs etc.)
         """
-        input_hash = self.inputs.hash
+        input_hash = self.inputs.compute_hash(
+            self.file_hash_policy, memo=self.input_hash_memo
+        )
         if self.state is None:
             self._checksum = create_checksum(self.__class__.__name__, input_hash)
         else:
@@ -286,16 +322,19 @@ class TaskBase:
             }
 
         if state_index is not None:
-            inputs_copy = copy(self.inputs)
+            # the hash of the inputs with the elements of the state substituted for the
+            # split fields, composed from the memoized hashes of the elements and of
+            # the fields that aren't split over
+            elements = {}
             for key, ind in self.state.inputs_ind[state_index].items():
-                val = self._extract_input_el(
-                    inputs=self.inputs, inp_nm=key.split(".")[1], ind=ind
+                inp_nm = key.split(".")[1]
+                elements[inp_nm] = (
+                    ind,
+                    self._extract_input_el(inputs=self.inputs, inp_nm=inp_nm, ind=ind),
                 )
-                setattr(inputs_copy, key.split(".")[1], val)
-            # setting files_hash again in case it was cleaned by setting specific element
-            # that might be important for outer splitter of input variable with big files
-            # the file can be changed with every single index even if there are only two files
-            input_hash = inputs_copy.hash
+            input_hash = self.inputs.compute_state_hash(
+                elements, self.file_hash_policy, memo=self.input_hash_memo
+            )
             if is_workflow(self):
                 con_hash = hash_function(self._connections)
                 # TODO: hash list is not used
@@ -399,7 +438,13 @@ class TaskBase:
 
     @property
     def cache_locations(self):
-        """Get the list of cache sources."""
+        """Get the list of cache sources. If results are promoted or written back
+        between the tiers of the cache (see `CacheTiers`), the cache directory, which is
+        the local tier, comes first, otherwise it comes last."""
+        if cache_tiers.tiered:
+            return list(
+                dict.fromkeys(ensure_list(self._cache_dir) + self._cache_locations)
+            )
         return self._cache_locations + ensure_list(self._cache_dir)
 
     @cache_locations.setter
@@ -530,15 +575,22 @@ class TaskBase:
             json.dump({"checksum": checksum}, jsonfile)
         if not self.can_resume and output_dir.exists():
             shutil.rmtree(output_dir)
+            result_cache.invalidate(output_dir)
         output_dir.mkdir(parents=False, exist_ok=self.can_resume)
 
     def _run(self, rerun=False, environment=None, **kwargs):
         self.inputs = attr.evolve(self.inputs, **kwargs)
         self.inputs.check_fields_input_spec()
 
-        checksum = self.checksum
+        hash_profile = HashProfile() if HashProfile.enabled() else None
+        with activate_hash_profile(hash_profile):
+            checksum = self.checksum
+        inputs_snapshot = self._snapshot_inputs()
         output_dir = self.output_dir
         lockfile = self.cache_dir / (checksum + ".lock")
+        if not (rerun or self.task_rerun):
+            # results computed on other hosts are downloaded from the remote cache
+            fetch_result(checksum, self.cache_locations, self.cache_dir)
         # Eagerly retrieve cached - see scenarios in __init__()
         self.hooks.pre_run(self)
         logger.debug("'%s' is attempting to acquire lock on %s", self.name, lockfile)
@@ -549,6 +601,8 @@ class TaskBase:
                     return result
             cwd = os.getcwd()
             self._populate_filesystem(checksum, output_dir)
+            if hash_profile is not None:
+                hash_profile.save(output_dir)
             os.chdir(output_dir)
             orig_inputs = self._modify_inputs()
             result = Result(output=None, runtime=None, errored=False)
@@ -576,10 +630,12 @@ class TaskBase:
                 for field_name, field_value in orig_inputs.items():
                     setattr(self.inputs, field_name, field_value)
                 os.chdir(cwd)
+        cache_tiers.saved(output_dir, self.cache_locations)
+        upload_result(output_dir)
         self.hooks.post_run(self, result)
         # Check for any changes to the input hashes that have occurred during the execution
         # of the task
-        self._check_for_hash_changes()
+        self._check_for_hash_changes(inputs_snapshot)
         return result
 
     def _collect_outputs(self, output_dir):
@@ -735,12 +791,18 @@ class TaskBase:
         If
         """
         if f"{self.name}.{inp_nm}" in self.cont_dim:
-            return list(
-                hlpst.flatten(
-                    ensure_list(getattr(inputs, inp_nm)),
-                    max_depth=self.cont_dim[f"{self.name}.{inp_nm}"],
-                )
-            )[ind]
+            value = getattr(inputs, inp_nm)
+            max_depth = self.cont_dim[f"{self.name}.{inp_nm}"]
+            # the flattened values are kept to avoid flattening them again for every
+            # element
+            try:
+                orig_value, orig_max_depth, flattened = self._flattened_inputs[inp_nm]
+            except KeyError:
+                orig_value = None
+            if orig_value is not value or orig_max_depth != max_depth:
+                flattened = list(hlpst.flatten(ensure_list(value), max_depth=max_depth))
+                self._flattened_inputs[inp_nm] = (value, max_depth, flattened)
+            return flattened[ind]
         else:
             return getattr(inputs, inp_nm)[ind]
 
@@ -764,12 +826,12 @@ class TaskBase:
         #     return None, inputs_dict
 
     def pickle_task(self):
-        """Pickling the tasks with full inputs"""
+        """Pickling the task, whose states have been prepared, as a payload holding a
+        template of the task and the inputs of each state (see `StatePayload`)"""
         pkl_files = self.cache_dir / "pkl_files"
         pkl_files.mkdir(exist_ok=True, parents=True)
         task_main_path = pkl_files / f"{self.name}_{self.uid}_task.pklz"
-        save(task_path=pkl_files, task=self, name_prefix=f"{self.name}_{self.uid}")
-        return task_main_path
+        return StatePayload.dump(self, task_main_path)
 
     @property
     def done(self):
@@ -808,13 +870,24 @@ class TaskBase:
         return False
 
     def _combined_output(self, return_inputs=False):
+        combined_mapping = self.state.final_combined_ind_mapping
+        # the results of all the states are looked up together
+        state_inds = sorted(
+            {ind for ind_l in combined_mapping.values() for ind in ind_l}
+        )
+        loaded = load_results(
+            [self.checksum_states(ind) for ind in state_inds],
+            self.cache_locations,
+            require_all=True,
+        )
+        if loaded is None:
+            return None
+        state_results = dict(zip(state_inds, loaded))
         combined_results = []
-        for gr, ind_l in self.state.final_combined_ind_mapping.items():
+        for gr, ind_l in combined_mapping.items():
             combined_results_gr = []
             for ind in ind_l:
-                result = load_result(self.checksum_states(ind), self.cache_locations)
-                if result is None:
-                    return None
+                result = state_results[ind]
                 if return_inputs is True or return_inputs == "val":
                     result = (self.state.states_val[ind], result)
                 elif return_inputs == "ind":
@@ -854,13 +927,16 @@ class TaskBase:
                 if self.state.combiner:
                     return self._combined_output(return_inputs=return_inputs)
                 else:
-                    results = []
-                    for ind in range(len(self.state.inputs_ind)):
-                        checksum = self.checksum_states(state_index=ind)
-                        result = load_result(checksum, self.cache_locations)
-                        if result is None:
-                            return None
-                        results.append(result)
+                    results = load_results(
+                        [
+                            self.checksum_states(state_index=ind)
+                            for ind in range(len(self.state.inputs_ind))
+                        ],
+                        self.cache_locations,
+                        require_all=True,
+                    )
+                    if results is None:
+                        return None
                     if return_inputs is True or return_inputs == "val":
                         return list(zip(self.state.states_val, results))
                     elif return_inputs == "ind":
@@ -909,8 +985,23 @@ class TaskBase:
             for task in self.graph.nodes:
                 task._reset()
 
-    def _check_for_hash_changes(self):
-        hash_changes = self.inputs.hash_changes()
+    def _snapshot_inputs(self) -> ty.Optional[ty.Dict[str, ty.Optional[tuple]]]:
+        """Snapshot the inputs to check for changes after the run, unless the "strict"
+        check, in which all inputs are rehashed, has been selected"""
+        if hash_change_check_default() == "strict":
+            return None
+        return self.inputs.snapshot()
+
+    def _check_for_hash_changes(self, inputs_snapshot=None):
+        if inputs_snapshot is None:
+            # strict check, all fields are fully rehashed
+            hash_changes = self.inputs.hash_changes(self.file_hash_policy)
+        else:
+            hash_changes = self.inputs.hash_changes(
+                self.file_hash_policy,
+                memo=self.input_hash_memo,
+                snapshot=inputs_snapshot,
+            )
         details = ""
         for changed in hash_changes:
             field = getattr(attr.fields(type(self.inputs)), changed)
@@ -1146,7 +1237,9 @@ class Workflow(TaskBase):
                 nd.name: nd.checksum for nd in self.graph_sorted
             }
 
-        input_hash = self.inputs.hash
+        input_hash = self.inputs.compute_hash(
+            self.file_hash_policy, memo=self.input_hash_memo
+        )
         if not self.state:
             self._checksum = create_checksum(
                 self.__class__.__name__, self._checksum_wf(input_hash)
@@ -1286,7 +1379,10 @@ class Workflow(TaskBase):
             propagate_rerun=self.task_rerun and self.propagate_rerun
         )
 
-        checksum = self.checksum
+        hash_profile = HashProfile() if HashProfile.enabled() else None
+        with activate_hash_profile(hash_profile):
+            checksum = self.checksum
+        inputs_snapshot = self._snapshot_inputs()
         output_dir = self.output_dir
         lockfile = self.cache_dir / (checksum + ".lock")
         self.hooks.pre_run(self)
@@ -1302,6 +1398,8 @@ class Workflow(TaskBase):
                     return result
             cwd = os.getcwd()
             self._populate_filesystem(checksum, output_dir)
+            if hash_profile is not None:
+                hash_profile.save(output_dir)
             result = Result(output=None, runtime=None, errored=False)
             self.hooks.pre_run_task(self)
             self.audit.start_audit(odir=output_dir)
@@ -1323,10 +1421,11 @@ class Workflow(TaskBase):
                 # removing the additional file with the checksum
                 (self.cache_dir / f"{self.uid}_info.json").unlink()
                 os.chdir(cwd)
+        cache_tiers.saved(output_dir, self.cache_locations)
         self.hooks.post_run(self, result)
         # Check for any changes to the input hashes that have occurred during the execution
         # of the task
-        self._check_for_hash_changes()
+        self._check_for_hash_changes(inputs_snapshot)
         return result
 
     async def _run_task(self, submitter, rerun=False):
@@ -1527,6 +1626,8 @@ class Workflow(TaskBase):
             if override_task_caches and task.allow_cache_override:
                 task.cache_dir = self.cache_dir
             task.cache_locations = task._cache_locations + self.cache_locations
+            if task.file_hash_policy is None:
+                task.file_hash_policy = self.file_hash_policy
 
 
 def is_task(obj):
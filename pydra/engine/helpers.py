@@ -2,14 +2,28 @@
 
 import asyncio
 import asyncio.subprocess as asp
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from collections import OrderedDict, deque
+from copy import copy
+from functools import cached_property
 from pathlib import Path
 import os
 import sys
 from uuid import uuid4
 import getpass
+import inspect
+import logging
+import json
+import lzma
+import pickle
+import zlib
 import typing as ty
 import subprocess as sp
 import re
+import shutil
+import struct
+import threading
+import time
 from time import strftime
 from traceback import format_exception
 import attr
@@ -17,17 +31,29 @@ import attrs  # New defaults
 from filelock import SoftFileLock, Timeout
 import cloudpickle as cp
 from .specs import (
+    InputHashMemo,
     Runtime,
     attr_fields,
     Result,
     LazyField,
+    LazyOutputs,
+    StoredOutput,
     File,
 )
-from .helpers_file import copy_nested_files
+from .helpers_file import copy_nested_files, BlobStore
 from ..utils.typing import TypeParser
 from fileformats.core import FileSet
 from .specs import MultiInputFile, MultiInputObj, MultiOutputObj, MultiOutputFile
 
+try:
+    import numpy
+except ImportError:
+    HAVE_NUMPY = False
+else:
+    HAVE_NUMPY = True
+
+logger = logging.getLogger("pydra")
+
 
 def ensure_list(obj, tuple2list=False):
     """
@@ -103,6 +129,662 @@ def print_help(obj):
     return lines
 
 
+PICKLE_SERIALIZER_ENV_VAR = "PYDRA_PICKLE_SERIALIZER"
+PICKLE_COMPRESSION_ENV_VAR = "PYDRA_PICKLE_COMPRESSION"
+PICKLE_MAGIC = b"\x00PYDRA1\x00"
+RESULT_INLINE_SIZE_ENV_VAR = "PYDRA_RESULT_INLINE_SIZE"
+SIDECAR_MIN_SIZE = 2**20
+"""Minimum size (in bytes) of the buffers that are written to sidecar files"""
+
+
+@attrs.define(frozen=True)
+class Serializer:
+    """A serializer of the task and result files
+
+    Parameters
+    ----------
+    dumps : callable
+        Serializes an object, taking the object and a `buffer_callback` (as for
+        `pickle.dumps` with protocol 5, which may be None) and returning bytes
+    loads : callable
+        Deserializes an object, taking the bytes and the out-of-band buffers
+    fallback : str, optional
+        Name of the serializer used instead if `dumps` raises an exception
+    """
+
+    dumps: ty.Callable[[ty.Any, ty.Optional[ty.Callable]], bytes]
+    loads: ty.Callable[[bytes, ty.List[ty.Any]], ty.Any]
+    fallback: ty.Optional[str] = None
+
+
+def _pickle_dumps(obj, buffer_callback):
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    # objects defined in the main module are pickled by reference by the standard
+    # library, so they couldn't be loaded by the workers
+    if b"__main__" in data:
+        raise pickle.PicklingError("object refers to the __main__ module")
+    return data
+
+
+def _pickle_loads(data, buffers):
+    return pickle.loads(data, buffers=buffers)
+
+
+SERIALIZERS: ty.Dict[str, Serializer] = {
+    "pickle": Serializer(_pickle_dumps, _pickle_loads, fallback="cloudpickle"),
+    "cloudpickle": Serializer(
+        lambda obj, buffer_callback: cp.dumps(
+            obj, protocol=5, buffer_callback=buffer_callback
+        ),
+        _pickle_loads,
+    ),
+}
+
+COMPRESSIONS: ty.Dict[str, ty.Tuple[ty.Callable, ty.Callable]] = {
+    "none": (bytes, bytes),
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def register_serializer(name: str, serializer: Serializer):
+    """Register a serializer of the task and result files, which can then be selected
+    by name in `dump_pickle` or with the PYDRA_PICKLE_SERIALIZER environment variable.
+    Since the name is recorded in the files, the serializer needs to be registered in
+    the processes that load them too."""
+    SERIALIZERS[name] = serializer
+
+
+def register_compression(
+    name: str, compress: ty.Callable[[bytes], bytes], decompress: ty.Callable
+):
+    """Register a compression of the task and result files, which can then be selected
+    by name in `dump_pickle` or with the PYDRA_PICKLE_COMPRESSION environment
+    variable"""
+    COMPRESSIONS[name] = (compress, decompress)
+
+
+def _sidecar_path(path: Path, index: int) -> Path:
+    return path.with_name(f"{path.stem}.buf{index}.npy")
+
+
+def dump_pickle(
+    obj,
+    path: Path,
+    serializer: ty.Optional[str] = None,
+    compression: ty.Optional[str] = None,
+):
+    """
+    Write an object to a task or result file.
+
+    The file ends with a trailer recording the serializer and compression used, so
+    the files can be loaded whatever the settings of the loading process (since
+    trailing bytes are ignored by `pickle.loads`, uncompressed files without sidecars
+    can also still be loaded directly with pickle or cloudpickle). If numpy is
+    installed, buffers larger than `SIDECAR_MIN_SIZE` that support pickle protocol 5
+    (e.g. large numpy arrays) are written out-of-band to `.npy` sidecar files next to
+    the file, which are memory-mapped when it is loaded (see `load_pickle`), instead
+    of being copied into it.
+
+    Parameters
+    ----------
+    obj : :obj:`object`
+        The object to write
+    path : :obj:`Path`
+        Path of the file
+    serializer : :obj:`str`, optional
+        Name of the serializer (see `register_serializer`), by default the one set by
+        the PYDRA_PICKLE_SERIALIZER environment variable or "pickle", which uses the
+        standard library and falls back to cloudpickle for the objects it can't pickle
+    compression : :obj:`str`, optional
+        Compression of the file ("none", "zlib", "lzma" or one registered with
+        `register_compression`), by default the one set by the
+        PYDRA_PICKLE_COMPRESSION environment variable or "none". The sidecar files
+        aren't compressed so that they can be memory-mapped.
+    """
+    _write_pickle(Path(path), *_serialize_pickle(obj, serializer, compression))
+
+
+def _serialize_pickle(
+    obj, serializer: ty.Optional[str] = None, compression: ty.Optional[str] = None
+) -> ty.Tuple[bytes, ty.List[memoryview]]:
+    """Serialize an object into the contents of a file written by `dump_pickle` and
+    the buffers to be written to its sidecars"""
+    if serializer is None:
+        serializer = os.environ.get(PICKLE_SERIALIZER_ENV_VAR, "pickle")
+    if compression is None:
+        compression = os.environ.get(PICKLE_COMPRESSION_ENV_VAR, "none")
+    try:
+        compress = COMPRESSIONS[compression][0]
+    except KeyError:
+        raise ValueError(
+            f"Unrecognised compression '{compression}', can be one of "
+            f"{list(COMPRESSIONS)}"
+        )
+    buffers = []
+
+    def buffer_callback(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:  # non-contiguous buffers are pickled in-band
+            return True
+        if raw.nbytes < SIDECAR_MIN_SIZE:
+            return True
+        buffers.append(raw)
+        return False
+
+    while True:
+        try:
+            dumps = SERIALIZERS[serializer].dumps
+        except KeyError:
+            raise ValueError(
+                f"Unrecognised serializer '{serializer}', can be one of "
+                f"{list(SERIALIZERS)}"
+            )
+        try:
+            data = dumps(obj, buffer_callback if HAVE_NUMPY else None)
+        except Exception:
+            if SERIALIZERS[serializer].fallback is None:
+                raise
+            serializer = SERIALIZERS[serializer].fallback
+            buffers.clear()
+        else:
+            break
+    header = json.dumps(
+        {"serializer": serializer, "compression": compression, "buffers": len(buffers)}
+    ).encode()
+    data = b"".join(
+        (compress(data), header, struct.pack("<I", len(header)), PICKLE_MAGIC)
+    )
+    return data, buffers
+
+
+def _write_pickle(path: Path, data: bytes, buffers: ty.List[memoryview]):
+    # the sidecars are written first so that they are complete once the file exists
+    sidecars = [_sidecar_path(path, i) for i in range(len(buffers))]
+    for sidecar, raw in zip(sidecars, buffers):
+        numpy.save(sidecar, numpy.frombuffer(raw, dtype=numpy.uint8))
+    for stale in path.parent.glob(f"{path.stem}.buf*.npy"):
+        if stale not in sidecars:
+            stale.unlink(missing_ok=True)
+    path.write_bytes(data)
+
+
+def load_pickle(path: Path):
+    """
+    Load an object from a task or result file written by `dump_pickle`, memory-mapping
+    its sidecar files (copy-on-write, so the loaded arrays can still be modified
+    without changing the files). Files written by older versions of pydra (i.e. with
+    cloudpickle and without a trailer) are also loaded.
+
+    Parameters
+    ----------
+    path : :obj:`Path`
+        Path of the file
+    """
+    data = Path(path).read_bytes()
+    if not data.endswith(PICKLE_MAGIC):
+        return cp.loads(data)
+    header_end = len(data) - len(PICKLE_MAGIC) - 4
+    (header_size,) = struct.unpack("<I", data[header_end : -len(PICKLE_MAGIC)])
+    header = json.loads(data[header_end - header_size : header_end])
+    try:
+        serializer = SERIALIZERS[header["serializer"]]
+        decompress = COMPRESSIONS[header["compression"]][1]
+    except KeyError as e:
+        raise ValueError(
+            f"Cannot load '{path}', which was written with the unregistered serializer "
+            f"or compression {e}"
+        )
+    buffers = [
+        numpy.load(_sidecar_path(Path(path), i), mmap_mode="c")
+        for i in range(header["buffers"])
+    ]
+    return serializer.loads(decompress(data[: header_end - header_size]), buffers)
+
+
+class ResultIndex:
+    """Index of the checksums of the tasks that have saved results in a cache location,
+    so that lookups of tasks that haven't been run don't need to stat their directories.
+
+    The index is backed by an append-only manifest in the location, to which the
+    checksum of a task is appended whenever its result is saved (see `save`). Refreshing
+    the index only stats the manifest and reads the entries appended since it was last
+    read. Locations without a manifest (e.g. created by older versions) are scanned for
+    result files once, after which a marker is appended to the manifest.
+
+    Since results can be removed without updating the manifest (e.g. when a task is
+    rerun), an indexed checksum only indicates that a result may be present, which is
+    confirmed when it is loaded.
+
+    Locations that aren't writable (e.g. shared caches mounted read-only) are scanned
+    without being locked, and the results found are only indexed in memory.
+    """
+
+    MANIFEST_NAME = "_results_index"
+    SCANNED_MARKER = "#scanned"
+
+    _instances: ty.Dict[str, "ResultIndex"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, location: os.PathLike):
+        self.location = Path(location)
+        self.manifest = self.location / self.MANIFEST_NAME
+        self.checksums: ty.Set[str] = set()
+        self._manifest_id: ty.Optional[ty.Tuple[int, int]] = None
+        self._offset = 0
+        self._scanned = False
+        self._lock = threading.RLock()
+
+    @classmethod
+    def for_location(cls, location: os.PathLike) -> "ResultIndex":
+        """The index of the location shared within the process"""
+        key = os.path.abspath(location)
+        with cls._instances_lock:
+            try:
+                return cls._instances[key]
+            except KeyError:
+                index = cls._instances[key] = cls(key)
+                return index
+
+    def refresh(self):
+        """Read the entries appended to the manifest since it was last read, scanning
+        the location for results if it hasn't been indexed yet"""
+        with self._lock:
+            try:
+                stat = self.manifest.stat()
+            except FileNotFoundError:
+                stat = None
+            manifest_id = (stat.st_dev, stat.st_ino) if stat else None
+            if manifest_id != self._manifest_id or (
+                stat and stat.st_size < self._offset
+            ):
+                # the manifest has been created, removed or rewritten
+                self.checksums.clear()
+                self._manifest_id = manifest_id
+                self._offset = 0
+                self._scanned = False
+            if stat and stat.st_size > self._offset:
+                with self.manifest.open("rb") as f:
+                    f.seek(self._offset)
+                    appended = f.read(stat.st_size - self._offset)
+                # only complete lines are read, as others may still be being written
+                appended = appended[: appended.rfind(b"\n") + 1]
+                self._offset += len(appended)
+                for line in appended.decode().splitlines():
+                    if line == self.SCANNED_MARKER:
+                        self._scanned = True
+                    elif line:
+                        self.checksums.add(line)
+            if not self._scanned and self.location.is_dir():
+                self._scan()
+
+    def completed(self, checksums: ty.Iterable[str]) -> ty.Set[str]:
+        """Return the checksums, of those provided, that have results in the location
+        according to the (refreshed) index"""
+        self.refresh()
+        with self._lock:
+            return self.checksums.intersection(checksums)
+
+    def add(self, checksum: str):
+        """Add the checksum of a task whose result has been saved to the index"""
+        try:
+            self._append([checksum])
+        except OSError as e:
+            logger.debug("Couldn't append %s to %s: %s", checksum, self.manifest, e)
+        with self._lock:
+            self.checksums.add(checksum)
+
+    def compact(self):
+        """Rewrite the manifest with only the checksums of the results present in the
+        location (e.g. after results have been removed from it)"""
+        with self._lock, SoftFileLock(self.lockfile):
+            found = self._find_results()
+            tmp_manifest = self.manifest.with_name(f"{self.MANIFEST_NAME}.{uuid4()}")
+            tmp_manifest.write_text(
+                "".join(line + "\n" for line in found + [self.SCANNED_MARKER])
+            )
+            # the new manifest is detected by the indices of other processes, which
+            # are then reread from it
+            os.replace(tmp_manifest, self.manifest)
+            self._manifest_id = None
+        self.refresh()
+
+    @property
+    def lockfile(self) -> Path:
+        return self.location / (self.MANIFEST_NAME + ".lock")
+
+    def _scan(self):
+        try:
+            with SoftFileLock(self.lockfile):
+                # another process may have scanned the location while waiting for the
+                # lock
+                if self.manifest.exists():
+                    if self.SCANNED_MARKER in self.manifest.read_text().splitlines():
+                        self._scanned = True
+                        return
+                found = self._find_results()
+                self._append(found + [self.SCANNED_MARKER])
+        except OSError as e:
+            # e.g. a read-only location, whose results are only indexed in memory
+            logger.debug("Couldn't write the index of %s: %s", self.location, e)
+            found = self._find_results()
+        self.checksums.update(found)
+        self._scanned = True
+
+    def _find_results(self) -> ty.List[str]:
+        return [
+            entry.name
+            for entry in os.scandir(self.location)
+            if entry.is_dir() and _has_result(Path(entry.path))
+        ]
+
+    def _append(self, lines: ty.List[str]):
+        # appended in a single write so the lines aren't interleaved with those
+        # appended concurrently by other processes
+        fd = os.open(self.manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            os.write(fd, "".join(line + "\n" for line in lines).encode())
+        finally:
+            os.close(fd)
+
+
+class ResultCache:
+    """Process-wide LRU cache of the results unpickled from the cache locations, so
+    that the results of tasks that are repeatedly looked up (e.g. by the submitter to
+    check whether the tasks they are connected to are done) are only unpickled once.
+
+    The results are keyed by the path of their file and validated against its
+    modification time and size, so results that have been rewritten are reloaded.
+    Results are evicted, least recently used first, once the total size of their
+    files exceeds `max_size` bytes (set by the PYDRA_RESULT_CACHE_SIZE environment
+    variable, 256 MiB by default, with 0 disabling the cache).
+
+    Note that the cached results are shared between the callers, so they shouldn't be
+    modified.
+    """
+
+    ENV_VAR = "PYDRA_RESULT_CACHE_SIZE"
+
+    def __init__(self, max_size: ty.Optional[int] = None):
+        if max_size is None:
+            max_size = int(os.environ.get(self.ENV_VAR, 2**28))
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, result_file: Path):
+        """Load the result from the file, or from the cache if the file is unchanged
+        since it was last loaded. Returns None if the file is missing or empty."""
+        try:
+            stat = result_file.stat()
+        except FileNotFoundError:
+            return None
+        if not stat.st_size:
+            return None
+        key = str(result_file)
+        file_id = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == file_id:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        result = load_pickle(result_file)
+        if isinstance(result.output, LazyOutputs):
+            # the outputs are loaded from the directory the result has been loaded from
+            result.output.relocate(
+                result_file.with_name(result.output.outputs_dir.name)
+            )
+        if stat.st_size <= self.max_size:
+            with self._lock:
+                self._pop(key)
+                self._entries[key] = (file_id, result)
+                self.size += stat.st_size
+                while self.size > self.max_size:
+                    _, ((_, evicted_size), _) = self._entries.popitem(last=False)
+                    self.size -= evicted_size
+        return result
+
+    def invalidate(self, task_dir: Path):
+        """Remove the result of the task from the cache (e.g. when it is rerun)"""
+        with self._lock:
+            self._pop(str(Path(task_dir) / "_result.pklz"))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0][1]
+
+
+result_cache = ResultCache()
+"""The cache of the results loaded by the process"""
+
+
+def _has_result(task_dir: Path) -> bool:
+    try:
+        return (task_dir / "_result.pklz").stat().st_size > 0
+    except FileNotFoundError:
+        return False
+
+
+class CacheTiers:
+    """Tiering of the cache locations searched for results, in which the first
+    location (the cache directory of the task, which the results are written to, e.g.
+    on a fast local disk) is the local tier and the others are slower shared tiers
+    (e.g. on a network filesystem).
+
+    The hits and lookups of each location are recorded (see `report`), and results can
+    be copied between the tiers in the background (see `copy_result`):
+
+    * results found in shared tiers are copied into the local tier, so that
+      subsequent lookups don't need to access the shared tier, if the
+      PYDRA_CACHE_PROMOTE environment variable is set
+    * new results are copied into the first shared tier, so that they are available
+      to other hosts, if the PYDRA_CACHE_WRITE_BACK environment variable is set
+
+    Results are only copied into locations in which they aren't present or being
+    computed, and copying them into read-only locations is skipped.
+
+    The cache directory is only looked up before the other locations while results
+    are promoted or written back (see `TaskBase.cache_locations`), otherwise the
+    locations passed by the user take precedence over it.
+    """
+
+    PROMOTE_ENV_VAR = "PYDRA_CACHE_PROMOTE"
+    WRITE_BACK_ENV_VAR = "PYDRA_CACHE_WRITE_BACK"
+
+    def __init__(
+        self, promote: ty.Optional[bool] = None, write_back: ty.Optional[bool] = None
+    ):
+        if promote is None:
+            promote = _env_flag(self.PROMOTE_ENV_VAR)
+        if write_back is None:
+            write_back = _env_flag(self.WRITE_BACK_ENV_VAR)
+        self.promote = promote
+        self.write_back = write_back
+        self.stats: ty.Dict[str, ty.List[int]] = {}
+        self._pending: ty.Dict[Path, Future] = {}
+        self._executor: ty.Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def tiered(self) -> bool:
+        """Whether results are copied between the tiers"""
+        return self.promote or self.write_back
+
+    def record(self, location: os.PathLike, hits: int, lookups: int):
+        """Record the number of results found in a location out of those looked up"""
+        with self._lock:
+            stats = self.stats.setdefault(str(location), [0, 0])
+            stats[0] += hits
+            stats[1] += lookups
+
+    def hit_rates(self) -> ty.Dict[str, float]:
+        """The proportion of the lookups of each location that were hits"""
+        with self._lock:
+            return {loc: hits / lookups for loc, (hits, lookups) in self.stats.items()}
+
+    def report(self) -> str:
+        """Human-readable report of the hit rates of the locations"""
+        with self._lock:
+            return "\n".join(
+                f"{loc}: {hits}/{lookups} hits ({hits / lookups:.0%})"
+                for loc, (hits, lookups) in self.stats.items()
+            )
+
+    def found(self, task_dir: Path, cache_locations: ty.Sequence[os.PathLike]):
+        """Called when a result is found in a cache location, promoting it to the
+        local tier if it was found in a shared tier"""
+        if self.promote and task_dir.parent != Path(cache_locations[0]):
+            self._copy(task_dir, Path(cache_locations[0]))
+
+    def saved(self, task_dir: Path, cache_locations: ty.Sequence[os.PathLike]):
+        """Called when a new result is saved to the local tier, writing it back to the
+        first shared tier"""
+        if self.write_back and len(cache_locations) > 1:
+            self._copy(task_dir, Path(cache_locations[1]))
+
+    def wait(self):
+        """Wait for the pending copies to complete"""
+        with self._lock:
+            pending = list(self._pending.values())
+        wait_futures(pending)
+
+    def clear(self):
+        with self._lock:
+            self.stats.clear()
+
+    def _copy(self, task_dir: Path, location: Path) -> ty.Optional[Future]:
+        dest = location / task_dir.name
+        with self._lock:
+            if dest in self._pending:
+                return None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=2, thread_name_prefix="pydra-cache-tiers"
+                )
+            future = self._pending[dest] = self._executor.submit(
+                self._copy_task, task_dir, location
+            )
+        return future
+
+    def _copy_task(self, task_dir: Path, location: Path):
+        try:
+            copy_result(task_dir, location)
+        except Exception as e:
+            logger.debug("Couldn't copy %s to %s: %s", task_dir, location, e)
+        finally:
+            with self._lock:
+                del self._pending[location / task_dir.name]
+
+
+def copy_result(
+    task_dir: Path,
+    location: os.PathLike,
+    origin: ty.Optional[os.PathLike] = None,
+    move: bool = False,
+) -> ty.Optional[Path]:
+    """
+    Copy the directory of a task with a result into another cache location, relocating
+    the file-sets of its outputs into the copied directory.
+
+    Parameters
+    ----------
+    task_dir : :obj:`Path`
+        the directory of the task
+    location : :obj:`os.PathLike`
+        the cache location to copy it into
+    origin : :obj:`os.PathLike`, optional
+        the directory the paths of the output file-sets are relative to, if it isn't
+        the task directory (e.g. when it has been downloaded from another host)
+    move : bool
+        move the task directory instead of copying it, it must be in the same file
+        system as the location
+
+    Returns
+    -------
+    dest : :obj:`Path` or None
+        the copied directory, or None if the result is already present in the location
+        or the task is being run in it
+    """
+    task_dir = Path(task_dir)
+    location = Path(location)
+    origin = Path(origin) if origin is not None else task_dir
+    dest = location / task_dir.name
+    if _has_result(dest):
+        return None
+    lock = SoftFileLock(location / (task_dir.name + ".lock"))
+    try:
+        lock.acquire(timeout=0)
+    except Timeout:
+        return None
+    try:
+        if dest.exists():
+            # an incomplete copy or run
+            shutil.rmtree(dest)
+        result_file = task_dir / "_result.pklz"
+        result = load_pickle(result_file)
+        if result.output is not None:
+            if isinstance(result.output, LazyOutputs):
+                result.output.relocate(task_dir / result.output.outputs_dir.name)
+
+            def relocate(fileset: FileSet) -> FileSet:
+                if not all(origin in Path(p).parents for p in fileset.fspaths):
+                    return fileset
+                return type(fileset)(
+                    [dest / Path(p).relative_to(origin) for p in fileset.fspaths]
+                )
+
+            # the stored outputs are loaded before the directory is moved
+            values = {
+                f.name: getattr(result.output, f.name)
+                for f in attr_fields(result.output)
+            }
+        # the result file and stored outputs are rewritten with the relocated paths
+        if move:
+            os.rename(task_dir, dest)
+            for path in dest.glob("_result.*"):
+                path.unlink()
+        else:
+            skipped = shutil.ignore_patterns("_result.*", "_outputs")
+            tmp_dir = location / f".{task_dir.name}.{uuid4().hex}"
+            shutil.copytree(task_dir, tmp_dir, symlinks=True, ignore=skipped)
+            os.rename(tmp_dir, dest)
+        if result.output is not None:
+            # the relocated file-sets are validated, so the files must be in place
+            for name, value in values.items():
+                value = TypeParser.apply_to_instances(FileSet, relocate, value)
+                setattr(result.output, name, value)
+        result = store_outputs(result, dest / "_outputs")
+        dump_pickle(result, dest / "_result.pklz")
+        result_cache.invalidate(dest)
+        ResultIndex.for_location(location).add(dest.name)
+    finally:
+        lock.release()
+    return dest
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").lower() not in ("", "0", "false", "no")
+
+
+cache_tiers = CacheTiers()
+"""The tiering of the cache locations searched by the process"""
+
+
 def load_result(checksum, cache_locations):
     """
     Restore a result from the cache.
@@ -116,17 +798,61 @@ def load_result(checksum, cache_locations):
         the checksum will be looked for.
 
     """
+    return load_results([checksum], cache_locations)[0]
+
+
+def load_results(checksums, cache_locations, require_all=False):
+    """
+    Restore the results of multiple tasks from the cache, looking the checksums up in
+    the result indices of the cache locations in bulk.
+
+    Parameters
+    ----------
+    checksums : :obj:`list` of :obj:`str`
+        Unique identifiers of the tasks to be loaded.
+    cache_locations : :obj:`list` of :obj:`os.pathlike`
+        List of cache directories, in order of priority, where
+        the checksums will be looked for.
+    require_all : :obj:`bool`
+        If True, None is returned instead of a list (and no results are loaded) if
+        any of the results aren't in the cache.
+
+    Returns
+    -------
+    results : :obj:`list` of :obj:`Result` or None
+        The results of the tasks (None for those not in the cache).
+
+    """
+    results = [None] * len(checksums)
     if not cache_locations:
-        return None
+        return None if require_all and checksums else results
+    pending = {}
+    for i, checksum in enumerate(checksums):
+        pending.setdefault(checksum, []).append(i)
     # TODO: if there are issues with loading, we might need to
     # TODO: sleep and repeat loads (after checking that there are no lock files!)
+    result_files = {}
     for location in cache_locations:
-        if (location / checksum).exists():
-            result_file = location / checksum / "_result.pklz"
-            if result_file.exists() and result_file.stat().st_size > 0:
-                return cp.loads(result_file.read_bytes())
-            return None
-    return None
+        if len(result_files) == len(pending):
+            break
+        lookups = [c for c in pending if c not in result_files]
+        found = ResultIndex.for_location(location).completed(lookups)
+        cache_tiers.record(location, len(found), len(lookups))
+        for checksum in found:
+            result_files[checksum] = Path(location) / checksum / "_result.pklz"
+    if require_all and len(result_files) < len(pending):
+        return None
+    for checksum, result_file in result_files.items():
+        result = result_cache.load(result_file)
+        if result is None:
+            # the result has been removed since it was indexed
+            if require_all:
+                return None
+            continue
+        for i in pending[checksum]:
+            results[i] = result
+        cache_tiers.found(result_file.parent, cache_locations)
+    return results
 
 
 def save(task_path: Path, result=None, task=None, name_prefix=None):
@@ -158,11 +884,61 @@ def save(task_path: Path, result=None, task=None, name_prefix=None):
             if task_path.name.startswith("Workflow") and result.output is not None:
                 # copy files to the workflow directory
                 result = copyfile_workflow(wf_path=task_path, result=result)
-            with (task_path / f"{name_prefix}_result.pklz").open("wb") as fp:
-                cp.dump(result, fp)
+            blob_store = BlobStore.default(task_path.parent)
+            if blob_store and not name_prefix and result.output is not None:
+                blob_store.ingest_nested(
+                    attr.asdict(result.output, recurse=False), task_path
+                )
+            result = store_outputs(result, task_path / f"{name_prefix}_outputs")
+            dump_pickle(result, task_path / f"{name_prefix}_result.pklz")
+            if not name_prefix:
+                result_cache.invalidate(task_path)
+                ResultIndex.for_location(task_path.parent).add(task_path.name)
         if task:
-            with (task_path / f"{name_prefix}_task.pklz").open("wb") as fp:
-                cp.dump(task, fp)
+            dump_pickle(task, task_path / f"{name_prefix}_task.pklz")
+
+
+def store_outputs(result: Result, outputs_dir: Path) -> Result:
+    """
+    Write the values of the output fields of a result that are larger than the size
+    set by the PYDRA_RESULT_INLINE_SIZE environment variable (64 KiB by default, with
+    0 storing every field) to separate files in the outputs directory, so that they
+    are only loaded when they are accessed (see `LazyOutputs`) instead of whenever
+    the result is loaded.
+
+    Parameters
+    ----------
+    result : :obj:`Result`
+        The result to be saved
+    outputs_dir : :obj:`Path`
+        The directory the values are written to
+
+    Returns
+    -------
+    result : :obj:`Result`
+        The result to be pickled, which references the stored values
+    """
+    if result.output is None:
+        shutil.rmtree(outputs_dir, ignore_errors=True)
+        return result
+    inline_size = int(os.environ.get(RESULT_INLINE_SIZE_ENV_VAR, 2**16))
+    fields = [(f.name, f.type) for f in attr_fields(result.output)]
+    # the values are accessed before the previous files are removed, as they may be
+    # lazily loaded from them
+    values = {name: getattr(result.output, name) for name, _ in fields}
+    shutil.rmtree(outputs_dir, ignore_errors=True)
+    for name, value in values.items():
+        data, buffers = _serialize_pickle(value)
+        if len(data) + sum(b.nbytes for b in buffers) >= inline_size:
+            outputs_dir.mkdir(parents=True, exist_ok=True)
+            _write_pickle(outputs_dir / f"{name}.pklz", data, buffers)
+            values[name] = StoredOutput(f"{name}.pklz")
+    if not any(isinstance(v, StoredOutput) for v in values.values()):
+        return result
+    output = LazyOutputs.create(
+        type(result.output).__name__, fields, values, outputs_dir
+    )
+    return attr.evolve(result, output=output)
 
 
 def copyfile_workflow(wf_path: os.PathLike, result):
@@ -547,7 +1323,7 @@ def load_and_run(
 ):
     """
     loading a task from a pickle file, settings proper input
-    and running the task
+    and running the task, returning its result
     """
     try:
         task = load_task(task_pkl=task_pkl, ind=ind)
@@ -555,14 +1331,67 @@ def load_and_run(
         if task_pkl.parent.exists():
             etype, eval, etr = sys.exc_info()
             traceback = format_exception(etype, eval, etr)
-            errorfile = record_error(task_pkl.parent, error=traceback)
+            record_error(task_pkl.parent, error=traceback)
             result = Result(output=None, runtime=None, errored=True)
             save(task_pkl.parent, result=result)
         raise
+    return _run_loaded(task, rerun=rerun, plugin=plugin, submitter=submitter, **kwargs)
+
 
+def load_and_run_chunk(task_pkl, inds, rerun=False, report=None, **kwargs):
+    """
+    loading and running the states of a task with the given indices one after the
+    other, each in its own task directory as by `load_and_run`, returning the result
+    of each state or the exception it raised, along with its runtime
+
+    If `report` is given, the outcomes of the states other than the last are instead
+    passed to `report(ind, outcome, runtime)` as soon as they complete, e.g. to stream
+    them back from the process running the chunk, so that only the outcome of the last
+    state is returned and each outcome is only sent back once.
+    """
+    outcomes = []
+    for i, ind in enumerate(inds):
+        start = time.monotonic()
+        try:
+            outcome = load_and_run(task_pkl, ind, rerun, **kwargs)
+        except Exception as e:
+            outcome = e
+        if report is not None and i < len(inds) - 1:
+            report(ind, outcome, time.monotonic() - start)
+        else:
+            outcomes.append((ind, outcome, time.monotonic() - start))
+    return outcomes
+
+
+def load_and_run_node(wf_pkl, name, rerun=False):
+    """
+    loading a workflow from a pickle file and running one of its nodes, whose inputs
+    connected to other nodes are retrieved from their results in the cache (e.g. in
+    the jobs of the nodes submitted upfront by the slurm worker)
+    """
+    wf = load_task(task_pkl=wf_pkl)
+    graph = wf.graph
+    node = getattr(wf, name)
+    # the inputs of the nodes upstream of the node are retrieved first, in
+    # topological order, as they are needed to find the results of the nodes
+    upstream = {name}
+    predecessors = deque([node])
+    while predecessors:
+        for pred in graph.predecessors[predecessors.popleft().name]:
+            if pred.name not in upstream:
+                upstream.add(pred.name)
+                predecessors.append(pred)
+    for nd in graph.sorted_nodes:
+        if nd.name in upstream:
+            nd.inputs.retrieve_values(wf)
+    return _run_loaded(node, rerun=rerun)
+
+
+def _run_loaded(task, rerun=False, plugin=None, submitter=None, **kwargs):
+    """running a loaded task, creating the result and error files if it fails"""
     resultfile = task.output_dir / "_result.pklz"
     try:
-        task(rerun=rerun, plugin=plugin, submitter=submitter, **kwargs)
+        result = task(rerun=rerun, plugin=plugin, submitter=submitter, **kwargs)
     except Exception as excinfo:
         # creating result and error files if missing
         errorfile = task.output_dir / "_error.pklz"
@@ -577,26 +1406,46 @@ def load_and_run(
             str(excinfo.with_traceback(None)),
             f" full crash report is here: {errorfile}",
         )
-    return resultfile
+    return result
 
 
 async def load_and_run_async(task_pkl, ind=None, submitter=None, rerun=False, **kwargs):
     """
     loading a task from a pickle file, settings proper input
-    and running the workflow
+    and running the workflow, returning its result
     """
     task = load_task(task_pkl=task_pkl, ind=ind)
-    await task._run(submitter=submitter, rerun=rerun, **kwargs)
+    return await task._run(submitter=submitter, rerun=rerun, **kwargs)
 
 
 def load_task(task_pkl, ind=None):
     """loading a task from a pickle file, settings proper input for the specific ind"""
     if isinstance(task_pkl, str):
         task_pkl = Path(task_pkl)
-    task = cp.loads(task_pkl.read_bytes())
-    if ind is not None:
+    task = load_pickle(task_pkl)
+    if isinstance(task, StatePayload):
+        if ind is None:
+            raise ValueError(
+                f"The index of the state to load from {task_pkl} is needed"
+            )
+        record = StatePayload.read_record(task_pkl, ind)
+        task = task.task
+        input_ind = record["inputs_ind"]
+        ind_inputs = record["inputs"]
+        task.input_hash_memo.entries.update(record["memo"])
+    elif ind is not None:
+        input_ind = task.state.inputs_ind[ind]
         ind_inputs = task.get_input_el(ind)
+    if ind is not None:
         task.inputs = attr.evolve(task.inputs, **ind_inputs)
+        # reusing the hashes of the elements calculated for the checksum of the state
+        for inp_nm, value in ind_inputs.items():
+            task.input_hash_memo.rebind(
+                (inp_nm, input_ind[f"{task.name}.{inp_nm}"]),
+                value,
+                getattr(task.inputs, inp_nm),
+                new_key=inp_nm,
+            )
         task._pre_split = True
         task.state = None
         # resetting uid for task
@@ -604,6 +1453,114 @@ def load_task(task_pkl, ind=None):
     return task
 
 
+@attrs.define
+class StatePayload:
+    """The payload of a task split over states, which is run by loading the states
+    with `load_task`.
+
+    Rather than the whole task, which would have to be unpickled with all the
+    elements of its split inputs by each state, the payload file only holds a template
+    of the task without the values of the split inputs (or its state). The elements of
+    each state, along with their memoized hashes, are written to a separate record in
+    the ``.states`` file next to it, which is preceded by a table of the offsets of the
+    records so that only the record of the state being loaded needs to be read.
+
+    Parameters
+    ----------
+    task : TaskBase
+        the template of the task
+    nstates : int
+        the number of states
+    """
+
+    task: ty.Any
+    nstates: int
+
+    OFFSET = struct.Struct("<Q")
+
+    @staticmethod
+    def records_path(path: Path) -> Path:
+        return path.with_suffix(".states")
+
+    @classmethod
+    def dump(cls, task, path: Path) -> Path:
+        """
+        Write the payload of a task, whose states have been prepared, to a file.
+
+        Parameters
+        ----------
+        task : TaskBase
+            the task split over states
+        path : :obj:`Path`
+            the path of the payload file
+
+        Returns
+        -------
+        path : :obj:`Path`
+            the path of the payload file
+        """
+        path = Path(path)
+        inputs_ind = task.state.inputs_ind
+        split = [
+            inp
+            for inp in sorted(set(task.input_names))
+            if inputs_ind and f"{task.name}.{inp}" in inputs_ind[0]
+        ]
+        offset = cls.OFFSET.size * (len(inputs_ind) + 1)
+        with open(cls.records_path(path), "wb") as f:
+            f.seek(offset)
+            offsets = [offset]
+            for ind, input_ind in enumerate(inputs_ind):
+                inputs = task.get_input_el(ind)
+                memo_keys = [(inp, input_ind[f"{task.name}.{inp}"]) for inp in inputs]
+                memo = {
+                    k: task.input_hash_memo.entries[k]
+                    for k in memo_keys
+                    if k in task.input_hash_memo.entries
+                }
+                f.write(
+                    cp.dumps({"inputs": inputs, "inputs_ind": input_ind, "memo": memo})
+                )
+                offsets.append(f.tell())
+            f.seek(0)
+            f.write(b"".join(cls.OFFSET.pack(o) for o in offsets))
+        # a shallow copy of the task, which doesn't reference the elements of the split
+        # inputs (the template is pickled with `TaskBase.__getstate__`)
+        template = object.__new__(type(task))
+        template.__dict__.update(task.__dict__)
+        for name, value in inspect.getmembers(type(task)):
+            if isinstance(value, cached_property):
+                # e.g. `lzout`, which references the task
+                template.__dict__.pop(name, None)
+        template.inputs = copy(task.inputs)
+        for inp in split:
+            object.__setattr__(template.inputs, inp, attr.NOTHING)
+        template.state = None
+        # neither the hashes of the elements of the split inputs nor those of the whole
+        # inputs (e.g. memoized when the checksum of the task was calculated) are kept,
+        # as the memo entries reference the values they were calculated from
+        memo = task.input_hash_memo
+        template.input_hash_memo = InputHashMemo(
+            entries={
+                k: e
+                for k, e in memo.entries.items()
+                if (k[0] if isinstance(k, tuple) else k) not in split
+            },
+            scheme=memo.scheme,
+        )
+        dump_pickle(cls(task=template, nstates=len(inputs_ind)), path)
+        return path
+
+    @classmethod
+    def read_record(cls, path: Path, ind: int) -> ty.Dict[str, ty.Any]:
+        """Read the record of a state from the ``.states`` file of a payload"""
+        with open(cls.records_path(Path(path)), "rb") as f:
+            f.seek(ind * cls.OFFSET.size)
+            start, end = struct.unpack("<QQ", f.read(2 * cls.OFFSET.size))
+            f.seek(start)
+            return cp.loads(f.read(end - start))
+
+
 def position_sort(args):
     """
     Sort objects by position, following Python indexing conventions.
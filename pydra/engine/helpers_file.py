@@ -2,12 +2,16 @@
 
 import os
 import re
+import hashlib
 import logging
+import shutil
+import stat
 from pathlib import Path
 import typing as ty
 from copy import copy
 import subprocess as sp
 from contextlib import contextmanager
+from uuid import uuid4
 import attr
 from fileformats.core import FileSet
 
@@ -470,3 +474,240 @@ class MountIndentifier:
             cls._mount_table = orig_table
 
     _mount_table: ty.Optional[ty.List[ty.Tuple[str, str]]] = None
+
+
+class BlobStore:
+    """Content-addressed store of the output files of the tasks in a cache location,
+    in which each distinct file is stored once (in the `_blobs` directory of the
+    location) and linked to from the directories of the tasks that produced it.
+
+    The store is enabled with the PYDRA_BLOB_STORE environment variable, which sets
+    how the files are linked to the stored blobs:
+
+    * "hardlink" (or "1"/"true") - the files are hard-linked to the blobs, which are
+      made read-only to protect them from being modified through one of the links.
+      Since the links share the permissions of the blob, **the output files of the
+      tasks become read-only too**, so tasks that modify their input files in place
+      need to copy them first (or use the "reflink" mode). Files that can't be
+      hard-linked (e.g. if the link limit has been reached) are reflinked instead.
+      Files that are already hard-linked from elsewhere (e.g. input files copied into
+      the task directory as links) are replaced by copies before they are added, so
+      the original files aren't made read-only.
+    * "reflink" - the files are copy-on-write clones of the blobs (on filesystems that
+      support them, e.g. XFS and Btrfs), so they can still be modified
+
+    Files that can't be linked are left as they are. The blobs that were reflinked
+    when they were added are stored with a ".reflink" suffix, as the files cloned from
+    them can't be tracked, so they are never pruned (see `prune`).
+    """
+
+    ENV_VAR = "PYDRA_BLOB_STORE"
+    DIR_NAME = "_blobs"
+    LINK_MODES = ("hardlink", "reflink")
+
+    def __init__(self, location: os.PathLike, link_mode: str = "hardlink"):
+        if link_mode not in self.LINK_MODES:
+            raise ValueError(
+                f"Unrecognised link mode '{link_mode}', can be one of "
+                f"{self.LINK_MODES}"
+            )
+        self.root = Path(location) / self.DIR_NAME
+        self.link_mode = link_mode
+
+    @classmethod
+    def default(cls, location: os.PathLike) -> ty.Optional["BlobStore"]:
+        """The store of the location if it has been enabled by the environment"""
+        mode = os.environ.get(cls.ENV_VAR, "").lower()
+        if mode in ("", "0", "false", "no"):
+            return None
+        return cls(location, "hardlink" if mode in ("1", "true", "yes") else mode)
+
+    def blob_path(self, digest: str, reflinked: bool = False) -> Path:
+        return self.root / digest[:2] / (digest + (".reflink" if reflinked else ""))
+
+    def ingest(self, path: os.PathLike) -> bool:
+        """
+        Add a file to the store, replacing it with a link to the blob with the same
+        contents if there already is one.
+
+        Parameters
+        ----------
+        path : os.PathLike
+            the file to ingest
+
+        Returns
+        -------
+        linked : bool
+            whether the file has been linked to a blob
+        """
+        path = Path(path)
+        digest = _file_digest(path)
+        # the blob can be pruned concurrently between being found and being linked to,
+        # in which case it is looked up again
+        for _ in range(3):
+            for blob in (self.blob_path(digest), self.blob_path(digest, True)):
+                if blob.exists():
+                    break
+            else:
+                return self._add(path, digest)
+            tmp = path.with_name(f".{path.name}.{uuid4().hex}")
+            try:
+                if os.path.samefile(path, blob):
+                    return True
+                if not self._link(blob, tmp):
+                    return False
+            except FileNotFoundError:
+                continue
+            os.replace(tmp, path)
+            return True
+        return False
+
+    def _add(self, path: Path, digest: str) -> bool:
+        """Add a file as a new blob, which is added atomically in case another process
+        is adding the same contents"""
+        blob = self.blob_path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        if self.link_mode == "hardlink" and path.stat().st_nlink > 1:
+            # the file is hard-linked from elsewhere (e.g. an input file that has been
+            # copied into the task directory as a link), which would otherwise become
+            # the blob and be made read-only, so a copy of it is added instead
+            copy = path.with_name(f".{path.name}.{uuid4().hex}")
+            shutil.copy2(path, copy)
+            os.replace(copy, path)
+        tmp = blob.with_name(f".{blob.name}.{uuid4().hex}")
+        if not self._link(path, tmp):
+            return False
+        if os.path.samefile(path, tmp):
+            _make_read_only(tmp)
+        else:
+            blob = self.blob_path(digest, reflinked=True)
+        os.replace(tmp, blob)
+        return True
+
+    def ingest_nested(self, value: ty.Any, task_dir: os.PathLike) -> int:
+        """
+        Ingest the files of the file-sets nested within a value (e.g. the output of a
+        task) that are within a task directory.
+
+        Parameters
+        ----------
+        value : Any
+            the value to ingest the files of
+        task_dir : os.PathLike
+            the directory of the task that produced the value, files outside of it
+            (e.g. inputs passed through) are left as they are
+
+        Returns
+        -------
+        n_linked : int
+            the number of files linked to blobs
+        """
+        from ..utils.typing import TypeParser  # noqa
+
+        task_dir = Path(task_dir).absolute()
+        paths = set()
+
+        def collect(fileset: FileSet):
+            for fspath in fileset.fspaths:
+                fspath = Path(fspath).absolute()
+                if task_dir not in fspath.parents:
+                    continue
+                if fspath.is_dir():
+                    paths.update(p for p in fspath.rglob("*") if p.is_file())
+                elif fspath.is_file():
+                    paths.add(fspath)
+            return fileset
+
+        TypeParser.apply_to_instances(FileSet, collect, value)
+        return sum(self.ingest(p) for p in sorted(paths) if not p.is_symlink())
+
+    def prune(self, dry_run: bool = False) -> ty.List[ty.Tuple[Path, int]]:
+        """
+        Remove the hard-linked blobs that aren't linked to from any task directory.
+        The reflinked blobs are kept, as whether they are still referenced can't be
+        tracked.
+
+        A blob is moved aside before it is removed, and restored if a file has been
+        linked to it in the meantime (i.e. by a concurrent `ingest`).
+
+        Parameters
+        ----------
+        dry_run : bool
+            if True, the blobs are only reported
+
+        Returns
+        -------
+        pruned : list[tuple[Path, int]]
+            the paths and sizes of the pruned blobs
+        """
+        pruned = []
+        if not self.root.exists():
+            return pruned
+        for prefix_dir in self.root.iterdir():
+            for blob in prefix_dir.iterdir():
+                if blob.name.startswith(".") or blob.suffix == ".reflink":
+                    continue
+                try:
+                    blob_stat = blob.stat()
+                except FileNotFoundError:
+                    continue
+                if blob_stat.st_nlink > 1:
+                    continue
+                if not dry_run:
+                    pruning = blob.with_name(f".{blob.name}.{uuid4().hex}.pruned")
+                    try:
+                        os.rename(blob, pruning)
+                    except FileNotFoundError:
+                        continue
+                    if pruning.stat().st_nlink > 1:
+                        os.replace(pruning, blob)
+                        continue
+                    pruning.unlink()
+                pruned.append((blob, blob_stat.st_size))
+        return pruned
+
+    def _link(self, src: Path, dst: Path) -> bool:
+        if self.link_mode == "hardlink":
+            try:
+                os.link(src, dst)
+                return True
+            except OSError as e:
+                logger.debug("Couldn't hard-link %s to %s: %s", src, dst, e)
+        return _reflink(src, dst)
+
+
+# ioctl request cloning a file on Linux, see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        return False
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError as e:
+            logger.debug("Couldn't reflink %s to %s: %s", src, dst, e)
+            cloned = False
+        else:
+            cloned = True
+    if not cloned:
+        dst.unlink()
+    else:
+        shutil.copystat(src, dst)
+    return cloned
+
+
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _make_read_only(path: Path):
+    mode = path.stat().st_mode
+    path.chmod(mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
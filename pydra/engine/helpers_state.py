@@ -612,11 +612,19 @@ def map_splits(split_iter, inputs, cont_dim=None):
     """generate a dictionary of inputs prescribed by the splitter."""
     if cont_dim is None:
         cont_dim = {}
+    # each input is only flattened once, rather than for every split
+    flattened = {}
     for split in split_iter:
-        yield {
-            k: list(flatten(ensure_list(inputs[k]), max_depth=cont_dim.get(k, None)))[v]
-            for k, v in split.items()
-        }
+        split_vals = {}
+        for k, v in split.items():
+            try:
+                vals = flattened[k]
+            except KeyError:
+                vals = flattened[k] = list(
+                    flatten(ensure_list(inputs[k]), max_depth=cont_dim.get(k, None))
+                )
+            split_vals[k] = vals[v]
+        yield split_vals
 
 
 def inputs_types_to_dict(name, inputs):
@@ -0,0 +1,448 @@
+"""Remote cache of task results, shared between hosts through a simple HTTP content
+store in which the files of a task directory are stored under its checksum, e.g.
+``PUT <url>/<checksum>/_result.pklz``.
+
+The store only needs to support HEAD, GET and PUT requests for arbitrary paths, so
+any WebDAV or object store that accepts them can be used. A reference server that
+stores the files in a local directory is included (see `main`)::
+
+    $ pydra-cache-server /path/to/store --port 8080
+    $ export PYDRA_REMOTE_CACHE=http://localhost:8080
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import typing as ty
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
+from uuid import uuid4
+from .helpers import _env_flag, _has_result, cache_tiers, copy_result, load_result
+
+logger = logging.getLogger("pydra.remote")
+
+MANIFEST_NAME = "_manifest.json"
+
+
+class RemoteError(Exception):
+    """Raised when a request to the remote cache fails"""
+
+
+class ConnectionPool:
+    """A pool of persistent connections to an HTTP server, which are reused between
+    requests and threads.
+
+    Parameters
+    ----------
+    url : str
+        URL of the server, only its scheme, host and port are used
+    size : int
+        maximum number of connections open at once, further requests wait for one
+        of them to be released
+    timeout : float
+        timeout of the connections in seconds
+    """
+
+    def __init__(self, url: str, size: int = 8, timeout: float = 60.0):
+        parsed = urlsplit(url)
+        if parsed.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported scheme of remote cache URL '{url}'")
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.size = size
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    @contextmanager
+    def connection(self, fresh: bool = False):
+        """Borrow a connection from the pool, which is closed rather than returned if
+        the request fails
+
+        Parameters
+        ----------
+        fresh : bool
+            open a new connection instead of reusing an idle one, e.g. when retrying
+            a request that failed because the server had closed the idle connection
+        """
+        with self._slots:
+            conn = None
+            if not fresh:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    pass
+            if conn is None:
+                conn = self._connect()
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class RemoteCache:
+    """Remote cache of task results stored in an HTTP content store.
+
+    A task directory is uploaded (see `upload`) by putting each of its files, except
+    the pickled task, under ``<url>/<checksum>/`` followed by a manifest listing them,
+    so that the results are only visible to other hosts once all their files are
+    present. Results are fetched (see `fetch`) by getting the manifest and then the
+    listed files into a cache location, and relocating the file-sets of their outputs
+    into it (see `copy_result`).
+
+    The files are transferred concurrently over a pool of persistent connections.
+
+    Parameters
+    ----------
+    url : str
+        base URL of the content store
+    upload : bool
+        whether new results are uploaded, otherwise the store is only read from
+    max_connections : int
+        maximum number of concurrent transfers
+    timeout : float
+        timeout of the requests in seconds
+    """
+
+    ENV_VAR = "PYDRA_REMOTE_CACHE"
+    UPLOAD_ENV_VAR = "PYDRA_REMOTE_CACHE_UPLOAD"
+
+    _default: ty.Optional["RemoteCache"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(
+        self,
+        url: str,
+        upload: bool = True,
+        max_connections: int = 8,
+        timeout: float = 60.0,
+    ):
+        self.url = url.rstrip("/")
+        self.upload_results = upload
+        self.max_connections = max_connections
+        self.prefix = urlsplit(self.url).path
+        self.pool = ConnectionPool(self.url, size=max_connections, timeout=timeout)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="pydra-remote-cache"
+        )
+
+    @classmethod
+    def default(cls) -> ty.Optional["RemoteCache"]:
+        """The remote cache at the URL of the PYDRA_REMOTE_CACHE environment variable,
+        which uploads results unless PYDRA_REMOTE_CACHE_UPLOAD is set to 0, or None if
+        it isn't set"""
+        url = os.environ.get(cls.ENV_VAR)
+        if not url:
+            return None
+        upload = os.environ.get(cls.UPLOAD_ENV_VAR)
+        upload = True if upload is None else _env_flag(cls.UPLOAD_ENV_VAR)
+        with cls._default_lock:
+            default = cls._default
+            if (
+                default is None
+                or default.url != url.rstrip("/")
+                or default.upload_results != upload
+            ):
+                if default is not None:
+                    default.close()
+                default = cls._default = cls(url, upload=upload)
+        return default
+
+    def exists(self, checksum: str) -> bool:
+        """Whether the result of a task is stored in the remote cache"""
+        status, _ = self._request("HEAD", f"{checksum}/{MANIFEST_NAME}")
+        return status == 200
+
+    def fetch(self, checksum: str, location: os.PathLike) -> ty.Optional[Path]:
+        """
+        Download the result of a task into a cache location.
+
+        Parameters
+        ----------
+        checksum : str
+            the checksum of the task
+        location : os.PathLike
+            the cache location
+
+        Returns
+        -------
+        task_dir : Path or None
+            the downloaded task directory, or None if the result isn't stored in the
+            remote cache or is already present in, or being computed in, the location
+        """
+        location = Path(location)
+        status, data = self._request("GET", f"{checksum}/{MANIFEST_NAME}")
+        cache_tiers.record(self.url, int(status == 200), 1)
+        if status == 404:
+            return None
+        if status != 200:
+            raise RemoteError(f"GET {checksum}/{MANIFEST_NAME} returned {status}")
+        manifest = json.loads(data)
+        tmp_dir = location / f".{checksum}.{uuid4().hex}"
+        task_dir = tmp_dir / checksum
+        try:
+            task_dir.mkdir(parents=True)
+            self._map(
+                lambda name: self._download(f"{checksum}/{name}", task_dir / name),
+                manifest["files"],
+            )
+            # the file-sets of the outputs are relative to the directory the task was
+            # run in on the host that uploaded it
+            return copy_result(
+                task_dir, location, origin=manifest["task_dir"], move=True
+            )
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def upload(self, task_dir: os.PathLike) -> bool:
+        """
+        Upload the result of a task to the remote cache.
+
+        Parameters
+        ----------
+        task_dir : os.PathLike
+            the directory of the task, named by its checksum
+
+        Returns
+        -------
+        uploaded : bool
+            whether the result was uploaded, i.e. it wasn't already stored
+        """
+        task_dir = Path(task_dir)
+        checksum = task_dir.name
+        if self.exists(checksum):
+            return False
+        files = [
+            p.relative_to(task_dir).as_posix()
+            for p in sorted(task_dir.rglob("*"))
+            if (p.is_file() or p.is_symlink() and p.exists())
+            and not p.name.startswith("_task.")
+        ]
+        self._map(
+            lambda name: self._upload(task_dir / name, f"{checksum}/{name}"), files
+        )
+        # the manifest is put last, once all the files it lists are present
+        manifest = json.dumps({"files": files, "task_dir": str(task_dir)}).encode()
+        status, _ = self._request("PUT", f"{checksum}/{MANIFEST_NAME}", body=manifest)
+        if status not in (200, 201, 204):
+            raise RemoteError(f"PUT {checksum}/{MANIFEST_NAME} returned {status}")
+        return True
+
+    def close(self):
+        self._executor.shutdown()
+        self.pool.close()
+
+    def _map(self, func: ty.Callable[[str], None], names: ty.Iterable[str]):
+        # the results are consumed so the exceptions are raised
+        list(self._executor.map(func, names))
+
+    def _download(self, path: str, dest: Path):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with open(dest, "wb") as f:
+            status, _ = self._request("GET", path, dest=f)
+        if status != 200:
+            raise RemoteError(f"GET {path} returned {status}")
+
+    def _upload(self, src: Path, path: str):
+        with open(src, "rb") as f:
+            status, _ = self._request(
+                "PUT", path, body=f, headers={"Content-Length": str(src.stat().st_size)}
+            )
+        if status not in (200, 201, 204):
+            raise RemoteError(f"PUT {path} returned {status}")
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        body: ty.Union[bytes, ty.BinaryIO, None] = None,
+        headers: ty.Optional[ty.Dict[str, str]] = None,
+        dest: ty.Optional[ty.BinaryIO] = None,
+    ) -> ty.Tuple[int, bytes]:
+        """Send a request, streaming the body of successful responses into `dest` if
+        it is provided, and retrying it once over a new connection if it fails (e.g.
+        because the server closed the idle connection)"""
+        url = f"{self.prefix}/{quote(path)}"
+        for attempt in range(2):
+            try:
+                with self.pool.connection(fresh=attempt > 0) as conn:
+                    if hasattr(body, "seek"):
+                        body.seek(0)
+                    conn.request(method, url, body=body, headers=headers or {})
+                    response = conn.getresponse()
+                    if dest is not None and response.status == 200:
+                        dest.seek(0)
+                        dest.truncate()
+                        shutil.copyfileobj(response, dest, 2**20)
+                        return response.status, b""
+                    return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                if attempt:
+                    raise RemoteError(f"{method} {self.url}/{path} failed: {e}") from e
+                logger.debug("Retrying %s %s after %s", method, path, e)
+
+
+def fetch_result(
+    checksum: str, cache_locations: ty.Sequence[os.PathLike], cache_dir: os.PathLike
+):
+    """Download the result of a task into its cache directory from the remote cache if
+    one is configured (see `RemoteCache.default`) and the result isn't present in any
+    of the cache locations"""
+    remote = RemoteCache.default()
+    if remote is None or load_result(checksum, cache_locations) is not None:
+        return
+    try:
+        if remote.fetch(checksum, cache_dir) is not None:
+            logger.debug("Fetched the result of %s from %s", checksum, remote.url)
+    except Exception as e:
+        logger.warning("Couldn't fetch %s from %s: %s", checksum, remote.url, e)
+
+
+def upload_result(task_dir: Path):
+    """Upload the result saved in a task directory to the remote cache if one is
+    configured (see `RemoteCache.default`) and uploading isn't disabled"""
+    remote = RemoteCache.default()
+    if remote is None or not remote.upload_results or not _has_result(task_dir):
+        return
+    try:
+        if remote.upload(task_dir):
+            logger.debug("Uploaded the result of %s to %s", task_dir.name, remote.url)
+    except Exception as e:
+        logger.warning("Couldn't upload %s to %s: %s", task_dir.name, remote.url, e)
+
+
+class ContentStoreHandler(http.server.BaseHTTPRequestHandler):
+    """Handler of the HEAD, GET and PUT requests of the reference content store,
+    which stores the files under the `root` directory of its server"""
+
+    protocol_version = "HTTP/1.1"
+    server: "ContentStoreServer"
+
+    def _path(self) -> ty.Optional[Path]:
+        parts = unquote(urlsplit(self.path).path).strip("/").split("/")
+        if not parts or any(p in ("", ".", "..") for p in parts):
+            return None
+        return self.server.root.joinpath(*parts)
+
+    def _reply(self, status: int, length: int = 0):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._path()
+        if path is None or not path.is_file():
+            self._reply(404)
+        else:
+            self._reply(200, path.stat().st_size)
+
+    def do_GET(self):
+        path = self._path()
+        if path is None or not path.is_file():
+            self._reply(404)
+            return
+        with open(path, "rb") as f:
+            self._reply(200, os.fstat(f.fileno()).st_size)
+            shutil.copyfileobj(f, self.wfile, 2**20)
+
+    def do_PUT(self):
+        path = self._path()
+        length = int(self.headers.get("Content-Length", -1))
+        if path is None or length < 0:
+            # the body is discarded by closing the connection
+            self.close_connection = True
+            self._reply(400)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # the file is written under a temporary name, so it is never read incomplete
+        tmp_path = path.with_name(f".{path.name}.{uuid4().hex}")
+        with open(tmp_path, "wb") as f:
+            while length:
+                chunk = self.rfile.read(min(length, 2**20))
+                if not chunk:
+                    break
+                f.write(chunk)
+                length -= len(chunk)
+        if length:
+            tmp_path.unlink()
+            self.close_connection = True
+            self._reply(400)
+            return
+        os.replace(tmp_path, path)
+        self._reply(201)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ContentStoreServer(http.server.ThreadingHTTPServer):
+    """Reference content store for the remote cache, which stores the files put to it
+    under a root directory.
+
+    Parameters
+    ----------
+    root : os.PathLike
+        the directory the files are stored in
+    address : tuple[str, int]
+        the host and port to listen on, the port is chosen by the system if it is 0
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root: os.PathLike, address: ty.Tuple[str, int] = ("", 0)):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        super().__init__(address, ContentStoreHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        if host in ("", "0.0.0.0"):
+            host = "localhost"
+        return f"http://{host}:{port}"
+
+
+def main(argv: ty.Optional[ty.Sequence[str]] = None) -> int:
+    """Entry point of the `pydra-cache-server` console script"""
+    parser = argparse.ArgumentParser(
+        prog="pydra-cache-server",
+        description="Serve a directory as a remote cache of pydra results",
+    )
+    parser.add_argument("root", type=Path, help="directory the results are stored in")
+    parser.add_argument("--host", default="", help="host to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    args = parser.parse_args(argv)
+    with ContentStoreServer(args.root, (args.host, args.port)) as server:
+        print(f"Serving {args.root} at {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
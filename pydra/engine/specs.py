@@ -5,6 +5,7 @@ import typing as ty
 import inspect
 import re
 import os
+import time
 from copy import copy
 from glob import glob
 import attr
@@ -15,7 +16,19 @@ from fileformats.generic import (
 )
 import pydra
 from .helpers_file import template_update_single
-from ..utils.hash import hash_function, Cache
+from ..utils.hash import (
+    hash_function,
+    hash_single,
+    Cache,
+    Hash,
+    FileHashPolicy,
+    hash_threads_default,
+    precompute_fileset_hashes,
+    active_hash_profile,
+    value_fingerprint,
+    value_snapshot,
+    hash_scheme_default,
+)
 
 # from ..utils.misc import add_exc_note
 
@@ -69,6 +82,104 @@ class SpecInfo:
        Should be a tuple containing at least one BaseSpec """
 
 
+@attr.s(auto_attribs=True)
+class InputHashMemo:
+    """Memo of the hashes of the fields of an input spec, so that only the fields that
+    have been modified since the previous calculation need to be rehashed.
+
+    An entry is only reused while the field still holds the same object (i.e. it
+    hasn't been set again, either directly or via ``attr.evolve``), the file-hash
+    policy is the same and the fingerprint of the value (see
+    `pydra.utils.hash.value_fingerprint`) is unchanged, i.e. the containers nested
+    within the value haven't been modified in place and the cheap identity keys
+    (path, mtime, size and inode) of the files nested within it are unchanged. Values
+    that can't be fingerprinted without reading their memory (e.g. writeable numpy
+    arrays), whose in-place modifications couldn't be detected as cheaply as they are
+    hashed, aren't memoized.
+
+    Since the entries are validated against the field values, the memo can be shared
+    between copies of a spec.
+    """
+
+    entries: ty.Dict[ty.Hashable, tuple] = attr.ib(factory=dict)
+    item_hashes: ty.Dict[ty.Tuple[str, str], Hash] = attr.ib(factory=dict)
+    """Hashes of the (name, hash) items the hash of the inputs is calculated from"""
+    hits: int = 0
+    """Number of field hashes reused from the memo"""
+    misses: int = 0
+    """Number of field hashes that had to be calculated"""
+    scheme: ty.Optional[int] = None
+    """Version of the hash scheme the hashes were calculated with"""
+
+    def get(self, key: ty.Hashable, value: ty.Any, policy) -> ty.Optional[str]:
+        """Return the memoized hash of the field (or element of a field to be split
+        over) if it is still valid, otherwise None"""
+        try:
+            memo_value, memo_policy, memo_fingerprint, hsh = self.entries[key]
+        except KeyError:
+            return None
+        if (
+            memo_value is value
+            and memo_policy == policy
+            and memo_fingerprint == value_fingerprint(value)
+        ):
+            self.hits += 1
+            return hsh
+        return None
+
+    def set(self, key: ty.Hashable, value: ty.Any, policy, hsh: str):
+        """Memoize the hash of a field (or element of a field to be split over)"""
+        self.misses += 1
+        fingerprint = value_fingerprint(value)
+        if fingerprint is not None:
+            self.entries[key] = (value, policy, fingerprint, hsh)
+        else:
+            self.entries.pop(key, None)
+
+    def rebind(
+        self,
+        key: ty.Hashable,
+        value: ty.Any,
+        new_value: ty.Any,
+        new_key: ty.Optional[ty.Hashable] = None,
+    ) -> bool:
+        """Carry the memoized hash of a value over to an equivalent value that replaces
+        it (e.g. after it has been converted when unpickling the spec or an element of
+        a split field has been set on the field), optionally under a different key.
+        Returns whether a hash was memoized for the value."""
+        try:
+            memo_value, memo_policy, memo_fingerprint, hsh = self.entries[key]
+        except KeyError:
+            return False
+        if memo_value is not value or memo_fingerprint != value_fingerprint(value):
+            return False
+        fingerprint = value_fingerprint(new_value)
+        if fingerprint is None:
+            return False
+        self.entries[key if new_key is None else new_key] = (
+            new_value,
+            memo_policy,
+            fingerprint,
+            hsh,
+        )
+        return True
+
+    def filesets(self) -> "InputHashMemo":
+        """A copy of the memo restricted to the values that are file-sets, which can
+        only be modified via their files and therefore their identity keys"""
+        return InputHashMemo(
+            entries={
+                k: e for k, e in self.entries.items() if isinstance(e[0], FileSet)
+            },
+            scheme=self.scheme,
+        )
+
+    def clear(self):
+        self.entries.clear()
+        self.item_hashes.clear()
+        self.hits = self.misses = 0
+
+
 @attr.s(auto_attribs=True, kw_only=True)
 class BaseSpec:
     """The base dataclass specs for all inputs and outputs."""
@@ -79,36 +190,219 @@ class BaseSpec:
 
     @property
     def hash(self):
-        hsh, self._hashes = self._compute_hashes()
+        return self.compute_hash()
+
+    @property
+    def hash_memo(self) -> InputHashMemo:
+        """The memo of field hashes used when no other memo is passed to `compute_hash`
+        (shallow copies of the spec share it)"""
+        try:
+            return self.__dict__["_hash_memo"]
+        except KeyError:
+            memo = self.__dict__["_hash_memo"] = InputHashMemo()
+            return memo
+
+    def compute_hash(
+        self, file_hash_policy=None, memo: ty.Optional[InputHashMemo] = None
+    ):
+        """Compute the hash of the inputs, hashing the file-sets within them with the
+        strategies selected by the given policy (see `pydra.utils.hash.FileHashPolicy`)
+        unless overridden by the "file_hash_policy" metadata of the field.
+
+        Only the fields that have changed since they were memoized are rehashed, using
+        the `hash_memo` of the spec unless a different memo is provided (e.g. one that
+        outlives the spec instance).
+        """
+        if memo is None:
+            memo = self.hash_memo
+        hsh, self._hashes = self._compute_hashes(
+            file_hash_policy=file_hash_policy, memo=memo
+        )
         return hsh
 
-    def hash_changes(self):
+    def hash_changes(
+        self,
+        file_hash_policy=None,
+        memo: ty.Optional[InputHashMemo] = None,
+        snapshot: ty.Optional[ty.Dict[str, ty.Optional[tuple]]] = None,
+    ):
         """Detects any changes in the hashed values between the current inputs and the
-        previously calculated values"""
-        _, new_hashes = self._compute_hashes()
+        previously calculated values.
+
+        The fields are rehashed to pick up in-place modifications of their values,
+        apart from file-sets memoized in the memo (if provided), which are only rehashed
+        if the identity keys of their files have changed. If a snapshot of the inputs
+        taken when the hashes were calculated is provided (see `snapshot`), only the
+        fields whose snapshots differ, or couldn't be taken, are rehashed.
+        """
+        names = None
+        if snapshot is not None:
+            names = [
+                name
+                for name, field_snapshot in self.snapshot().items()
+                if field_snapshot is None or field_snapshot != snapshot.get(name)
+            ]
+            if not names:
+                return []
+        _, new_hashes = self._compute_hashes(
+            file_hash_policy=file_hash_policy,
+            memo=memo.filesets() if memo is not None else None,
+            names=names,
+        )
         return [k for k, v in new_hashes.items() if v != self._hashes[k]]
 
-    def _compute_hashes(self) -> ty.Tuple[bytes, ty.Dict[str, bytes]]:
-        """Compute a basic hash for any given set of fields."""
-        inp_dict = {}
-        for field in attr_fields(
-            self, exclude_names=("_graph_checksums", "bindings", "files_hash")
-        ):
-            if field.metadata.get("output_file_template"):
+    def snapshot(self) -> ty.Dict[str, ty.Optional[tuple]]:
+        """Cheap snapshots of the values of the hashed fields (see
+        `pydra.utils.hash.value_snapshot`), which can be compared before and after the
+        inputs are used to detect the fields that may have been modified"""
+        snapshot = {}
+        for field in self._hashed_fields():
+            value = getattr(self, field.name)
+            snapshot[field.name] = (
+                () if value is attr.NOTHING else value_snapshot(value)
+            )
+        return snapshot
+
+    def compute_state_hash(
+        self,
+        elements: ty.Dict[str, ty.Tuple[int, ty.Any]],
+        file_hash_policy=None,
+        memo: ty.Optional[InputHashMemo] = None,
+    ):
+        """Compute the hash the inputs would have if the given elements of the values
+        to be split over were set on their fields, without copying the spec.
+
+        The hashes of the elements are memoized by their field name and index, so
+        with a shared memo each element (and each field that isn't split over) is
+        only hashed once across all the states of a task.
+
+        Parameters
+        ----------
+        elements : dict[str, tuple[int, Any]]
+            the index and value of the element to substitute for each split field
+        file_hash_policy : str or FileHashPolicy, optional
+            the policy used to hash the files within the inputs
+        memo : InputHashMemo, optional
+            the memo to reuse the hashes from, by default the `hash_memo` of the spec
+        """
+        if memo is None:
+            memo = self.hash_memo
+        hsh, _ = self._compute_hashes(
+            file_hash_policy=file_hash_policy, memo=memo, elements=elements
+        )
+        return hsh
+
+    def _compute_hashes(
+        self,
+        file_hash_policy=None,
+        memo: ty.Optional[InputHashMemo] = None,
+        elements: ty.Optional[ty.Dict[str, ty.Tuple[int, ty.Any]]] = None,
+        names: ty.Optional[ty.Collection[str]] = None,
+    ) -> ty.Tuple[bytes, ty.Dict[str, bytes]]:
+        """Compute a basic hash for any given set of fields, reusing the hashes of the
+        unchanged fields from the memo if provided."""
+        field_hashes = {}
+        to_hash = {}
+        profile = active_hash_profile()
+        scheme = hash_scheme_default()
+        if memo is not None and memo.scheme != scheme:
+            memo.clear()
+            memo.scheme = scheme
+        for field in self._hashed_fields():
+            if names is not None and field.name not in names:
                 continue
+            if elements and field.name in elements:
+                index, value = elements[field.name]
+                memo_key = (field.name, index)
+            else:
+                value = getattr(self, field.name)
+                memo_key = field.name
             # removing values that are not set from hash calculation
-            if getattr(self, field.name) is attr.NOTHING:
-                continue
-            if "container_path" in field.metadata:
+            if value is attr.NOTHING:
                 continue
-            inp_dict[field.name] = getattr(self, field.name)
-        hash_cache = Cache()
-        field_hashes = {
-            k: hash_function(v, cache=hash_cache) for k, v in inp_dict.items()
-        }
+            policy = FileHashPolicy.from_value(
+                field.metadata.get("file_hash_policy", file_hash_policy)
+            )
+            if memo is not None:
+                hsh = memo.get(memo_key, value, policy)
+                if hsh is not None:
+                    field_hashes[field.name] = hsh
+                    if profile is not None:
+                        profile.record_field(field.name, hit=True)
+                    continue
+            hashed_value = value
+            if memo_key != field.name and field.on_setattr is not None:
+                # elements are converted as they would be if set on the field
+                hashed_value = field.on_setattr(self, field, value)
+            to_hash[field.name] = (memo_key, value, hashed_value, policy)
+        if to_hash:
+            # fields hashed with different policies need separate caches, as the hashes
+            # of the same objects can differ between them
+            hash_caches = {}
+            for _, _, _, policy in to_hash.values():
+                if policy not in hash_caches:
+                    hash_caches[policy] = Cache(file_hash_policy=policy, scheme=scheme)
+            hash_threads = hash_threads_default()
+            if hash_threads:
+                # hash the contents of all (uncached) files in the inputs concurrently
+                start = time.perf_counter()
+                for policy, hash_cache in hash_caches.items():
+                    precompute_fileset_hashes(
+                        (v for _, _, v, p in to_hash.values() if p == policy),
+                        hash_cache,
+                        n_threads=hash_threads,
+                    )
+                if profile is not None:
+                    # the files hashed in the worker threads aren't attributed to
+                    # their fields, which pick their hashes up from the persistent cache
+                    profile.record_field(
+                        profile.CONCURRENT_FILES_FIELD, time.perf_counter() - start
+                    )
+        for name, (memo_key, value, hashed_value, policy) in to_hash.items():
+            if profile is not None:
+                start, nbytes = time.perf_counter(), profile.nbytes
+            field_hashes[name] = hash_function(hashed_value, cache=hash_caches[policy])
+            if profile is not None:
+                profile.record_field(
+                    name, time.perf_counter() - start, profile.nbytes - nbytes
+                )
+            if memo is not None:
+                memo.set(memo_key, value, policy, field_hashes[name])
         if hasattr(self, "_graph_checksums"):
             field_hashes["_graph_checksums"] = self._graph_checksums
-        return hash_function(sorted(field_hashes.items())), field_hashes
+        return self._combine_hashes(field_hashes, memo=memo), field_hashes
+
+    def _hashed_fields(self) -> ty.List[attr.Attribute]:
+        """The fields whose values are included in the hash of the inputs"""
+        return [
+            field
+            for field in attr_fields(
+                self, exclude_names=("_graph_checksums", "bindings", "files_hash")
+            )
+            if not field.metadata.get("output_file_template")
+            and "container_path" not in field.metadata
+        ]
+
+    @staticmethod
+    def _combine_hashes(
+        field_hashes: ty.Dict[str, ty.Any], memo: ty.Optional[InputHashMemo] = None
+    ) -> str:
+        """Hash the sorted (name, hash) items of the fields, reusing the hashes of the
+        items from the memo if provided"""
+        items = sorted(field_hashes.items())
+        if memo is None:
+            return hash_function(items)
+        # the items are hashed with the same cache as the list, so it picks up their
+        # memoized hashes
+        cache = Cache()
+        for item in items:
+            if not isinstance(item[1], str):
+                continue
+            try:
+                cache[id(item)] = memo.item_hashes[item]
+            except KeyError:
+                cache[id(item)] = memo.item_hashes[item] = hash_single(item, cache)
+        return hash_function(items, cache=cache)
 
     def retrieve_values(self, wf, state_index: ty.Optional[int] = None):
         """Get values contained by this spec."""
@@ -204,6 +498,85 @@ class Runtime:
     """Peak in cpu consumption."""
 
 
+@attr.s(auto_attribs=True, frozen=True)
+class StoredOutput:
+    """Reference to the value of an output field that is stored in a separate file in
+    the outputs directory of the result (see `LazyOutputs`)."""
+
+    filename: str
+
+
+class LazyOutputs:
+    """Base of the output classes of results whose fields are stored in separate files,
+    which are only loaded when they are first accessed (see `StoredOutput`)."""
+
+    @classmethod
+    def create(
+        cls,
+        name: str,
+        fields: ty.Sequence[ty.Tuple[str, type]],
+        values: ty.Dict[str, ty.Any],
+        outputs_dir: os.PathLike,
+    ) -> "LazyOutputs":
+        """Create the outputs of a result
+
+        Parameters
+        ----------
+        name : str
+            name of the output class
+        fields : sequence of (str, type)
+            names and types of the output fields
+        values : dict
+            values of the output fields, or `StoredOutput` references to them
+        outputs_dir : os.PathLike
+            the directory the referenced values are stored in
+        """
+        klass = attr.make_class(
+            name, {k: attr.ib(type=v) for k, v in fields}, bases=(cls,)
+        )
+        outputs = object.__new__(klass)
+        for field_name, value in values.items():
+            if not isinstance(value, StoredOutput):
+                outputs.__dict__[field_name] = value
+        outputs.__dict__["_stored_outputs"] = {
+            k: v for k, v in values.items() if isinstance(v, StoredOutput)
+        }
+        outputs.__dict__["_outputs_dir"] = Path(outputs_dir)
+        return outputs
+
+    @property
+    def outputs_dir(self) -> Path:
+        """The directory the stored values are loaded from"""
+        return self.__dict__["_outputs_dir"]
+
+    def relocate(self, outputs_dir: os.PathLike):
+        """Load the values that haven't been loaded yet from another directory (e.g.
+        if the cache directory has been moved)"""
+        self.__dict__["_outputs_dir"] = Path(outputs_dir)
+
+    def values(self) -> ty.Dict[str, ty.Any]:
+        """The values of the fields, with `StoredOutput` references to the values
+        that haven't been loaded yet"""
+        stored = self.__dict__["_stored_outputs"]
+        return {
+            f.name: self.__dict__[f.name] if f.name in self.__dict__ else stored[f.name]
+            for f in attr.fields(type(self))
+        }
+
+    def __getattr__(self, name):
+        # only called if the attribute hasn't been set, i.e. it hasn't been loaded
+        try:
+            stored = self.__dict__["_stored_outputs"][name]
+        except KeyError:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            ) from None
+        from .helpers import load_pickle
+
+        value = self.__dict__[name] = load_pickle(self.outputs_dir / stored.filename)
+        return value
+
+
 @attr.s(auto_attribs=True, kw_only=True)
 class Result:
     """Metadata regarding the outputs of processing."""
@@ -217,17 +590,27 @@ class Result:
         if state["output"] is not None:
             fields = tuple((el.name, el.type) for el in attr_fields(state["output"]))
             state["output_spec"] = (state["output"].__class__.__name__, fields)
-            state["output"] = attr.asdict(state["output"], recurse=False)
+            if isinstance(state["output"], LazyOutputs):
+                # the values that haven't been loaded are kept in their files
+                state["outputs_dir"] = str(state["output"].outputs_dir)
+                state["output"] = state["output"].values()
+            else:
+                state["output"] = attr.asdict(state["output"], recurse=False)
         return state
 
     def __setstate__(self, state):
         if "output_spec" in state:
             spec = list(state["output_spec"])
             del state["output_spec"]
-            klass = attr.make_class(
-                spec[0], {k: attr.ib(type=v) for k, v in list(spec[1])}
-            )
-            state["output"] = klass(**state["output"])
+            if "outputs_dir" in state:
+                state["output"] = LazyOutputs.create(
+                    spec[0], spec[1], state["output"], state.pop("outputs_dir")
+                )
+            else:
+                klass = attr.make_class(
+                    spec[0], {k: attr.ib(type=v) for k, v in list(spec[1])}
+                )
+                state["output"] = klass(**state["output"])
         self.__dict__.update(state)
 
     def get_output_field(self, field_name):
@@ -283,6 +666,7 @@ class FunctionSpec(BaseSpec):
         supported_keys = {
             "allowed_values",
             "copyfile",
+            "file_hash_policy",
             "help_string",
             "mandatory",
             # "readonly", #likely not needed
@@ -363,6 +747,7 @@ class ShellSpec(BaseSpec):
             "argstr",
             "container_path",
             "copyfile",
+            "file_hash_policy",
             "help_string",
             "mandatory",
             "readonly",
@@ -1,13 +1,15 @@
 """Handle execution backends."""
 
 import asyncio
+import inspect
 import typing as ty
-import pickle
+from collections import deque
 from uuid import uuid4
-from .workers import Worker, WORKERS
+from .workers import Worker, DistributedWorker, WORKERS
 from .core import is_workflow
-from .helpers import get_open_loop, load_and_run_async
-from ..utils.hash import PersistentCache
+from .specs import Result
+from .helpers import get_open_loop, load_and_run_async, load_task, cache_tiers
+from ..utils.hash import PersistentCache, FileHashPolicy
 
 import logging
 
@@ -18,7 +20,14 @@ logger = logging.getLogger("pydra.submitter")
 class Submitter:
     """Send a task to the execution backend."""
 
-    def __init__(self, plugin: ty.Union[str, ty.Type[Worker]] = "cf", **kwargs):
+    def __init__(
+        self,
+        plugin: ty.Union[str, ty.Type[Worker]] = "cf",
+        file_hash_policy: ty.Union[str, FileHashPolicy, None] = None,
+        chunk_size: ty.Optional[int] = None,
+        chunk_runtime: ty.Optional[float] = None,
+        **kwargs,
+    ):
         """
         Initialize task submission.
 
@@ -27,10 +36,23 @@ class Submitter:
         plugin : :obj:`str` or :obj:`ty.Type[pydra.engine.core.Worker]`
             Either the identifier of the execution backend or the worker class itself.
             Default is ``cf`` (Concurrent Futures).
+        file_hash_policy : :obj:`str` or :class:`~pydra.utils.hash.FileHashPolicy`
+            The policy used to select the strategies files in the inputs are hashed
+            with, for submitted tasks that don't specify their own policy.
+        chunk_size : :obj:`int`
+            The number of states of tasks run by each call of the worker, for tasks
+            that don't specify their own chunking (see `expand_runnable`).
+        chunk_runtime : :obj:`float`
+            The target runtime in seconds of each call of the worker running states of
+            tasks, the number of states of each chunk being adapted to the runtimes of
+            the states that have completed.
         **kwargs
             Additional keyword arguments to pass to the worker.
 
         """
+        self.file_hash_policy = FileHashPolicy.from_value(file_hash_policy)
+        self.chunk_size = chunk_size
+        self.chunk_runtime = chunk_runtime
         self.loop = get_open_loop()
         self._own_loop = not self.loop.is_running()
         if isinstance(plugin, str):
@@ -52,11 +74,15 @@ class Submitter:
         """Submitter run function."""
         if cache_locations is not None:
             runnable.cache_locations = cache_locations
+        if runnable.file_hash_policy is None:
+            runnable.file_hash_policy = self.file_hash_policy
         self.loop.run_until_complete(
             self.submit_from_call(runnable, rerun, environment)
         )
-        PersistentCache().clean_up()
-        return runnable.result()
+        PersistentCache.default().clean_up()
+        result = runnable.result()
+        logger.debug("Hit rates of the cache locations:\n%s", cache_tiers.report())
+        return result
 
     async def submit_from_call(self, runnable, rerun, environment):
         """
@@ -107,6 +133,10 @@ class Submitter:
         True, waits for all coroutines to complete / error
         and returns None.
 
+        If the task (or else the submitter) sets a `chunk_size` or `chunk_runtime`,
+        contiguous blocks of states are run by each call of the worker (see
+        `Worker.run_states`), each state still being run in its own task directory.
+
         Parameters
         ----------
         runnable : pydra Task
@@ -129,20 +159,45 @@ class Submitter:
 
         task_pkl = await prepare_runnable_with_state(runnable)
 
-        for sidx in range(len(runnable.state.states_val)):
-            if is_workflow(runnable):
-                # job has no state anymore
-                futures.add(
-                    # This unpickles and runs workflow - why are we pickling?
-                    asyncio.create_task(load_and_run_async(task_pkl, sidx, self, rerun))
+        if runnable.chunk_size or runnable.chunk_runtime:
+            chunk_size, chunk_runtime = runnable.chunk_size, runnable.chunk_runtime
+        else:
+            chunk_size, chunk_runtime = self.chunk_size, self.chunk_runtime
+        if (chunk_size or chunk_runtime) and not is_workflow(runnable):
+            futures.update(
+                self.worker.run_states(
+                    task_pkl,
+                    runnable,
+                    range(len(runnable.state.states_val)),
+                    rerun=rerun,
+                    chunk_size=chunk_size,
+                    chunk_runtime=chunk_runtime,
                 )
-            else:
-                futures.add(self.worker.run_el((sidx, task_pkl, runnable), rerun=rerun))
+            )
+        else:
+            for sidx in range(len(runnable.state.states_val)):
+                if is_workflow(runnable):
+                    # job has no state anymore
+                    futures.add(
+                        # This unpickles and runs workflow - why are we pickling?
+                        asyncio.create_task(
+                            load_and_run_async(task_pkl, sidx, self, rerun)
+                        )
+                    )
+                else:
+                    futures.add(
+                        self.worker.run_el((sidx, task_pkl, runnable), rerun=rerun)
+                    )
 
         if wait and futures:
             # if wait is True, we are at the end of the graph / state expansion.
-            # Once the remaining jobs end, we will exit `submit_from_call`
-            await asyncio.gather(*futures)
+            # Once the remaining jobs end, we will exit `submit_from_call`. The
+            # states are all awaited before an error is raised, so none of them
+            # outlive the submitter
+            outcomes = await asyncio.gather(*futures, return_exceptions=True)
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    raise outcome
             return
         # pass along futures to be awaited independently
         return futures
@@ -152,6 +207,17 @@ class Submitter:
         Expand and execute a stateless :class:`~pydra.engine.core.Workflow`.
         This method is only reached by `Workflow._run_task`.
 
+        The nodes are scheduled as their predecessors complete: the number of
+        predecessors each node is waiting on is decremented when all the futures of a
+        predecessor have completed, and the node is submitted once it reaches zero. The
+        nodes that follow a node that raised an error aren't run.
+
+        If the worker supports it (e.g. the slurm worker with `submit_dag`), the nodes
+        that can be run without the scheduler are submitted upfront (see
+        `_upfront_nodes`). They are processed as the other nodes once their predecessors
+        have been, their inputs connected to other nodes being retrieved once they have
+        completed as they are retrieved in their jobs.
+
         Parameters
         ----------
         wf : :obj:`~pydra.engine.core.Workflow`
@@ -163,102 +229,208 @@ class Submitter:
             The computed workflow
 
         """
-        # creating a copy of the graph that will be modified
-        # the copy contains new lists with original runnable objects
-        graph_copy = wf.graph.copy()
-        # resetting uid for nodes in the copied workflows
-        for nd in graph_copy.nodes:
+        graph = wf.graph
+        nodes = graph.sorted_nodes
+        # resetting uid for the nodes
+        for nd in nodes:
             nd._uid = uuid4().hex
-        # keep track of pending futures
+        # the number of predecessors of each node that haven't completed yet
+        waiting = {nd.name: len(graph.predecessors[nd.name]) for nd in nodes}
+        # the number of futures of each submitted node that haven't completed yet and
+        # the outcomes (results or exceptions) of those that have
+        outstanding: ty.Dict[str, int] = {}
+        outcomes: ty.Dict[str, list] = {}
+        # the nodes that follow nodes that raised an error, which aren't run
+        tasks_follow_errored: ty.Dict[str, ty.List[str]] = {}
+        completed = deque()
         task_futures = set()
-        tasks, tasks_follow_errored = get_runnable_tasks(graph_copy)
-        while tasks or task_futures or graph_copy.nodes:
-            if not tasks and not task_futures:
-                # it's possible that task_futures is empty, but not able to get any
-                # tasks from graph_copy (using get_runnable_tasks)
-                # this might be related to some delays saving the files
-                # so try to get_runnable_tasks for another minut
-                ii = 0
-                while not tasks and graph_copy.nodes:
-                    tasks, follow_err = get_runnable_tasks(graph_copy)
-                    ii += 1
-                    # don't block the event loop!
-                    await asyncio.sleep(1)
-                    if ii > 60:
-                        msg = (
-                            f"Graph of '{wf}' workflow is not empty, but not able to get "
-                            "more tasks - something has gone wrong when retrieving the "
-                            "results predecessors:\n\n"
-                        )
-                        # Get blocked tasks and the predecessors they are waiting on
-                        outstanding = {
-                            t: [
-                                p for p in graph_copy.predecessors[t.name] if not p.done
-                            ]
-                            for t in graph_copy.sorted_nodes
-                        }
-
-                        hashes_have_changed = False
-                        for task, waiting_on in outstanding.items():
-                            if not waiting_on:
+        # the futures of the nodes awaited by the trackers of the task futures
+        tracked = []
+
+        def track(task, future):
+            tracked.append(future)
+            return self._track(task, future, completed)
+
+        upfront = {}
+        if getattr(self.worker, "submit_dag", False):
+            upfront_nodes = _upfront_nodes(graph)
+            if upfront_nodes:
+                upfront = await self.worker.submit_nodes(wf, upfront_nodes, rerun=rerun)
+            for task in upfront_nodes:
+                outstanding[task.name] = 1
+                outcomes[task.name] = []
+                task_futures.add(track(task, upfront[task.name]))
+        ready = deque(
+            nd for nd in nodes if not waiting[nd.name] and nd.name not in upfront
+        )
+        try:
+            while ready or task_futures or completed:
+                while ready:
+                    task = ready.popleft()
+                    # grab inputs if needed
+                    logger.debug(f"Retrieving inputs for {task}")
+                    # TODO: add state idx to retrieve values to reduce waiting
+                    task.inputs.retrieve_values(wf)
+                    if task.state:
+                        futures = await self.expand_runnable(task, rerun=rerun)
+                        if not futures:
+                            # e.g. split over an empty list
+                            completed.append((task, None))
+                    # expand that workflow
+                    elif is_workflow(task):
+                        futures = []
+                        completed.append((task, await task._run(self, rerun=rerun)))
+                    # single task
+                    else:
+                        futures = [self.worker.run_el(task, rerun=rerun)]
+                    outstanding[task.name] = max(len(futures), 1)
+                    outcomes[task.name] = []
+                    for future in futures:
+                        task_futures.add(track(task, future))
+                if not completed:
+                    task_futures = await self.worker.fetch_finished(task_futures)
+                finished = deque()
+                while completed:
+                    task, outcome = completed.popleft()
+                    if task.name in tasks_follow_errored:
+                        # e.g. the job of a node submitted upfront that was cancelled
+                        continue
+                    outcomes[task.name].append(outcome)
+                    outstanding[task.name] -= 1
+                    # the nodes submitted upfront are processed after their predecessors
+                    if not outstanding[task.name] and not waiting[task.name]:
+                        finished.append(task)
+                while finished:
+                    task = finished.popleft()
+                    if task.name in upfront:
+                        task.inputs.retrieve_values(wf)
+                    if not await self._errored(wf, task, outcomes.pop(task.name)):
+                        for succ in graph.successors[task.name]:
+                            waiting[succ.name] -= 1
+                            if waiting[succ.name] or succ.name in tasks_follow_errored:
                                 continue
-                            msg += f"- '{task.name}' node blocked due to\n"
-                            for pred in waiting_on:
-                                if (
-                                    pred.checksum
-                                    != wf.inputs._graph_checksums[pred.name]
-                                ):
-                                    msg += (
-                                        f"    - hash changes in '{pred.name}' node inputs. "
-                                        f"Current values and hashes: {pred.inputs}, "
-                                        f"{pred.inputs._hashes}\n"
-                                    )
-                                    hashes_have_changed = True
-                                elif pred not in outstanding:
-                                    msg += (
-                                        f"    - undiagnosed issues in '{pred.name}' node, "
-                                        "potentially related to file-system access issues "
-                                    )
-                            msg += "\n"
-                        if hashes_have_changed:
-                            msg += (
-                                "Set loglevel to 'debug' in order to track hash changes "
-                                "throughout the execution of the workflow.\n\n "
-                                "These issues may have been caused by `bytes_repr()` methods "
-                                "that don't return stable hash values for specific object "
-                                "types across multiple processes (see bytes_repr() "
-                                '"singledispatch "function in pydra/utils/hash.py).'
-                                "You may need to implement a specific `bytes_repr()` "
-                                '"singledispatch overload"s or `__bytes_repr__()` '
-                                "dunder methods to handle one or more types in "
-                                "your interface inputs."
-                            )
-                        raise RuntimeError(msg)
-            for task in tasks:
-                # grab inputs if needed
-                logger.debug(f"Retrieving inputs for {task}")
-                # TODO: add state idx to retrieve values to reduce waiting
-                task.inputs.retrieve_values(wf)
-                if task.state:
-                    for fut in await self.expand_runnable(task, rerun=rerun):
-                        task_futures.add(fut)
-                # expand that workflow
-                elif is_workflow(task):
-                    await task._run(self, rerun=rerun)
-                # single task
-                else:
-                    task_futures.add(self.worker.run_el(task, rerun=rerun))
-            task_futures = await self.worker.fetch_finished(task_futures)
-            tasks, follow_err = get_runnable_tasks(graph_copy)
-            # updating tasks_errored
-            for key, val in follow_err.items():
-                tasks_follow_errored.setdefault(key, [])
-                tasks_follow_errored[key] += val
+                            if succ.name not in upfront:
+                                ready.append(succ)
+                            elif not outstanding[succ.name]:
+                                finished.append(succ)
+                        continue
+                    # the nodes that follow the errored node, which can't have been run
+                    followers = deque(graph.successors[task.name])
+                    while followers:
+                        follower = followers.popleft()
+                        errored_preds = tasks_follow_errored.setdefault(
+                            follower.name, []
+                        )
+                        if task.name not in errored_preds:
+                            errored_preds.append(task.name)
+                            followers.extend(graph.successors[follower.name])
+        finally:
+            # e.g. if an error has been raised, the futures that are still pending
+            # are cancelled so they don't outlive the submitter
+            await self._cancel(list(task_futures) + tracked)
 
         for key, val in tasks_follow_errored.items():
             setattr(getattr(wf, key), "_errored", val)
         return wf
 
+    @staticmethod
+    async def _cancel(futures):
+        """Cancel the futures that are still pending and wait for them to finish,
+        closing the coroutines that haven't been started"""
+        pending = []
+        for future in futures:
+            if asyncio.iscoroutine(future):
+                if inspect.getcoroutinestate(future) == inspect.CORO_CREATED:
+                    future.close()
+            elif not future.done():
+                future.cancel()
+                pending.append(future)
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    @staticmethod
+    async def _track(task, future, completed: deque):
+        """Await a future of a node, adding the node and the outcome of the future (its
+        return value or the exception it raised) to the completed futures"""
+        try:
+            outcome = await future
+        except Exception as e:
+            logger.debug(f"{task} raised {type(e).__name__}: {e}")
+            outcome = e
+        completed.append((task, outcome))
+
+    async def _errored(self, wf, task, outcomes: list) -> bool:
+        """
+        Whether a node whose futures have all completed raised an error. The results
+        returned by the futures are used if all of them returned one (e.g. tasks run by
+        the serial or concurrent futures workers). Otherwise the results are loaded
+        from the cache:
+
+        * if a future raised an error, the node only errored if an errored result was
+          saved, otherwise the error (e.g. the result couldn't be sent back from the
+          worker) is raised
+        * if the futures returned something else (e.g. the distributed workers, whose
+          tasks write their results to a shared filesystem), the results are waited
+          for in case they aren't visible yet
+        """
+        if outcomes and all(isinstance(o, Result) for o in outcomes):
+            errored = any(o.errored for o in outcomes)
+            if errored and not task.state:
+                task._errored = True
+            return errored
+        exceptions = [o for o in outcomes if isinstance(o, Exception)]
+        if exceptions and not isinstance(self.worker, DistributedWorker):
+            try:
+                if task.done:
+                    # e.g. the result couldn't be pickled to be sent back
+                    return False
+            except ValueError:
+                return True
+            raise self._not_empty_error(wf, task) from exceptions[0]
+        delay = 0.1
+        while True:
+            try:
+                if task.done:
+                    return False
+            except ValueError:
+                return True
+            if delay > 30:
+                break
+            await asyncio.sleep(delay)
+            delay *= 2
+        raise self._not_empty_error(wf, task)
+
+    @staticmethod
+    def _not_empty_error(wf, task) -> RuntimeError:
+        """The error raised when the result of a node that has completed can't be
+        found"""
+        msg = (
+            f"Graph of '{wf}' workflow is not empty, but not able to get more tasks - "
+            "something has gone wrong when retrieving the results of the "
+            f"'{task.name}' node, which has completed:\n\n"
+        )
+        if task.checksum != wf.inputs._graph_checksums[task.name]:
+            msg += (
+                f"    - hash changes in '{task.name}' node inputs. "
+                f"Current values and hashes: {task.inputs}, "
+                f"{task.inputs._hashes}\n\n"
+                "Set loglevel to 'debug' in order to track hash changes "
+                "throughout the execution of the workflow.\n\n "
+                "These issues may have been caused by `bytes_repr()` methods "
+                "that don't return stable hash values for specific object "
+                "types across multiple processes (see bytes_repr() "
+                '"singledispatch "function in pydra/utils/hash.py).'
+                "You may need to implement a specific `bytes_repr()` "
+                '"singledispatch overload"s or `__bytes_repr__()` '
+                "dunder methods to handle one or more types in "
+                "your interface inputs."
+            )
+        else:
+            msg += (
+                f"    - undiagnosed issues in '{task.name}' node, "
+                "potentially related to file-system access issues "
+            )
+        return RuntimeError(msg)
+
     def __enter__(self):
         return self
 
@@ -277,68 +449,6 @@ class Submitter:
             self.loop.close()
 
 
-def get_runnable_tasks(graph):
-    """Parse a graph and return all runnable tasks."""
-    tasks = []
-    to_remove = []
-    # tasks that follow task that raises an error
-    following_err = dict()
-    for tsk in graph.sorted_nodes:
-        if tsk not in graph.sorted_nodes:
-            continue
-        # since the list is sorted (breadth-first) we can stop
-        # when we find a task that depends on any task that is already in tasks
-        if set(graph.predecessors[tsk.name]).intersection(set(tasks)):
-            break
-        _is_runnable = is_runnable(graph, tsk)
-        if _is_runnable is True:
-            tasks.append(tsk)
-            to_remove.append(tsk)
-        elif _is_runnable is False:
-            continue
-        else:  # a previous task had an error
-            errored_task = _is_runnable
-            # removing all successors of the errored task
-            for task_err in errored_task:
-                task_to_remove = graph.remove_successors_nodes(task_err)
-                for tsk in task_to_remove:
-                    # adding tasks that were removed from the graph
-                    # due to the error in the errored_task
-                    following_err.setdefault(tsk, [])
-                    following_err[tsk].append(task_err.name)
-
-    # removing tasks that are ready to run from the graph
-    for nd in to_remove:
-        graph.remove_nodes(nd)
-    return tasks, following_err
-
-
-def is_runnable(graph, obj):
-    """Check if a task within a graph is runnable."""
-    connections_to_remove = []
-    pred_errored = []
-    is_done = None
-    for pred in graph.predecessors[obj.name]:
-        try:
-            is_done = pred.done
-        except ValueError:
-            pred_errored.append(pred)
-
-        if is_done is True:
-            connections_to_remove.append(pred)
-        elif is_done is False:
-            return False
-
-    if pred_errored:
-        return pred_errored
-
-    # removing nodes that are done from connections
-    for nd in connections_to_remove:
-        graph.remove_nodes_connections(nd)
-
-    return True
-
-
 async def prepare_runnable_with_state(runnable):
     runnable.state.prepare_states(runnable.inputs, cont_dim=runnable.cont_dim)
     runnable.state.prepare_inputs()
@@ -346,6 +456,23 @@ async def prepare_runnable_with_state(runnable):
     return runnable.pickle_task()
 
 
+def _upfront_nodes(graph):
+    """The nodes of a workflow that can be submitted upfront, i.e. those without states
+    (whose number can depend on the outputs of their predecessors) that aren't nested
+    workflows or run with their own plugin, and whose predecessors can be submitted
+    upfront too, in topological order"""
+    upfront = {}
+    for nd in graph.sorted_nodes:
+        if (
+            not nd.state
+            and not is_workflow(nd)
+            and not nd.plugin
+            and all(p.name in upfront for p in graph.predecessors[nd.name])
+        ):
+            upfront[nd.name] = nd
+    return list(upfront.values())
+
+
 def _list_blocked_tasks(graph):
     """Generates a list of tasks that can't be run and predecessors that are blocking
     them to help debugging of broken workflows"""
@@ -358,8 +485,7 @@ def _list_blocked_tasks(graph):
                 for cache_loc in tsk.cache_locations:
                     for tsk_work_dir in cache_loc.iterdir():
                         if (tsk_work_dir / "_task.pklz").exists():
-                            with open(tsk_work_dir / "_task.pklz", "rb") as f:
-                                saved_tsk = pickle.load(f)
+                            saved_tsk = load_task(tsk_work_dir / "_task.pklz")
                             if saved_tsk.name == pred.name:
                                 matching_name.append(
                                     f"{saved_tsk.name} ({tsk_work_dir.name})"
@@ -0,0 +1,89 @@
+import os
+import time
+from .utils import add2, multiply
+from ..cache_gc import (
+    cache_entries,
+    collect_garbage,
+    main,
+    parse_age,
+    parse_size,
+    referenced_checksums,
+)
+from ..core import Workflow
+from ..helpers import ResultIndex
+from ..submitter import Submitter
+
+
+def _age(path, seconds):
+    """set the access and modification times of the files under the path back"""
+    timestamp = time.time() - seconds
+    for root, _, files in os.walk(path):
+        for name in files + [root]:
+            os.utime(os.path.join(root, name), (timestamp, timestamp))
+
+
+def _run_workflow(cache_dir):
+    wf = Workflow(name="wf", input_spec=["x"], x=3, cache_dir=cache_dir)
+    wf.add(add2(name="add2", x=wf.lzin.x))
+    wf.add(multiply(name="mult", x=wf.add2.lzout.out, y=2))
+    wf.set_output([("out", wf.mult.lzout.out)])
+    with Submitter(plugin="serial") as sub:
+        sub(wf)
+    return wf
+
+
+def test_collect_garbage(tmp_path):
+    wf = _run_workflow(tmp_path)
+    task = multiply(x=2, y=5, cache_dir=tmp_path)
+    task()
+    _age(task.output_dir, 3600)
+    entries = cache_entries(tmp_path)
+    assert entries[0].path == task.output_dir
+    # the workflow and its nodes
+    referenced = referenced_checksums(wf)
+    assert len(referenced) == 3 and wf.checksum in referenced
+    task_dirs = {e.path.name for e in entries if e.kind == "task"}
+    assert task_dirs == referenced | {task.checksum}
+
+    # the nodes of the workflow are kept, so only the task can be evicted
+    report = collect_garbage(tmp_path, max_size=0, keep=[wf], dry_run=True)
+    assert [e.path for e in report.evicted] == [task.output_dir]
+    assert report.reclaimed == entries[0].size
+    assert "would evict" in report.summary()
+    assert task.output_dir.exists()
+
+    # locked task directories aren't evicted
+    lockfile = tmp_path / f"{task.checksum}.lock"
+    lockfile.touch()
+    assert not collect_garbage(tmp_path, max_size=0, keep=[wf]).evicted
+    lockfile.unlink()
+
+    # only the entries accessed more than an hour ago are evicted
+    report = collect_garbage(tmp_path, max_age=1800)
+    assert [e.path for e in report.evicted] == [task.output_dir]
+    assert not task.output_dir.exists()
+    assert wf.output_dir.exists()
+    # the manifest of the result index is compacted
+    manifest = (tmp_path / ResultIndex.MANIFEST_NAME).read_text().splitlines()
+    assert task.checksum not in manifest
+    assert wf.checksum in manifest
+    assert task.result() is None
+
+
+def test_collect_garbage_main(tmp_path, capsys):
+    wf = _run_workflow(tmp_path)
+    main([str(tmp_path), "--max-size", "0", "--dry-run"])
+    assert "would evict" in capsys.readouterr().out
+    assert wf.output_dir.exists()
+    main([str(tmp_path), "--max-size", "0", "--keep", wf.checksum])
+    assert "reclaimed" in capsys.readouterr().out
+    assert [e.path for e in cache_entries(tmp_path)] == [wf.output_dir]
+
+
+def test_parse_size_age():
+    assert parse_size("512") == 512
+    assert parse_size("1.5K") == 1536
+    assert parse_size("10GiB") == 10 * 2**30
+    assert parse_age("90") == 90
+    assert parse_age("2h") == 7200
+    assert parse_age("30d") == 30 * 86400
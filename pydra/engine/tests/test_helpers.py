@@ -4,21 +4,35 @@ from pathlib import Path
 import random
 import platform
 import pytest
+import attrs
 import cloudpickle as cp
 from unittest.mock import Mock
 from fileformats.generic import Directory, File
 from fileformats.core import FileSet
-from .utils import multiply, raise_xeq1
+from .utils import multiply, multiply_list, raise_xeq1, fun_write_file
 from ..helpers import (
     get_available_cpus,
     save,
     load_and_run,
+    load_and_run_chunk,
     position_sort,
     parse_copyfile,
+    load_result,
+    load_results,
+    ResultIndex,
+    ResultCache,
+    dump_pickle,
+    store_outputs,
+    load_pickle,
+    cache_tiers,
+    copy_result,
+    load_task,
+    StatePayload,
 )
 from ...utils.hash import hash_function
-from .. import helpers_file
+from .. import helpers, helpers_file
 from ..core import Workflow
+from ..specs import Result, LazyOutputs
 
 
 def test_save(tmpdir):
@@ -45,6 +59,252 @@ def test_save(tmpdir):
     assert res.output.out == 2
 
 
+@attrs.define
+class Output:
+    out: int
+
+
+@attrs.define
+class Outputs:
+    small: int
+    large: list
+
+
+def test_result_index(tmp_path):
+    cache_dir = tmp_path / "cache"
+    # results saved before the location was indexed are found by scanning it
+    save(cache_dir / "checksum_a", result=Result(output=Output(1), runtime=None))
+    (cache_dir / ResultIndex.MANIFEST_NAME).unlink()
+    (cache_dir / "checksum_b").mkdir()  # task without a result
+    index = ResultIndex(cache_dir)
+    assert index.completed(["checksum_a", "checksum_b"]) == {"checksum_a"}
+
+    # results saved afterwards are read from the manifest
+    save(cache_dir / "checksum_b", result=Result(output=Output(2), runtime=None))
+    assert index.completed(["checksum_a", "checksum_b"]) == {
+        "checksum_a",
+        "checksum_b",
+    }
+    manifest = (cache_dir / ResultIndex.MANIFEST_NAME).read_text().splitlines()
+    assert manifest == ["checksum_a", ResultIndex.SCANNED_MARKER, "checksum_b"]
+
+    # a rewritten manifest is reloaded
+    (cache_dir / ResultIndex.MANIFEST_NAME).unlink()
+    assert index.completed(["checksum_a", "checksum_b"]) == {
+        "checksum_a",
+        "checksum_b",
+    }
+
+
+def test_result_index_read_only(tmp_path, monkeypatch):
+    """results in locations that aren't writable are found without writing the index"""
+    shared = tmp_path / "shared"
+    task = multiply(x=1, y=2, cache_dir=shared)
+    task()
+    (shared / ResultIndex.MANIFEST_NAME).unlink()
+    os.chmod(shared, 0o555)
+    if os.access(shared, os.W_OK):
+        # e.g. running as root, for which the permissions aren't enforced
+
+        def read_only(*args, **kwargs):
+            raise OSError(30, "Read-only file system")
+
+        monkeypatch.setattr(helpers, "SoftFileLock", read_only)
+    try:
+        task = multiply(
+            x=1, y=2, cache_dir=tmp_path / "cache", cache_locations=[shared]
+        )
+        assert task.result().output.out == 2
+        assert task.done
+        assert not (shared / ResultIndex.MANIFEST_NAME).exists()
+    finally:
+        os.chmod(shared, 0o755)
+
+
+def test_load_results(tmp_path):
+    cache_dir, other_dir = tmp_path / "cache", tmp_path / "other"
+    save(cache_dir / "checksum_a", result=Result(output=Output(1), runtime=None))
+    save(other_dir / "checksum_b", result=Result(output=Output(2), runtime=None))
+    save(other_dir / "checksum_a", result=Result(output=Output(3), runtime=None))
+    locations = [cache_dir, other_dir]
+
+    results = load_results(["checksum_a", "checksum_b", "checksum_c"], locations)
+    assert [r.output.out if r else None for r in results] == [1, 2, None]
+    assert load_results(["checksum_b", "checksum_c"], locations, True) is None
+    assert load_result("checksum_b", locations).output.out == 2
+
+    # results removed since they were indexed aren't returned
+    (cache_dir / "checksum_a" / "_result.pklz").unlink()
+    assert load_result("checksum_a", locations) is None
+    assert load_results(["checksum_a", "checksum_b"], locations, True) is None
+
+
+def test_result_cache(tmp_path):
+    save(tmp_path / "checksum_a", result=Result(output=Output(1), runtime=None))
+    save(tmp_path / "checksum_b", result=Result(output=Output(2), runtime=None))
+    result_a = tmp_path / "checksum_a" / "_result.pklz"
+    result_b = tmp_path / "checksum_b" / "_result.pklz"
+    cache = ResultCache(max_size=result_a.stat().st_size + result_b.stat().st_size)
+    loaded = cache.load(result_a)
+    assert loaded.output.out == 1
+    assert cache.load(result_a) is loaded
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.load(tmp_path / "checksum_c" / "_result.pklz") is None
+
+    # rewritten results are reloaded
+    save(tmp_path / "checksum_a", result=Result(output=Output(3), runtime=None))
+    assert cache.load(result_a).output.out == 3
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.invalidate(tmp_path / "checksum_a")
+    assert len(cache) == 0
+
+    # least recently used results are evicted once the budget is exceeded
+    cache.load(result_a)
+    cache.load(result_b)
+    assert len(cache) == 2
+    cache.max_size -= 1
+    save(tmp_path / "checksum_c", result=Result(output=Output(4), runtime=None))
+    cache.load(tmp_path / "checksum_c" / "_result.pklz")
+    assert len(cache) == 1
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "lzma"])
+def test_dump_pickle(tmp_path, compression):
+    np = pytest.importorskip("numpy")
+    array = np.arange(2**18, dtype=np.float64)
+    result = Result(output=Output((array, np.arange(3))), runtime=None)
+    path = tmp_path / "_result.pklz"
+    dump_pickle(result, path, compression=compression)
+    # the large array is written to a sidecar, which is memory-mapped when loaded
+    assert path.stat().st_size < array.nbytes
+    assert [p.name for p in tmp_path.glob("*.npy")] == ["_result.buf0.npy"]
+    loaded = load_pickle(path)
+    base = loaded.output.out[0].base
+    while not isinstance(base, np.memmap):
+        base = base.base
+    np.testing.assert_array_equal(loaded.output.out[0], array)
+    np.testing.assert_array_equal(loaded.output.out[1], np.arange(3))
+    # copy-on-write, so the sidecar is unchanged
+    loaded.output.out[0][0] = -1
+    np.testing.assert_array_equal(load_pickle(path).output.out[0], array)
+    # stale sidecars are removed when the file is rewritten
+    dump_pickle(Result(output=Output(1), runtime=None), path, compression=compression)
+    assert not list(tmp_path.glob("*.npy"))
+    assert load_pickle(path).output.out == 1
+
+
+def test_dump_pickle_fallback(tmp_path):
+    path = tmp_path / "_task.pklz"
+    # local functions can't be pickled by the standard library
+    dump_pickle(lambda x: x + 1, path)
+    assert b'"serializer": "cloudpickle"' in path.read_bytes()
+    assert load_pickle(path)(1) == 2
+    dump_pickle([1, 2], path)
+    assert b'"serializer": "pickle"' in path.read_bytes()
+    # uncompressed files can still be loaded directly
+    assert cp.loads(path.read_bytes()) == [1, 2]
+    with pytest.raises(ValueError, match="Unrecognised compression"):
+        dump_pickle([1, 2], path, compression="bz2")
+    # files written by older versions
+    path.write_bytes(cp.dumps(lambda x: x + 2))
+    assert load_pickle(path)(1) == 3
+
+
+def test_store_outputs(tmp_path, monkeypatch):
+    large = list(range(100_000))
+    save(tmp_path / "checksum_a", result=Result(output=Outputs(1, large)))
+    # only the large field is stored separately
+    outputs_dir = tmp_path / "checksum_a" / "_outputs"
+    assert [p.name for p in outputs_dir.iterdir()] == ["large.pklz"]
+    result_file = tmp_path / "checksum_a" / "_result.pklz"
+    assert result_file.stat().st_size < (outputs_dir / "large.pklz").stat().st_size
+
+    result = ResultCache().load(result_file)
+    assert isinstance(result.output, LazyOutputs)
+    assert "large" not in vars(result.output)
+    assert result.output.small == 1
+    assert "large" not in vars(result.output)
+    assert result.output.large == large
+    assert attrs.asdict(result.output) == {"small": 1, "large": large}
+
+    # the fields are loaded from where the result has been moved to
+    shutil.move(tmp_path / "checksum_a", tmp_path / "checksum_b")
+    result = ResultCache().load(tmp_path / "checksum_b" / "_result.pklz")
+    assert result.output.large == large
+
+    # fields that haven't been loaded yet can be stored elsewhere
+    monkeypatch.setenv("PYDRA_RESULT_INLINE_SIZE", "0")
+    result = ResultCache().load(tmp_path / "checksum_b" / "_result.pklz")
+    stored = store_outputs(result, tmp_path / "checksum_c" / "_outputs")
+    assert sorted(stored.output.values()) == ["large", "small"]
+    assert stored.output.large == large
+    assert sorted(p.name for p in (tmp_path / "checksum_c" / "_outputs").iterdir()) == [
+        "large.pklz",
+        "small.pklz",
+    ]
+    save(tmp_path / "checksum_b", result=Result(output=None, errored=True))
+    assert not (tmp_path / "checksum_b" / "_outputs").exists()
+
+
+def test_copy_result(tmp_path):
+    (tmp_path / "shared").mkdir()
+    (tmp_path / "local").mkdir()
+    task = fun_write_file(filename="out.txt", cache_dir=tmp_path / "shared")
+    task()
+    copied = copy_result(task.output_dir, tmp_path / "local")
+    assert copied == tmp_path / "local" / task.checksum
+    # the files of the outputs are relocated to the copied directory
+    result = load_result(task.checksum, [tmp_path / "local"])
+    assert result.output.out.fspath == copied / "out.txt"
+    assert result.output.out.fspath.read_text() == "hello"
+    # results are only copied once
+    assert copy_result(task.output_dir, tmp_path / "local") is None
+
+
+def test_cache_tiers(tmp_path, monkeypatch):
+    local, shared = tmp_path / "local", tmp_path / "shared"
+    local.mkdir()
+    shared.mkdir()
+    fun_write_file(filename="out.txt", cache_dir=shared)()
+    monkeypatch.setattr(cache_tiers, "promote", True)
+    monkeypatch.setattr(cache_tiers, "write_back", True)
+    cache_tiers.clear()
+
+    # the result is found in the shared tier and promoted to the local one
+    task = fun_write_file(filename="out.txt", cache_dir=local, cache_locations=shared)
+    assert task.cache_locations == [local, shared]
+    assert task.result().output.out.fspath.parent.parent == shared
+    cache_tiers.wait()
+    assert task.result().output.out.fspath.parent.parent == local
+    assert cache_tiers.hit_rates() == {str(local): 0.5, str(shared): 1.0}
+    assert f"{shared}: 1/1 hits" in cache_tiers.report()
+
+    # new results are written back to the shared tier
+    task = fun_write_file(filename="new.txt", cache_dir=local, cache_locations=shared)
+    task()
+    cache_tiers.wait()
+    result = load_result(task.checksum, [shared])
+    assert result.output.out.fspath == shared / task.checksum / "new.txt"
+    cache_tiers.clear()
+
+
+def test_cache_locations_order(tmp_path, monkeypatch):
+    """the locations passed by the user are looked up before the cache directory,
+    unless results are copied between the tiers of the cache"""
+    local, shared = tmp_path / "local", tmp_path / "shared"
+    task = multiply(x=1, y=2, cache_dir=local, cache_locations=shared)
+    save(local / task.checksum, result=Result(output=Output(1), runtime=None))
+    save(shared / task.checksum, result=Result(output=Output(2), runtime=None))
+    monkeypatch.setattr(cache_tiers, "promote", False)
+    monkeypatch.setattr(cache_tiers, "write_back", False)
+    assert task.cache_locations == [shared, local]
+    assert task.result().output.out == 2
+    monkeypatch.setattr(cache_tiers, "promote", True)
+    assert task.cache_locations == [local, shared]
+    assert task.result().output.out == 1
+    cache_tiers.clear()
+
+
 def test_hash_file(tmpdir):
     outdir = Path(tmpdir)
     with open(outdir / "test.file", "w") as fp:
@@ -184,15 +444,65 @@ def test_load_and_run(tmpdir):
     with task_pkl.open("wb") as fp:
         cp.dump(task, fp)
 
-    resultfile_0 = load_and_run(task_pkl=task_pkl, ind=0)
-    resultfile_1 = load_and_run(task_pkl=task_pkl, ind=1)
-    # checking the result files
-    result_0 = cp.loads(resultfile_0.read_bytes())
-    result_1 = cp.loads(resultfile_1.read_bytes())
+    result_0 = load_and_run(task_pkl=task_pkl, ind=0)
+    result_1 = load_and_run(task_pkl=task_pkl, ind=1)
     assert result_0.output.out == 10
     assert result_1.output.out == 20
 
 
+def test_load_and_run_state_payload(tmp_path):
+    """testing load_and_run for a task pickled as a state payload"""
+    task = multiply(name="mult", y=10, cache_dir=tmp_path).split(x=[1, 2, 3])
+    task.state.prepare_states(inputs=task.inputs)
+    task.state.prepare_inputs()
+    task_pkl = task.pickle_task()
+    payload = load_pickle(task_pkl)
+    assert isinstance(payload, StatePayload) and payload.nstates == 3
+    # the template doesn't hold the values of the split input or the state
+    assert payload.task.inputs.x is attrs.NOTHING
+    assert payload.task.state is None
+    assert StatePayload.read_record(task_pkl, 2)["inputs"] == {"x": 3}
+    assert load_and_run(task_pkl=task_pkl, ind=2).output.out == 30
+    with pytest.raises(ValueError, match="index of the state"):
+        load_task(task_pkl)
+
+
+def test_load_and_run_chunk(tmp_path):
+    """the outcomes of the states of a chunk passed to the report callback aren't
+    returned as well, so that they are only sent back once"""
+    task = raise_xeq1(name="raise", cache_dir=tmp_path).split("x", x=[0, 1, 2, 3])
+    task.state.prepare_states(inputs=task.inputs)
+    task.state.prepare_inputs()
+    task_pkl = task.pickle_task()
+    outcomes = load_and_run_chunk(task_pkl, [0, 1, 2])
+    assert [ind for ind, _, _ in outcomes] == [0, 1, 2]
+    assert isinstance(outcomes[1][1], Exception)
+    assert outcomes[2][1].output.out == 2
+
+    reported = []
+    outcomes = load_and_run_chunk(
+        task_pkl, [1, 2, 3], report=lambda *outcome: reported.append(outcome)
+    )
+    assert [ind for ind, _, _ in reported] == [1, 2]
+    assert isinstance(reported[0][1], Exception)
+    assert reported[1][1].output.out == 2
+    assert [(ind, outcome.output.out) for ind, outcome, _ in outcomes] == [(3, 3)]
+
+
+def test_state_payload_template_size(tmp_path):
+    """the size of the template doesn't grow with the number of states, even when the
+    hash of the whole split input has been memoized"""
+    sizes = []
+    for nstates in (5, 50):
+        task = multiply_list(name="mult", y=2, cache_dir=tmp_path / str(nstates))
+        task.split(x=[list(range(i, i + 5000)) for i in range(nstates)])
+        task.checksum
+        task.state.prepare_states(inputs=task.inputs)
+        task.state.prepare_inputs()
+        sizes.append(task.pickle_task().stat().st_size)
+    assert sizes[1] < sizes[0] + 1000
+
+
 def test_load_and_run_exception_load(tmpdir):
     """testing raising exception and saving info in crashfile when when load_and_run"""
     task_pkl = Path(tmpdir.join("task_main.pkl"))
@@ -227,8 +537,7 @@ def test_load_and_run_exception_run(tmpdir):
     assert result_exception.errored is True
 
     # the second task should be fine
-    resultfile = load_and_run(task_pkl=task_pkl, ind=1)
-    result_1 = cp.loads(resultfile.read_bytes())
+    result_1 = load_and_run(task_pkl=task_pkl, ind=1)
     assert result_1.output.out == 2
 
 
@@ -250,11 +559,8 @@ def test_load_and_run_wf(tmpdir):
     with wf_pkl.open("wb") as fp:
         cp.dump(wf, fp)
 
-    resultfile_0 = load_and_run(ind=0, task_pkl=wf_pkl)
-    resultfile_1 = load_and_run(ind=1, task_pkl=wf_pkl)
-    # checking the result files
-    result_0 = cp.loads(resultfile_0.read_bytes())
-    result_1 = cp.loads(resultfile_1.read_bytes())
+    result_0 = load_and_run(ind=0, task_pkl=wf_pkl)
+    result_1 = load_and_run(ind=1, task_pkl=wf_pkl)
     assert result_0.output.out == 10
     assert result_1.output.out == 20
 
@@ -1,3 +1,7 @@
+import os
+import stat
+import shutil
+import hashlib
 import typing as ty
 import sys
 from pathlib import Path
@@ -12,7 +16,10 @@ from ..helpers_file import (
     MountIndentifier,
     copy_nested_files,
     template_update_single,
+    BlobStore,
 )
+from ..cache_gc import collect_garbage
+from ... import mark
 
 
 def _ignore_atime(stat):
@@ -417,3 +424,92 @@ def test_template_formatting(tmp_path):
         output_dir=tmp_path,
         spec_type="input",
     ) == [str(tmp_path / "file.bvec"), str(tmp_path / "file.bval")]
+
+
+@mark.task
+def write_file(filename: str, content: str) -> File:
+    Path(filename).write_text(content)
+    return File(Path(filename).absolute())
+
+
+def test_blob_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYDRA_BLOB_STORE", "hardlink")
+    res_a = write_file(filename="a.txt", content="mask", cache_dir=tmp_path)()
+    res_b = write_file(filename="b.txt", content="mask", cache_dir=tmp_path)()
+    res_c = write_file(filename="c.txt", content="atlas", cache_dir=tmp_path)()
+    file_a, file_b = res_a.output.out.fspath, res_b.output.out.fspath
+    # the identical files are linked to the same blob
+    assert file_a.parent != file_b.parent
+    assert file_a.samefile(file_b)
+    assert file_a.stat().st_nlink == 3
+    assert res_c.output.out.fspath.stat().st_nlink == 2
+    blobs = list((tmp_path / "_blobs").rglob("*"))
+    assert len([b for b in blobs if b.is_file()]) == 2
+    # the blobs are protected from being modified through the links
+    assert not file_a.stat().st_mode & 0o222
+    assert file_b.read_text() == "mask"
+
+    # the blobs are pruned once the task directories linking to them are evicted
+    report = collect_garbage(tmp_path, max_size=0, keep=[str(file_a.parent.name)])
+    assert len(report.evicted) == 2
+    assert len(report.pruned_blobs) == 1
+    assert file_a.read_text() == "mask"
+
+    with pytest.raises(ValueError, match="link mode"):
+        BlobStore(tmp_path, "symlink")
+
+
+def test_blob_store_ingest(tmp_path):
+    store = BlobStore(tmp_path / "cache")
+    file_a, file_b = tmp_path / "a.txt", tmp_path / "b.txt"
+    file_a.write_text("template")
+    file_b.write_text("template")
+    assert store.ingest(file_a)
+    assert store.ingest(file_b)
+    assert store.ingest(file_b)
+    assert file_a.samefile(file_b)
+    assert store.prune() == []
+    file_a.unlink()
+    file_b.unlink()
+    assert store.prune() == [
+        (store.blob_path(hashlib.sha256(b"template").hexdigest()), 8)
+    ]
+
+
+def test_blob_store_hardlinked_input(tmp_path):
+    """files hard-linked from outside the task directory (e.g. copyfile inputs) are
+    copied before they are added, so the source files aren't made read-only"""
+    store = BlobStore(tmp_path / "cache")
+    source = tmp_path / "source.txt"
+    source.write_text("template")
+    source.chmod(0o644)
+    task_dir = tmp_path / "cache" / "FunctionTask_abc"
+    task_dir.mkdir(parents=True)
+    linked = task_dir / "source.txt"
+    os.link(source, linked)
+    assert store.ingest_nested(File(linked), task_dir) == 1
+    assert stat.S_IMODE(source.stat().st_mode) == 0o644
+    assert source.stat().st_nlink == 1
+    assert not linked.samefile(source)
+    assert linked.samefile(store.blob_path(hashlib.sha256(b"template").hexdigest()))
+    source.write_text("modified")
+    assert linked.read_text() == "template"
+
+
+def test_blob_store_prune_reflinked(tmp_path, monkeypatch):
+    """blobs that were reflinked aren't pruned, as their references can't be
+    tracked"""
+    store = BlobStore(tmp_path / "cache")
+    monkeypatch.setattr(
+        BlobStore, "_link", lambda self, src, dst: shutil.copyfile(src, dst) and True
+    )
+    file_a = tmp_path / "a.txt"
+    file_a.write_text("template")
+    assert store.ingest(file_a)
+    blob = store.blob_path(hashlib.sha256(b"template").hexdigest(), reflinked=True)
+    assert blob.exists()
+    # the files aren't made read-only as they don't share the blob
+    assert file_a.stat().st_mode & 0o200
+    file_a.unlink()
+    assert store.prune() == []
+    assert blob.exists()
@@ -25,6 +25,7 @@ from .utils import (
 )
 
 from ..core import TaskBase
+from ..helpers import load_task
 from ..specs import StateArray
 from ..submitter import Submitter
 
@@ -1410,6 +1411,59 @@ def test_task_state_contdim_2(tmp_path):
     assert res[7].output.out == "a2 b4 c2 d2"
 
 
+def test_task_state_checksums_contdim():
+    """checking that the checksums of the states are the same as the checksums of the
+    inputs with the elements set, and that each element is only hashed once"""
+    task_4var = op_4var(name="op_4var")
+    task_4var.split(
+        ["a", ("b", ["c", "d"])],
+        cont_dim={"b": 2},
+        a=["a1", "a2"],
+        b=[["b1", "b2"], ["b3", "b4"]],
+        c=["c1", "c2"],
+        d=["d1", "d2"],
+    )
+    checksums = task_4var.checksum_states()
+    assert len(checksums) == 8
+    # 2 + 4 + 2 + 2 elements, plus the function
+    assert task_4var.input_hash_memo.misses == 11
+
+    for ind, checksum in enumerate(checksums):
+        inputs = attr.evolve(task_4var.inputs)
+        for key, el_ind in task_4var.state.inputs_ind[ind].items():
+            name = key.split(".")[1]
+            setattr(
+                inputs,
+                name,
+                task_4var._extract_input_el(task_4var.inputs, name, el_ind),
+            )
+        assert checksum == f"{type(task_4var).__name__}_{inputs.hash}"
+
+    assert task_4var.checksum_states() == checksums
+    assert task_4var.input_hash_memo.misses == 11
+
+
+def test_task_state_checksums_pickled(tmp_path):
+    """checking that the hashes of the elements calculated for the checksums of the
+    states are reused by the tasks loaded for the states"""
+    task_4var = op_4var(name="op_4var", cache_dir=tmp_path)
+    task_4var.split(
+        ["a", ("b", ["c", "d"])],
+        cont_dim={"b": 2},
+        a=["a1", "a2"],
+        b=[["b1", "b2"], ["b3", "b4"]],
+        c=["c1", "c2"],
+        d=["d1", "d2"],
+    )
+    checksums = task_4var.checksum_states()
+    task_pkl = task_4var.pickle_task()
+    for ind, checksum in enumerate(checksums):
+        task = load_task(task_pkl, ind=ind)
+        misses = task.input_hash_memo.misses
+        assert task.checksum == checksum
+        assert task.input_hash_memo.misses == misses
+
+
 def test_task_state_comb_contdim_1(tmp_path):
     """task with a splitter-combiner, and container dimension for one of the value"""
     task_4var = op_4var(
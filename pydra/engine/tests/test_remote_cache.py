@@ -0,0 +1,69 @@
+import threading
+import pytest
+from .utils import fun_write_file
+from ..helpers import cache_tiers, load_result
+from ..remote_cache import MANIFEST_NAME, ContentStoreServer, RemoteCache
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = ContentStoreServer(tmp_path / "store", ("localhost", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def remote(server, monkeypatch):
+    monkeypatch.setenv(RemoteCache.ENV_VAR, server.url)
+    remote = RemoteCache.default()
+    yield remote
+    remote.close()
+    RemoteCache._default = None
+
+
+def test_remote_cache(tmp_path, server, remote):
+    cache_tiers.clear()
+    # the result is uploaded after the task is run on one host
+    task = fun_write_file(filename="out.txt", cache_dir=tmp_path / "host1")
+    task()
+    stored = server.root / task.checksum
+    assert (stored / MANIFEST_NAME).exists()
+    assert (stored / "out.txt").read_text() == "hello"
+    assert not (stored / "_task.pklz").exists()
+    assert remote.exists(task.checksum)
+    assert not remote.upload(task.output_dir)
+
+    # and fetched instead of being rerun on another
+    task = fun_write_file(filename="out.txt", cache_dir=tmp_path / "host2")
+    result = task()
+    assert result.output.out.fspath == tmp_path / "host2" / task.checksum / "out.txt"
+    assert result.output.out.fspath.read_text() == "hello"
+    assert not (tmp_path / "host2" / task.checksum / "_task.pklz").exists()
+    # the result was looked up before the task was run on the first host
+    assert cache_tiers.hit_rates()[server.url] == 0.5
+    # the download directory is removed
+    assert not list((tmp_path / "host2").glob(f".{task.checksum}.*"))
+    cache_tiers.clear()
+
+
+def test_remote_cache_miss(tmp_path, remote):
+    task = fun_write_file(filename="out.txt", cache_dir=tmp_path)
+    assert remote.fetch(task.checksum, tmp_path) is None
+    assert not remote.exists(task.checksum)
+    # the connections are reused between requests
+    assert remote.pool._idle.qsize() == 1
+    cache_tiers.clear()
+
+
+def test_content_store_server(server, remote):
+    status, _ = remote._request("PUT", "a/b.txt", body=b"content")
+    assert status == 201
+    assert remote._request("HEAD", "a/b.txt")[0] == 200
+    assert remote._request("GET", "a/b.txt") == (200, b"content")
+    assert remote._request("GET", "a/c.txt")[0] == 404
+    # paths outside the root are rejected
+    assert remote._request("PUT", "../b.txt", body=b"")[0] == 400
+    assert not (server.root.parent / "b.txt").exists()
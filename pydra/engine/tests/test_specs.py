@@ -1,6 +1,7 @@
 from pathlib import Path
 import typing as ty
 import os
+import attr
 import attrs
 from copy import deepcopy
 import time
@@ -207,6 +208,56 @@ def test_input_file_hash_2a(tmp_path):
     assert hash4 == "aee7c7ae25509fb4c92a081d58d17a67"
 
 
+def test_input_file_hash_2b(tmp_path, monkeypatch):
+    """input spec with File types, checking the checksum is the same when the files are
+    hashed concurrently"""
+    files = []
+    for i in range(5):
+        file = tmp_path / f"in_file_{i}.txt"
+        file.write_text(f"hello {i}")
+        files.append(file)
+
+    input_spec = SpecInfo(
+        name="Inputs",
+        fields=[("in_file", File), ("in_files", ty.List[File])],
+        bases=(BaseSpec,),
+    )
+    inputs = make_klass(input_spec)
+    monkeypatch.setenv("PYDRA_HASH_CACHE", str(tmp_path / "serial-cache"))
+    serial_hash = inputs(in_file=files[0], in_files=files[1:]).hash
+    monkeypatch.setenv("PYDRA_HASH_CACHE", str(tmp_path / "threaded-cache"))
+    monkeypatch.setenv("PYDRA_HASH_THREADS", "4")
+    assert inputs(in_file=files[0], in_files=files[1:]).hash == serial_hash
+    assert len(list((tmp_path / "threaded-cache").iterdir())) == 5
+
+
+def test_input_file_hash_2c(tmp_path, monkeypatch):
+    """input spec with File types, checking the file hash policy can be set for the
+    whole spec and overridden for specific fields"""
+    monkeypatch.setenv("PYDRA_HASH_CACHE", str(tmp_path / "hash-cache"))
+    file = tmp_path / "in_file_1.txt"
+    file.write_text("hello")
+
+    input_spec = SpecInfo(
+        name="Inputs",
+        fields=[
+            ("in_file", File),
+            (
+                "in_file_meta",
+                attr.ib(type=File, metadata={"file_hash_policy": "metadata"}),
+            ),
+        ],
+        bases=(BaseSpec,),
+    )
+    my_inp = make_klass(input_spec)(in_file=file, in_file_meta=file)
+    content_hash = my_inp.hash
+    content_field_hashes = my_inp._hashes
+    assert content_field_hashes["in_file"] != content_field_hashes["in_file_meta"]
+    assert my_inp.compute_hash("mmap") == content_hash
+    assert my_inp.compute_hash("metadata") != content_hash
+    assert my_inp._hashes["in_file_meta"] == content_field_hashes["in_file_meta"]
+
+
 def test_input_file_hash_3(tmp_path):
     """input spec with File types, checking when the hash and file_hash change"""
     file = tmp_path / "in_file_1.txt"
@@ -261,6 +312,47 @@ def test_input_file_hash_3(tmp_path):
     # assert filename in my_inp.files_hash["in_file"]
 
 
+def test_input_file_hash_3a(tmp_path):
+    """input spec with File types, checking that only the fields that have been set
+    again (or whose files have changed) are rehashed"""
+    file = tmp_path / "in_file_1.txt"
+    file.write_text("hello")
+
+    input_spec = SpecInfo(
+        name="Inputs", fields=[("in_file", File), ("in_int", int)], bases=(BaseSpec,)
+    )
+    inputs = make_klass(input_spec)
+
+    my_inp = inputs(in_file=file, in_int=3)
+    hash1 = my_inp.hash
+    assert (my_inp.hash_memo.hits, my_inp.hash_memo.misses) == (0, 2)
+    assert my_inp.hash == hash1
+    assert (my_inp.hash_memo.hits, my_inp.hash_memo.misses) == (2, 2)
+
+    # only the field that has been set is rehashed
+    my_inp.in_int = 5
+    hash2 = my_inp.hash
+    assert hash2 == inputs(in_file=file, in_int=5).hash
+    assert (my_inp.hash_memo.hits, my_inp.hash_memo.misses) == (3, 3)
+
+    # the memo can be shared with evolved copies of the spec
+    evolved = attr.evolve(my_inp, in_int=3)
+    assert evolved.compute_hash(memo=my_inp.hash_memo) == hash1
+    assert (my_inp.hash_memo.hits, my_inp.hash_memo.misses) == (4, 4)
+
+    # the file is rehashed if it has been modified
+    time.sleep(0.1)
+    file.write_text("hi")
+    hash3 = evolved.compute_hash(memo=my_inp.hash_memo)
+    assert hash3 != hash1
+    assert hash3 == inputs(in_file=file, in_int=3).hash
+    assert (my_inp.hash_memo.hits, my_inp.hash_memo.misses) == (5, 5)
+
+    # memoized hashes aren't reused with a different file-hash policy
+    assert evolved.compute_hash("metadata", memo=my_inp.hash_memo) != hash3
+    assert (my_inp.hash_memo.hits, my_inp.hash_memo.misses) == (5, 7)
+
+
 def test_input_file_hash_4(tmp_path):
     """input spec with nested list, that contain ints and Files,
     checking changes in checksums
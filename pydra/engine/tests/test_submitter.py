@@ -1,3 +1,5 @@
+import asyncio
+import json
 from dateutil import parser
 import secrets
 import re
@@ -7,20 +9,27 @@ import attrs
 import typing as ty
 from random import randint
 import os
+import sys
 from unittest.mock import patch
 import pytest
-from fileformats.generic import Directory
+from fileformats.generic import Directory, File
 from .utils import (
     need_sge,
     need_slurm,
     gen_basic_wf,
     gen_basic_wf_with_threadcount,
     gen_basic_wf_with_threadcount_concurrent,
+    add2,
+    multiply,
+    raise_xeq1,
 )
 from ..core import Workflow, TaskBase
 from ..submitter import Submitter
 from ..workers import SerialWorker
+from .. import workers
+from ..helpers import load_task
 from ... import mark
+import pydra
 from pathlib import Path
 from datetime import datetime
 
@@ -183,6 +192,279 @@ def test_serial_wf():
     assert res.output.out == 9
 
 
+def test_cf_run_states_in_chunks(tmp_path):
+    """chunks of states are run by single calls of the worker, the outcome of each
+    state being returned separately"""
+    task = raise_xeq1(name="raise", cache_dir=tmp_path).split("x", x=[0, 1, 2, 3, 4])
+    task.state.prepare_states(inputs=task.inputs)
+    task.state.prepare_inputs()
+    task_pkl = task.pickle_task()
+    worker = workers.ConcurrentFuturesWorker(n_procs=2)
+
+    async def run():
+        worker.loop = asyncio.get_running_loop()
+        futures = worker.run_states(task_pkl, task, range(5), chunk_size=3)
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    try:
+        outcomes = asyncio.run(run())
+    finally:
+        worker.close()
+    assert isinstance(outcomes[1], Exception)
+    for ind in (0, 2, 3, 4):
+        assert outcomes[ind].output.out == ind
+        assert load_task(task_pkl, ind=ind).result().output.out == ind
+    # the chunk sizes are adapted to the mean runtime of the states
+    worker._runtimes["run"] = [1.0, 10]
+    assert worker._chunk_size("run", chunk_runtime=0.5, remaining=100) == 5
+    assert worker._chunk_size("run", chunk_runtime=0.5, remaining=4) == 2
+    worker._runtimes["run"] = [0.0, 0]
+    assert worker._chunk_size("run", chunk_runtime=0.5, remaining=100) == 1
+
+
+def test_submitter_chunks(tmp_path):
+    task = multiply(name="mult", x=2, cache_dir=tmp_path).split("y", y=list(range(20)))
+    task.chunk_runtime = 0.1
+    with Submitter("cf", n_procs=2, chunk_size=7) as sub:
+        results = sub(task)
+    assert [r.output.out for r in results] == [2 * y for y in range(20)]
+    # each state is run in its own task directory, which is reused without chunks
+    task_dirs = {p for p in tmp_path.iterdir() if p.name.startswith("Function")}
+    assert len(task_dirs) == 20
+    task = multiply(name="mult", x=2, cache_dir=tmp_path).split("y", y=list(range(20)))
+    with Submitter("cf", n_procs=2) as sub:
+        sub(task)
+    assert {p for p in tmp_path.iterdir() if p.name.startswith("Function")} == task_dirs
+
+
+def test_wf_scheduling(tmp_path, monkeypatch):
+    """the nodes are scheduled from the results returned by the worker (including
+    those of the states run from pickles), so none of them are loaded from the cache"""
+    wf = Workflow(name="wf", input_spec=["x"], x=0, cache_dir=tmp_path)
+    out = wf.lzin.x
+    for i in range(20):
+        wf.add(add2(name=f"add2_{i}", x=out))
+        out = getattr(wf, f"add2_{i}").lzout.out
+    wf.add(multiply(name="mult", x=out).split("y", y=[1, 2, 3]).combine("y"))
+    wf.set_output([("out", out), ("mult", wf.mult.lzout.out)])
+    checked = []
+    done = TaskBase.done
+    monkeypatch.setattr(
+        TaskBase, "done", property(lambda t: checked.append(t.name) or done.fget(t))
+    )
+    with Submitter(plugin="serial") as sub:
+        sub(wf)
+    assert wf.result().output.out == 40
+    assert wf.result().output.mult == [40, 80, 120]
+    assert checked == []
+
+
+def test_wf_worker_error(tmp_path):
+    """errors raised by the worker that aren't raised by the tasks are raised by the
+    submitter, cancelling the futures that are still pending"""
+    cancelled = []
+
+    class BrokenWorker(SerialWorker):
+        plugin_name = "broken"
+
+        async def exec_serial(self, runnable, rerun=False, environment=None):
+            if runnable.name == "broken":
+                raise OSError("connection lost")
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(runnable.name)
+                raise
+
+        async def fetch_finished(self, futures):
+            return await workers.Worker.fetch_finished(self, futures)
+
+    wf = Workflow(name="wf", input_spec=["x"], x=1, cache_dir=tmp_path)
+    wf.add(add2(name="broken", x=wf.lzin.x))
+    wf.add(add2(name="slow", x=wf.lzin.x))
+    wf.set_output([("out", wf.slow.lzout.out)])
+    start = time.monotonic()
+    with pytest.raises(Exception, match="workflow is not empty") as excinfo:
+        with Submitter(plugin=BrokenWorker) as sub:
+            sub(wf)
+    assert time.monotonic() - start < 5
+    assert "connection lost" in str(excinfo.value.__cause__)
+    assert cancelled == ["slow"]
+
+
+def test_slurm_poller(tmp_path, monkeypatch):
+    """the statuses of all the outstanding jobs are polled with single squeue and
+    sacct calls, and the futures of the jobs that have left the queue are resolved"""
+    calls = []
+    queue = {"1": "RUNNING", "2": "PENDING", "3": "PENDING"}
+    accounting = {"1": "COMPLETED 0:0", "2": "CANCELLED 0:0", "3": "FAILED 1:0"}
+
+    async def read_and_display_async(*cmd, hide_display=False):
+        calls.append(cmd)
+        jobids = cmd[cmd.index("-j") + 1].split(",")
+        if cmd[0] == "squeue":
+            lines = [f"{j} {queue[j]}" for j in jobids if j in queue]
+        else:
+            lines = [f"{j} {accounting[j]}" for j in jobids]
+        return 0, "\n".join(lines), ""
+
+    monkeypatch.setattr(workers, "read_and_display_async", read_and_display_async)
+    worker = workers.SlurmWorker(poll_delay=0.01, max_poll_delay=0.05)
+    (tmp_path / "slurm-3.err").write_text("Traceback\nValueError: failed\n")
+    worker.error = {j: str(tmp_path / f"slurm-{j}.err") for j in queue}
+
+    async def run():
+        waiting = [asyncio.create_task(worker.poller.wait(j)) for j in queue]
+        await asyncio.sleep(0.3)
+        # the delay is backed off while the jobs don't change state
+        assert worker.poller.delay == 0.05
+        assert not any(w.done() for w in waiting)
+        del queue["1"], queue["2"], queue["3"]
+        return await asyncio.gather(*waiting, return_exceptions=True)
+
+    polls = worker.poller.polls
+    done = asyncio.run(run())
+    assert done[:2] == [True, "CANCELLED"]
+    assert str(done[2]) == "ValueError: failed"
+    squeue = [c for c in calls if c[0] == "squeue"]
+    assert len(squeue) == worker.poller.polls > polls
+    assert all(c[-1] == "1,2,3" for c in squeue)
+    assert [c for c in calls if c[0] == "sacct"] == [
+        ("sacct", "-n", "-X", "-j", "1,2,3", "-o", "JobID%30,State,ExitCode")
+    ]
+
+
+def test_slurm_job_arrays(tmp_path, monkeypatch):
+    """the states of a task are submitted as job arrays, whose elements are polled
+    individually"""
+    calls = []
+
+    async def read_and_display_async(*cmd, hide_display=False):
+        calls.append(cmd)
+        if cmd[0] == "sbatch":
+            return 0, f"Submitted batch job {10 + len(calls)}", ""
+        elif cmd[0] == "squeue":
+            return 0, "", ""
+        lines = [f"{j}_{i} COMPLETED 0:0" for j in cmd[4].split(",") for i in (0, 1)]
+        return 0, "\n".join(lines), ""
+
+    monkeypatch.setattr(workers, "read_and_display_async", read_and_display_async)
+    worker = workers.SlurmWorker(poll_delay=0.01, max_array_size=2, array_throttle=1)
+    task = multiply(name="mult", x=2, cache_dir=tmp_path).split("y", y=[1, 2, 3])
+    task.state.prepare_states(inputs=task.inputs)
+    task.state.prepare_inputs()
+    task_pkl = task.pickle_task()
+
+    async def run():
+        return await asyncio.gather(
+            *(worker.run_el((ind, task_pkl, task)) for ind in range(3))
+        )
+
+    assert asyncio.run(run()) == [True] * 3
+    sbatch = [c for c in calls if c[0] == "sbatch"]
+    assert [c[-2] for c in sbatch] == ["--array=0-1%1", "--array=0-0%1"]
+    assert [c for c in calls if c[0] == "squeue"][0][-1] == "11,12"
+    assert set(worker.error) == {"11_0", "11_1", "12_0"}
+
+    # the array task IDs are mapped to the indices of the states
+    script = Path(sbatch[1][-1]).with_name(f"array_{task.uid}_2-2.py")
+    env = dict(
+        os.environ,
+        SLURM_ARRAY_TASK_ID="0",
+        PYTHONPATH=str(Path(pydra.__file__).parent.parent),
+    )
+    sp.run([sys.executable, str(script)], env=env, check=True)
+    assert load_task(task_pkl, ind=2).result().output.out == 6
+
+
+FAKE_SLURM = """#!{python}
+import json, os, re, subprocess, sys
+from pathlib import Path
+
+db = Path(__file__).parent / "jobs.json"
+jobs = json.loads(db.read_text()) if db.exists() else {{}}
+cmd, args = Path(sys.argv[0]).name, sys.argv[1:]
+with (db.parent / "calls.log").open("a") as f:
+    f.write(json.dumps([cmd] + args) + "\\n")
+if cmd == "sbatch":
+    # the jobs are run as they are submitted
+    opts = dict(a[2:].split("=", 1) for a in args[:-1])
+    jobid = str(len({{j.split("_")[0] for j in jobs}}) + 1)
+    deps = opts.get("dependency", "afterok").split(":")[1:]
+    array = opts.get("array", "").split("%")[0]
+    inds = range(int(array.split("-")[-1]) + 1) if array else [None]
+    for i in inds:
+        key, env = jobid, dict(os.environ)
+        if i is not None:
+            key, env["SLURM_ARRAY_TASK_ID"] = f"{{jobid}}_{{i}}", str(i)
+        if any(jobs[d] != "COMPLETED" for d in deps):
+            jobs[key] = "CANCELLED"
+            continue
+        subs = {{"%j": jobid, "%A": jobid, "%a": str(i)}}
+        out, err = (
+            re.sub("%[jAa]", lambda m: subs[m.group()], opts[o]) for o in ("output", "error")
+        )
+        with open(out, "w") as fout, open(err, "w") as ferr:
+            rc = subprocess.run(["sh", args[-1]], stdout=fout, stderr=ferr, env=env)
+        jobs[key] = "FAILED" if rc.returncode else "COMPLETED"
+    db.with_suffix(".tmp").write_text(json.dumps(jobs))
+    os.replace(db.with_suffix(".tmp"), db)
+    print(f"Submitted batch job {{jobid}}")
+elif cmd == "sacct":
+    requested = args[args.index("-j") + 1].split(",")
+    for jobid, state in jobs.items():
+        if jobid.split("_")[0] in requested:
+            print(f"{{jobid}} {{state}} {{int(state != 'COMPLETED')}}:0")
+"""
+
+
+def test_slurm_submit_dag(tmp_path, monkeypatch):
+    """the nodes of a workflow without states are submitted upfront, chained by job
+    dependencies, and only the jobs of the terminal ones are polled"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for cmd in ("sbatch", "squeue", "sacct", "scontrol"):
+        (bin_dir / cmd).write_text(FAKE_SLURM.format(python=sys.executable))
+        (bin_dir / cmd).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("PYTHONPATH", str(Path(pydra.__file__).parent.parent))
+
+    def run(x, cache_dir, calls):
+        (bin_dir / "calls.log").unlink(missing_ok=True)
+        (bin_dir / "jobs.json").unlink(missing_ok=True)
+        wf = Workflow(name="wf", input_spec=["x"], x=x, cache_dir=cache_dir)
+        wf.add(raise_xeq1(name="check", x=wf.lzin.x))
+        wf.add(add2(name="add2", x=wf.check.lzout.out))
+        wf.add(multiply(name="mult", x=wf.add2.lzout.out).split("y", y=[1, 2]))
+        wf.set_output([("out", wf.mult.lzout.out)])
+        with Submitter("slurm", poll_delay=0.01, submit_dag=True) as sub:
+            try:
+                sub(wf)
+            finally:
+                for call in (bin_dir / "calls.log").read_text().splitlines():
+                    calls.append(json.loads(call))
+        return wf
+
+    calls = []
+    wf = run(3, tmp_path / "ok", calls)
+    assert wf.result().output.out == [5, 10]
+    sbatch = [c for c in calls if c[0] == "sbatch"]
+    assert len(sbatch) == 3
+    # the first two nodes were submitted upfront, the split one once they completed
+    assert "--dependency=afterok:1" in sbatch[1]
+    assert "--array=0-1" in sbatch[2]
+    # the job of the first node was never polled
+    polled = [c[c.index("-j") + 1] for c in calls if c[0] in ("squeue", "sacct")]
+    assert polled and not any("1" in p.split(",") for p in polled)
+
+    # the job following a failed job is cancelled and the split node isn't run
+    calls = []
+    with pytest.raises(Exception, match="check"):
+        run(1, tmp_path / "failed", calls)
+    assert len([c for c in calls if c[0] == "sbatch"]) == 2
+    assert not [c for c in calls if c[0] == "scontrol"]
+
+
 @need_slurm
 def test_slurm_wf(tmpdir):
     wf = gen_basic_wf()
@@ -675,6 +957,36 @@ def to_tuple(x, y):
     return (x, y)
 
 
+@mark.task
+def file_size(in_file: File) -> int:
+    return in_file.fspath.stat().st_size
+
+
+def test_submitter_file_hash_policy(tmp_path):
+    in_file = tmp_path / "in.txt"
+    in_file.write_text("foo")
+
+    wf = Workflow(name="wf_hash_policy", input_spec={"in_file": File})
+    wf.add(file_size(name="size", in_file=wf.lzin.in_file))
+    wf.add(file_size(name="size_content", in_file=wf.lzin.in_file))
+    wf.size_content.file_hash_policy = "content"
+    wf.set_output([("out", wf.size.lzout.out)])
+    wf.inputs.in_file = in_file
+    wf.cache_dir = tmp_path / "cache"
+
+    content_checksum = wf.checksum
+    with Submitter("serial", file_hash_policy="metadata") as sub:
+        result = sub(wf)
+    assert result.output.out == 3
+    # the policy of the submitter is inherited by the workflow and its nodes, unless
+    # they specify their own
+    assert wf.file_hash_policy.default == "metadata"
+    assert wf.size.file_hash_policy.default == "metadata"
+    assert wf.size_content.file_hash_policy == "content"
+    assert wf.checksum != content_checksum
+    assert (wf.cache_dir / wf.checksum).exists()
+
+
 class BYOAddVarWorker(SerialWorker):
     """A dummy worker that adds 1 to the output of the task"""
 
@@ -20,7 +20,7 @@ from ..specs import (
     ShellSpec,
     File,
 )
-from ...utils.hash import hash_function
+from ...utils.hash import hash_function, HashProfile
 
 
 no_win = pytest.mark.skipif(
@@ -70,6 +70,139 @@ def test_checksum():
     )
 
 
+def test_checksum_memo():
+    """checking that only the modified inputs are rehashed when the checksum is
+    recalculated"""
+    nn = funaddtwo(a=3)
+    checksum = nn.checksum
+    misses = nn.input_hash_memo.misses
+    assert nn.checksum == checksum
+    assert nn.input_hash_memo.misses == misses
+    assert nn.input_hash_memo.hits == misses
+
+    nn.inputs.a = 4
+    assert nn.checksum != checksum
+    assert nn.input_hash_memo.misses == misses + 1
+    assert nn.checksum == funaddtwo(a=4).checksum
+
+
+def test_checksum_memo_in_place():
+    """checking that the memoized hashes aren't reused after the input values have
+    been modified in place"""
+    nn = funaddtwo(a=[1, 2])
+    checksum = nn.checksum
+    nn.inputs.a.append(3)
+    assert nn.checksum != checksum
+    assert nn.checksum == funaddtwo(a=[1, 2, 3]).checksum
+
+    nn = funaddtwo(a={"x": [1, 2]})
+    checksum = nn.checksum
+    nn.inputs.a["x"][0] = 3
+    assert nn.checksum != checksum
+    assert nn.checksum == funaddtwo(a={"x": [3, 2]}).checksum
+
+    np = pytest.importorskip("numpy")
+    arr = np.arange(6)
+    nn = funaddtwo(a=arr)
+    checksum = nn.checksum
+    arr[0] = 10
+    assert nn.checksum != checksum
+    assert nn.checksum == funaddtwo(a=arr.copy()).checksum
+    arr.shape = (2, 3)
+    assert nn.checksum == funaddtwo(a=arr.copy()).checksum
+    # read-only arrays are memoized, until they are made writeable again
+    arr.flags.writeable = False
+    checksum = nn.checksum
+    hits = nn.input_hash_memo.hits
+    assert nn.checksum == checksum
+    assert nn.input_hash_memo.hits > hits
+    arr.flags.writeable = True
+    arr[0, 0] = 20
+    assert nn.checksum != checksum
+    assert nn.checksum == funaddtwo(a=arr.copy()).checksum
+
+    # in-place modifications before pickling aren't carried over either
+    nn = funaddtwo(a=[1, 2])
+    nn.checksum
+    nn.inputs.a.append(3)
+    nn = cp.loads(cp.dumps(nn))
+    assert nn.checksum == funaddtwo(a=[1, 2, 3]).checksum
+
+
+def test_checksum_memo_pickled(tmp_path):
+    """checking that the hashes calculated before the task is pickled are reused by
+    the unpickled task, and that changes to the files are still detected"""
+    in_file = tmp_path / "in.txt"
+    in_file.write_text("a")
+
+    @mark.task
+    def file_len(in_file: File) -> int:
+        return len(Path(in_file).read_text())
+
+    task = file_len(in_file=in_file)
+    checksum = task.checksum
+    task = cp.loads(cp.dumps(task))
+    misses = task.input_hash_memo.misses
+    assert task.checksum == checksum
+    assert task.input_hash_memo.misses == misses
+    assert task.inputs.hash_changes(memo=task.input_hash_memo) == []
+
+    in_file.write_text("ab")
+    assert task.inputs.hash_changes(memo=task.input_hash_memo) == ["in_file"]
+
+
+def test_checksum_hash_scheme(monkeypatch):
+    """checking that the memoized hashes aren't reused after the hash scheme has been
+    switched"""
+    nn = funaddtwo(a=[1, 2, 3])
+    checksum = nn.checksum
+    monkeypatch.setenv("PYDRA_HASH_SCHEME", "2")
+    assert nn.checksum != checksum
+    assert nn.checksum == funaddtwo(a=[1, 2, 3]).checksum
+    monkeypatch.delenv("PYDRA_HASH_SCHEME")
+    assert nn.checksum == checksum
+
+
+def test_hash_changes_snapshot():
+    """checking that only the fields whose snapshots differ are rehashed"""
+    nn = funaddtwo(a=[1, 2])
+    nn.checksum
+    snapshot = nn.inputs.snapshot()
+    assert nn.inputs.hash_changes(snapshot=snapshot) == []
+    nn.inputs.a.append(3)
+    assert nn.inputs.hash_changes(snapshot=snapshot) == ["a"]
+
+
+def test_hash_changes_strict(monkeypatch):
+    """checking that no snapshot is taken when the strict check is selected"""
+    nn = funaddtwo(a=3)
+    assert nn._snapshot_inputs() == nn.inputs.snapshot()
+    monkeypatch.setenv("PYDRA_HASH_CHANGE_CHECK", "strict")
+    assert nn._snapshot_inputs() is None
+    monkeypatch.setenv("PYDRA_HASH_CHANGE_CHECK", "lax")
+    with pytest.raises(ValueError, match="Unrecognised PYDRA_HASH_CHANGE_CHECK"):
+        nn._snapshot_inputs()
+
+
+def test_checksum_hash_profile(tmp_path, monkeypatch):
+    """checking that the profile of the hashing of the inputs is saved in the output
+    directory when enabled"""
+    nn = funaddtwo(a=3)
+    nn.cache_dir = tmp_path
+    nn()
+    with pytest.raises(FileNotFoundError):
+        HashProfile.load(nn.output_dir)
+
+    monkeypatch.setenv("PYDRA_HASH_PROFILE", "1")
+    nn = funaddtwo(a=4)
+    nn.cache_dir = tmp_path
+    nn()
+    profile = HashProfile.load(nn.output_dir)
+    assert set(profile.fields) == {"_func", "a"}
+    assert profile.fields["a"].calls == 1
+    assert "builtins.int" in profile.types
+
+
 def test_annotated_func():
     @mark.task
     def testfunc(
@@ -1088,20 +1221,14 @@ def test_audit_shellcommandtask(tmpdir):
 def test_audit_shellcommandtask_file(tmp_path):
     # sourcery skip: use-fstring-for-concatenation
     import glob
-    import shutil
 
     # create test.txt file with "This is a test" in it in the tmpdir
-    # create txt file in cwd
-    with open("test.txt", "w") as f:
+    with open(tmp_path / "test.txt", "w") as f:
         f.write("This is a test")
 
-    with open("test2.txt", "w") as f:
+    with open(tmp_path / "test2.txt", "w") as f:
         f.write("This is a test")
 
-    # copy the test.txt file to the tmpdir
-    shutil.copy("test.txt", tmp_path)
-    shutil.copy("test2.txt", tmp_path)
-
     cmd = "cat"
     file_in = File(tmp_path / "test.txt")
     file_in_2 = File(tmp_path / "test2.txt")
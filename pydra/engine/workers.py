@@ -3,12 +3,16 @@
 import asyncio
 import sys
 import json
+import math
 import re
+import threading
 from tempfile import gettempdir
 from pathlib import Path
-from shutil import copyfile, which
+from shutil import which
+from uuid import uuid4
 
 import concurrent.futures as cf
+import multiprocessing as mp
 
 from .core import TaskBase
 from .helpers import (
@@ -16,6 +20,7 @@ from .helpers import (
     read_and_display_async,
     save,
     load_and_run,
+    load_and_run_chunk,
     load_task,
 )
 
@@ -38,6 +43,36 @@ class Worker:
         """Return coroutine for task execution."""
         raise NotImplementedError
 
+    def run_states(
+        self, task_pkl, task, inds, rerun=False, chunk_size=None, chunk_runtime=None
+    ):
+        """
+        Return the awaitables of the states of a task with the given indices, run in
+        chunks of contiguous states by the workers that support it (or else one by one
+        as by `run_el`).
+
+        Parameters
+        ----------
+        task_pkl : Path
+            the pickled task (see `TaskBase.pickle_task`)
+        task : TaskBase
+            the task split over the states
+        inds : sequence of int
+            the indices of the states to run
+        rerun : bool
+            whether to rerun the states if their results are cached
+        chunk_size : int, optional
+            the number of states of each chunk
+        chunk_runtime : float, optional
+            the target runtime in seconds of each chunk (ignored if `chunk_size` is set)
+
+        Returns
+        -------
+        futures : list
+            the awaitables of the outcomes of the states, in the order of `inds`
+        """
+        return [self.run_el((ind, task_pkl, task), rerun=rerun) for ind in inds]
+
     def close(self):
         """Close this worker."""
 
@@ -165,8 +200,18 @@ class ConcurrentFuturesWorker(Worker):
         """Initialize Worker."""
         super().__init__()
         self.n_procs = get_available_cpus() if n_procs is None else n_procs
+        # the queue the outcomes of the states run in chunks are streamed back on from
+        # the processes of the pool (see `run_states`)
+        self._progress = mp.Queue()
         # added cpu_count to verify, remove once confident and let PPE handle
-        self.pool = cf.ProcessPoolExecutor(self.n_procs)
+        self.pool = cf.ProcessPoolExecutor(
+            self.n_procs, initializer=_set_progress_queue, initargs=(self._progress,)
+        )
+        # the futures of the states being run in chunks, by the token of their run, and
+        # the total runtime and number of those that have completed
+        self._states = {}
+        self._runtimes = {}
+        self._progress_reader = None
         # self.loop = asyncio.get_event_loop()
         logger.debug("Initialize ConcurrentFuture")
 
@@ -188,32 +233,346 @@ class ConcurrentFuturesWorker(Worker):
             )
         return res
 
+    def run_states(
+        self, task_pkl, task, inds, rerun=False, chunk_size=None, chunk_runtime=None
+    ):
+        """
+        Run the states of a task in chunks of contiguous states, each chunk being run
+        by a single call in one of the processes of the pool, which streams back the
+        outcome of each state as it completes, apart from that of the last state of the
+        chunk, which is returned by the call.
+
+        With `chunk_runtime`, a chunk of a single state is first submitted to each
+        process, and the sizes of the following chunks are adapted to the mean runtime
+        of the states that have completed. The chunks are never larger than an even
+        share of the remaining states between the processes.
+        """
+        token = uuid4().hex
+        futures = self._states[token] = {ind: self.loop.create_future() for ind in inds}
+        self._runtimes[token] = [0.0, 0]
+        if self._progress_reader is None:
+            self._progress_reader = threading.Thread(
+                target=self._read_progress, daemon=True
+            )
+            self._progress_reader.start()
+        asyncio.ensure_future(
+            self._run_chunks(
+                token, task_pkl, list(inds), rerun, chunk_size, chunk_runtime
+            )
+        )
+        return list(futures.values())
+
+    async def _run_chunks(
+        self, token, task_pkl, inds, rerun, chunk_size=None, chunk_runtime=None
+    ):
+        """Coroutine that submits the chunks of states of a run to the pool, keeping
+        one chunk per process in flight if their sizes are adapted to their runtimes"""
+        chunks = set()
+        try:
+            while inds or chunks:
+                while inds and (chunk_size or len(chunks) < self.n_procs):
+                    size = chunk_size or self._chunk_size(
+                        token, chunk_runtime, len(inds)
+                    )
+                    chunk, inds = inds[:size], inds[size:]
+                    chunks.add(
+                        self.loop.run_in_executor(
+                            self.pool, _run_chunk, token, task_pkl, chunk, rerun
+                        )
+                    )
+                done, chunks = await asyncio.wait(
+                    chunks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for chunk in done:
+                    # the last state of the chunk, whose outcome isn't streamed back
+                    for outcome in chunk.result():
+                        self._state_done(token, *outcome)
+            # the outcomes of the other states can still be in flight on the queue
+            pending = [f for f in self._states[token].values() if not f.done()]
+            if pending:
+                await asyncio.wait(pending)
+        except Exception as e:
+            for future in self._states[token].values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            del self._states[token], self._runtimes[token]
+
+    def _chunk_size(self, token, chunk_runtime, remaining):
+        """The number of states of the next chunk of a run, from the mean runtime of
+        its states that have completed"""
+        total, count = self._runtimes[token]
+        if not count:
+            return 1
+        size = max(round(chunk_runtime * count / max(total, 1e-6)), 1)
+        return min(size, math.ceil(remaining / self.n_procs))
+
+    def _state_done(self, token, ind, outcome, runtime):
+        """Resolve the future of a state that has completed, unless it already has. As
+        the outcome of the last state of each chunk is returned by the chunk, the chunks
+        of a run have all returned once its states have completed."""
+        future = self._states.get(token, {}).get(ind)
+        if future is None or future.done():
+            return
+        self._runtimes[token][0] += runtime
+        self._runtimes[token][1] += 1
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+    def _read_progress(self):
+        """Read the outcomes of the states streamed back from the processes of the
+        pool, until None is received"""
+        while True:
+            message = self._progress.get()
+            if message is None:
+                break
+            self.loop.call_soon_threadsafe(self._state_done, *message)
+
     def close(self):
         """Finalize the internal pool of tasks."""
         self.pool.shutdown()
+        if self._progress_reader is not None:
+            self._progress.put(None)
+            self._progress_reader.join()
+        self._progress.close()
+
+
+# the queue the processes of the pools of the concurrent futures workers stream the
+# outcomes of the states run in chunks back on
+_progress_queue = None
+
+
+def _set_progress_queue(queue):
+    global _progress_queue
+    _progress_queue = queue
+
+
+def _run_chunk(token, task_pkl, inds, rerun=False):
+    """Run a chunk of states in a process of the pool of a concurrent futures worker,
+    streaming back the outcome of each state but the last, which is returned"""
+
+    def report(ind, outcome, runtime):
+        _progress_queue.put((token, ind, outcome, runtime))
+
+    return load_and_run_chunk(task_pkl, inds, rerun, report=report)
+
+
+class SlurmPoller:
+    """Poller of the statuses of the jobs submitted by a :class:`SlurmWorker`.
+
+    Rather than each job being polled separately, the coroutines submitting the jobs
+    wait on futures (see `wait`) that are resolved by a single polling loop, which
+    queries all the outstanding jobs with one ``squeue`` call per interval, followed
+    by one ``sacct`` call for the jobs that have left the queue.
+
+    The interval is `poll_delay` scaled up with the logarithm of the number of
+    outstanding jobs, since larger queries are more expensive for the Slurm
+    controller, and is backed off by 50% per poll, up to `max_poll_delay`, while none
+    of the jobs change state.
+
+    Parameters
+    ----------
+    worker : SlurmWorker
+        the worker whose jobs are polled
+    poll_delay : float
+        minimum delay between polls in seconds
+    max_poll_delay : float
+        maximum delay between polls in seconds
+    """
+
+    def __init__(self, worker, poll_delay=1, max_poll_delay=60):
+        self.worker = worker
+        self.poll_delay = poll_delay
+        self.max_poll_delay = max(max_poll_delay, poll_delay)
+        self.delay = poll_delay
+        self.polls = 0
+        self._futures = {}
+        self._states = {}
+        self._task = None
+
+    async def wait(self, jobid):
+        """
+        Wait for a job to leave the queue.
+
+        Returns
+        -------
+        status : bool or str
+            True if the job completed, or the state of the job if it was cancelled,
+            timed out or preempted
+
+        Raises
+        ------
+        Exception
+            if the job failed
+        """
+        future = self._futures.get(jobid)
+        if future is None or future.done():
+            future = self._futures[jobid] = asyncio.get_running_loop().create_future()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        while self._futures:
+            await asyncio.sleep(self.delay)
+            try:
+                changed = await self.poll()
+            except Exception as e:
+                logger.warning(f"Polling Slurm jobs failed, retrying: {e}")
+                changed = False
+            self.delay = self.next_delay(changed)
+
+    def next_delay(self, changed):
+        """The delay before the next poll, given whether any job changed state"""
+        floor = self.poll_delay * (1 + math.log10(max(len(self._futures), 1)))
+        if changed:
+            return floor
+        return max(floor, min(self.delay * 1.5, self.max_poll_delay))
+
+    async def poll(self):
+        """
+        Query the statuses of all the outstanding jobs, resolving the futures of the
+        jobs that have left the queue.
+
+        Returns
+        -------
+        changed : bool
+            whether any of the jobs changed state since the previous poll
+        """
+        for jobid in [j for j, f in self._futures.items() if f.done()]:
+            # e.g. the waiting coroutine was cancelled
+            del self._futures[jobid]
+            self._states.pop(jobid, None)
+        if not self._futures:
+            return False
+        self.polls += 1
+        jobids = list(self._futures)
+        logger.debug(f"Polling {len(jobids)} jobs")
+        # the elements of job arrays (<jobid>_<index>) are queried via their arrays,
+        # and listed one per line
+        rc, stdout, stderr = await read_and_display_async(
+            "squeue",
+            "-h",
+            "-r",
+            "-o",
+            "%i %T",
+            "-j",
+            _array_jobids(jobids),
+            hide_display=True,
+        )
+        if rc and "slurm_load_jobs error" not in stderr:
+            raise RuntimeError(f"Error returned from squeue: {stderr}")
+        states = {}
+        for line in stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                states[parts[0]] = parts[1]
+        changed = False
+        for jobid in jobids:
+            if states.get(jobid) != self._states.get(jobid):
+                changed = True
+        self._states = {j: s for j, s in states.items() if j in self._futures}
+        # the jobs that are no longer in the queue, whose exit codes are checked
+        left = [j for j in jobids if j not in states]
+        if left:
+            _, stdout, _ = await read_and_display_async(
+                "sacct",
+                "-n",
+                "-X",
+                "-j",
+                _array_jobids(left),
+                "-o",
+                "JobID%30,State,ExitCode",
+                hide_display=True,
+            )
+            accounted = {}
+            for line in stdout.splitlines():
+                m = self.worker._sacct_re.search(line)
+                if m:
+                    accounted[m.group("jobid")] = m
+            for jobid in left:
+                future = self._futures[jobid]
+                try:
+                    m = accounted[jobid]
+                except KeyError:
+                    future.set_exception(RuntimeError("Job information not found"))
+                else:
+                    try:
+                        status = self.worker._job_status(
+                            jobid, m.group("status"), int(m.group("exit_code"))
+                        )
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        if status is False:
+                            # e.g. requeued
+                            continue
+                        future.set_result(status)
+                del self._futures[jobid]
+        return changed
+
+
+def _array_jobids(jobids):
+    """The comma-separated IDs of the jobs, or of the arrays of the job array elements,
+    e.g. "1234,1235" for ["1234_0", "1234_1", "1235"]"""
+    return ",".join(dict.fromkeys(j.split("_")[0] for j in jobids))
 
 
 class SlurmWorker(DistributedWorker):
-    """A worker to execute tasks on SLURM systems."""
+    """A worker to execute tasks on SLURM systems.
+
+    The states of a task that are submitted together (i.e. in the same iteration of
+    the event loop) are packed into job arrays of up to `max_array_size` elements,
+    each of which is run by a single batch script that maps the SLURM_ARRAY_TASK_ID
+    of the element to the index of its state.
+
+    With `submit_dag`, the nodes of a workflow that can be run as soon as their
+    predecessors complete are submitted upfront, chained by job dependencies (see
+    `submit_nodes`), instead of as their predecessors complete.
+    """
 
     plugin_name = "slurm"
     _cmd = "sbatch"
     _sacct_re = re.compile(
-        "(?P<jobid>\\d*) +(?P<status>\\w*)\\+? +" "(?P<exit_code>\\d+):\\d+"
+        "(?P<jobid>\\d+(?:_\\d+)?) +(?P<status>\\w*)\\+? +" "(?P<exit_code>\\d+):\\d+"
     )
 
-    def __init__(self, loop=None, max_jobs=None, poll_delay=1, sbatch_args=None):
+    def __init__(
+        self,
+        loop=None,
+        max_jobs=None,
+        poll_delay=1,
+        sbatch_args=None,
+        max_poll_delay=60,
+        max_array_size=1000,
+        array_throttle=None,
+        submit_dag=False,
+    ):
         """
         Initialize SLURM Worker.
 
         Parameters
         ----------
         poll_delay : seconds
-            Delay between polls to slurmd
+            Minimum delay between polls to slurmd
+        max_poll_delay : seconds
+            Maximum delay between polls to slurmd, which the delay is backed off to
+            while none of the jobs change state (see `SlurmPoller`)
         sbatch_args : str
             Additional sbatch arguments
         max_jobs : int
             Maximum number of submitted jobs
+        max_array_size : int
+            Maximum number of states of a task submitted as a single job array (it
+            shouldn't exceed the MaxArraySize of the cluster), or 1 to submit each
+            state as a separate job
+        array_throttle : int
+            Maximum number of elements of each job array run simultaneously
+        submit_dag : bool
+            Submit the nodes of workflows without states upfront, each as a job that
+            depends on the jobs of its predecessors
 
         """
         super().__init__(loop=loop, max_jobs=max_jobs)
@@ -221,10 +580,22 @@ class SlurmWorker(DistributedWorker):
             poll_delay = 0
         self.poll_delay = poll_delay
         self.sbatch_args = sbatch_args or ""
+        self.max_array_size = max(max_array_size or 1, 1)
+        self.array_throttle = array_throttle
+        self.submit_dag = submit_dag
         self.error = {}
+        self.poller = SlurmPoller(
+            self, poll_delay=poll_delay, max_poll_delay=max_poll_delay
+        )
+        # the states being gathered into job arrays, and the futures of the job IDs
+        # of their elements
+        self._array_states = {}
+        self._array_submissions = {}
 
     def run_el(self, runnable, rerun=False, environment=None):
         """Worker submission API."""
+        if not isinstance(runnable, TaskBase) and self.max_array_size > 1:
+            return self._run_array_el(runnable, rerun=rerun)
         script_dir, batch_script = self._prepare_runscripts(runnable, rerun=rerun)
         if (script_dir / script_dir.parts[1]) == gettempdir():
             logger.warning("Temporary directories may not be shared across computers")
@@ -254,10 +625,10 @@ class SlurmWorker(DistributedWorker):
         if ind is None:
             if not (script_dir / "_task.pkl").exists():
                 save(script_dir, task=task)
+            task_pkl = script_dir / "_task.pklz"
         else:
-            copyfile(task[1], script_dir / "_task.pklz")
-
-        task_pkl = script_dir / "_task.pklz"
+            # the payload of the states (see StatePayload) is shared by their jobs
+            task_pkl = task[1]
         if not task_pkl.exists() or not task_pkl.stat().st_size:
             raise Exception("Missing or empty task!")
 
@@ -277,24 +648,212 @@ class SlurmWorker(DistributedWorker):
             fp.writelines(bcmd)
         return script_dir, batchscript
 
-    async def _submit_job(self, batchscript, name, uid, cache_dir):
-        """Coroutine that submits task runscript and polls job until completion or error."""
-        script_dir = cache_dir / f"{self.__class__.__name__}_scripts" / uid
+    def _prepare_array_script(
+        self, task_pkl, task, inds, interpreter="/bin/sh", rerun=False
+    ):
+        """Write the batch script of a job array, whose elements run the states with
+        the given indices"""
+        uid = f"{task.uid}_{inds[0]}-{inds[-1]}"
+        script_dir = task.cache_dir / f"{self.__class__.__name__}_scripts" / uid
+        script_dir.mkdir(parents=True, exist_ok=True)
+        if not task_pkl.exists() or not task_pkl.stat().st_size:
+            raise Exception("Missing or empty task!")
+        # the mapping of the array task IDs to the indices of the states
+        python_script = script_dir / f"array_{uid}.py"
+        python_script.write_text(
+            "\n".join(
+                (
+                    "import os",
+                    "from pydra.engine.helpers import load_and_run",
+                    f"inds = {list(inds)}",
+                    'ind = inds[int(os.environ["SLURM_ARRAY_TASK_ID"])]',
+                    f'load_and_run(task_pkl="{task_pkl}", ind=ind, rerun={rerun})',
+                )
+            )
+        )
+        batchscript = script_dir / f"batchscript_{uid}.sh"
+        batchscript.write_text(
+            "\n".join(
+                (
+                    f"#!{interpreter}",
+                    f"#SBATCH --output={script_dir / 'slurm-%A_%a.out'}",
+                    f"{sys.executable} {python_script}",
+                )
+            )
+        )
+        return script_dir, batchscript
+
+    async def _run_array_el(self, runnable, rerun=False):
+        """Coroutine that runs a state as an element of a job array, which is
+        submitted by the first of the states of the task started in the same iteration
+        of the event loop"""
+        ind, task_pkl, task = runnable
+        key = (str(task_pkl), rerun)
+        states = self._array_states.get(key)
+        first = states is None
+        if first:
+            states = self._array_states[key] = []
+            jobids = self._array_submissions[key] = (
+                asyncio.get_running_loop().create_future()
+            )
+        else:
+            jobids = self._array_submissions[key]
+        states.append(ind)
+        if first:
+            # the other states started in this iteration of the event loop are gathered
+            await asyncio.sleep(0)
+            del self._array_states[key], self._array_submissions[key]
+            try:
+                submitted = {}
+                for i in range(0, len(states), self.max_array_size):
+                    submitted.update(
+                        await self._submit_array(
+                            task_pkl, task, states[i : i + self.max_array_size], rerun
+                        )
+                    )
+            except Exception as e:
+                jobids.set_exception(e)
+                raise
+            jobids.set_result(submitted)
+        jobid = (await jobids)[ind]
+        return await self._wait_job(
+            jobid, uid=f"{task.uid}_{ind}", cache_dir=task.cache_dir
+        )
+
+    async def _submit_array(self, task_pkl, task, inds, rerun=False):
+        """Submit a job array running the states with the given indices, returning the
+        job IDs of the elements of the states"""
+        script_dir, batchscript = self._prepare_array_script(
+            task_pkl, task, inds, rerun=rerun
+        )
+        array = f"0-{len(inds) - 1}"
+        if self.array_throttle:
+            array += f"%{self.array_throttle}"
+        jobid, error_file = await self._sbatch(
+            batchscript,
+            name=task.name,
+            uid=script_dir.name,
+            script_dir=script_dir,
+            array=array,
+        )
+        jobids = {}
+        for i, ind in enumerate(inds):
+            jobids[ind] = f"{jobid}_{i}"
+            self.error[jobids[ind]] = error_file and error_file.replace("%a", str(i))
+        logger.debug(f"Submitted {len(inds)} states of {task.name} as job {jobid}")
+        return jobids
+
+    async def submit_nodes(self, wf, nodes, rerun=False):
+        """
+        Submit nodes of a workflow upfront, each as a job that only starts once the jobs
+        of its predecessors have completed successfully (`--dependency=afterok`) and
+        that retrieves the inputs connected to them from their results in the cache
+        (see `load_and_run_node`). The jobs of nodes whose predecessors fail are
+        cancelled by slurm (`--kill-on-invalid-dep=yes`).
+
+        Only the jobs of the terminal nodes, i.e. those that aren't followed by another
+        node submitted upfront or that are followed by nodes that aren't, are polled.
+        The other nodes have completed successfully once any of the nodes following
+        them has, and otherwise their results are looked up in the cache.
+
+        Parameters
+        ----------
+        wf : :obj:`~pydra.engine.core.Workflow`
+            the workflow being run
+        nodes : list
+            the nodes to submit, in topological order, whose predecessors are all
+            submitted with them and which don't have states or nested workflows
+        rerun : bool
+            whether to rerun the nodes if their results are cached
+
+        Returns
+        -------
+        futures : dict
+            the futures of the completion of the jobs of the nodes by name
+        """
+        graph = wf.graph
+        script_dir = wf.cache_dir / f"{self.__class__.__name__}_scripts" / wf.uid
+        script_dir.mkdir(parents=True, exist_ok=True)
+        save(script_dir, task=wf)
+        wf_pkl = script_dir / "_task.pklz"
+        jobids = {}
+        for node in nodes:
+            batchscript = script_dir / f"batchscript_{node.name}.sh"
+            batchscript.write_text(
+                "\n".join(
+                    (
+                        "#!/bin/sh",
+                        f"{sys.executable} -c 'from pydra.engine.helpers import "
+                        f'load_and_run_node; load_and_run_node(wf_pkl="{wf_pkl}", '
+                        f'name="{node.name}", rerun={rerun})\'',
+                    )
+                )
+            )
+            jobid, error_file = await self._sbatch(
+                batchscript,
+                name=node.name,
+                uid=wf.uid,
+                script_dir=script_dir,
+                dependency=[jobids[p.name] for p in graph.predecessors[node.name]],
+            )
+            self.error[jobid] = error_file
+            jobids[node.name] = jobid
+        logger.debug(f"Submitted {len(nodes)} nodes of {wf.name} upfront")
+        futures = {}
+        for node in reversed(nodes):
+            successors = [s.name for s in graph.successors[node.name]]
+            submitted = [futures[s] for s in successors if s in futures]
+            if submitted and len(submitted) == len(successors):
+                future = self._wait_successors(submitted)
+            else:
+                future = self._wait_job(
+                    jobids[node.name],
+                    uid=wf.uid,
+                    cache_dir=wf.cache_dir,
+                    requeue_cancelled=False,
+                )
+            futures[node.name] = asyncio.ensure_future(future)
+        return futures
+
+    @staticmethod
+    async def _wait_successors(futures):
+        """Coroutine that waits for the jobs of the nodes following a node submitted
+        upfront, returning True once any of them has completed successfully (which
+        implies the job of the node has too) or None if none of them have"""
+        for future in asyncio.as_completed(futures):
+            try:
+                if await future is True:
+                    return True
+            except Exception:
+                pass
+        return None
+
+    async def _sbatch(
+        self, batchscript, name, uid, script_dir, array=None, dependency=None
+    ):
+        """Submit a batch script, returning the job ID and the path of the error file
+        (with %a standing for the array task ID of job arrays)"""
         sargs = self.sbatch_args.split()
         jobname = re.search(r"(?<=-J )\S+|(?<=--job-name=)\S+", self.sbatch_args)
         if not jobname:
             jobname = ".".join((name, uid))
             sargs.append(f"--job-name={jobname}")
+        pattern = "slurm-%A_%a" if array else "slurm-%j"
         output = re.search(r"(?<=-o )\S+|(?<=--output=)\S+", self.sbatch_args)
         if not output:
-            output_file = str(script_dir / "slurm-%j.out")
+            output_file = str(script_dir / f"{pattern}.out")
             sargs.append(f"--output={output_file}")
         error = re.search(r"(?<=-e )\S+|(?<=--error=)\S+", self.sbatch_args)
         if not error:
-            error_file = str(script_dir / "slurm-%j.err")
+            error_file = str(script_dir / f"{pattern}.err")
             sargs.append(f"--error={error_file}")
         else:
             error_file = None
+        if array:
+            sargs.append(f"--array={array}")
+        if dependency:
+            sargs.append(f"--dependency=afterok:{':'.join(dependency)}")
+            sargs.append("--kill-on-invalid-dep=yes")
         sargs.append(str(batchscript))
         # TO CONSIDER: add random sleep to avoid overloading calls
         rc, stdout, stderr = await read_and_display_async(
@@ -307,20 +866,31 @@ class SlurmWorker(DistributedWorker):
             raise RuntimeError("Could not extract job ID")
         jobid = jobid.group()
         if error_file:
-            error_file = error_file.replace("%j", jobid)
-        self.error[jobid] = error_file.replace("%j", jobid)
-        # intermittent polling
+            error_file = error_file.replace("%j", jobid).replace("%A", jobid)
+        return jobid, error_file
+
+    async def _submit_job(self, batchscript, name, uid, cache_dir):
+        """Coroutine that submits task runscript and polls job until completion or error."""
+        script_dir = cache_dir / f"{self.__class__.__name__}_scripts" / uid
+        jobid, error_file = await self._sbatch(batchscript, name, uid, script_dir)
+        self.error[jobid] = error_file
+        return await self._wait_job(jobid, uid=uid, cache_dir=cache_dir)
+
+    async def _wait_job(self, jobid, uid, cache_dir, requeue_cancelled=True):
+        """Coroutine that waits for a job (or element of a job array) to complete,
+        requeuing it if it is timed out, preempted or (unless `requeue_cancelled` is
+        False, e.g. for jobs cancelled as their dependencies failed) cancelled"""
+        requeued = ["TIMEOUT", "PREEMPTED"]
+        if requeue_cancelled:
+            requeued.append("CANCELLED")
+        # the job is polled along with the other jobs of the worker
         while True:
-            # 3 possibilities
-            # False: job is still pending/working
-            # True: job is complete
+            # 2 possibilities
+            # True or the state of a cancelled job: job has left the queue
             # Exception: Polling / job failure
-            done = await self._poll_job(jobid)
+            done = await self.poller.wait(jobid)
             if done:
-                if (
-                    done in ["CANCELLED", "TIMEOUT", "PREEMPTED"]
-                    and "--no-requeue" not in self.sbatch_args
-                ):
+                if done in requeued and "--no-requeue" not in self.sbatch_args:
                     # loading info about task with a specific uid
                     info_file = cache_dir / f"{uid}_info.json"
                     if info_file.exists():
@@ -331,30 +901,16 @@ class SlurmWorker(DistributedWorker):
                     cmd_re = ("scontrol", "requeue", jobid)
                     await read_and_display_async(*cmd_re, hide_display=True)
                 else:
-                    return True
-            await asyncio.sleep(self.poll_delay)
-
-    async def _poll_job(self, jobid):
-        cmd = ("squeue", "-h", "-j", jobid)
-        logger.debug(f"Polling job {jobid}")
-        rc, stdout, stderr = await read_and_display_async(*cmd, hide_display=True)
-        if not stdout or "slurm_load_jobs error" in stderr:
-            # job is no longer running - check exit code
-            status = await self._verify_exit_code(jobid)
-            return status
-        return False
+                    return done
 
-    async def _verify_exit_code(self, jobid):
-        cmd = ("sacct", "-n", "-X", "-j", jobid, "-o", "JobID,State,ExitCode")
-        _, stdout, _ = await read_and_display_async(*cmd, hide_display=True)
-        if not stdout:
-            raise RuntimeError("Job information not found")
-        m = self._sacct_re.search(stdout)
+    def _job_status(self, jobid, status, exit_code):
+        """The status of a job that has left the queue from its state and exit code
+        reported by sacct (see `SlurmPoller.wait`), or False if it is still running"""
         error_file = self.error[jobid]
-        if int(m.group("exit_code")) != 0 or m.group("status") != "COMPLETED":
-            if m.group("status") in ["CANCELLED", "TIMEOUT", "PREEMPTED"]:
-                return m.group("status")
-            elif m.group("status") in ["RUNNING", "PENDING"]:
+        if exit_code != 0 or status != "COMPLETED":
+            if status in ["CANCELLED", "TIMEOUT", "PREEMPTED"]:
+                return status
+            elif status in ["RUNNING", "PENDING"]:
                 return False
             # TODO: potential for requeuing
             # parsing the error message
@@ -508,10 +1064,10 @@ class SGEWorker(DistributedWorker):
         if ind is None:
             if not (script_dir / "_task.pkl").exists():
                 save(script_dir, task=task)
+            task_pkl = script_dir / "_task.pklz"
         else:
-            copyfile(task[1], script_dir / "_task.pklz")
-
-        task_pkl = script_dir / "_task.pklz"
+            # the payload of the states (see StatePayload) is shared by their jobs
+            task_pkl = task[1]
         if not task_pkl.exists() or not task_pkl.stat().st_size:
             raise Exception("Missing or empty task!")
 
@@ -1,11 +1,26 @@
 """Generic object hashing dispatch"""
 
 import os
+import array
+import json
+import mmap
+import operator
+import sqlite3
 import struct
+import sys
+import threading
+import time
+import weakref
 from datetime import datetime
 import typing as ty
-from pathlib import Path
+import dataclasses
+from pathlib import Path, PurePath
+from stat import S_ISDIR
+from collections import OrderedDict
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from functools import singledispatch
 from hashlib import blake2b
 import logging
@@ -17,6 +32,7 @@ from typing import (
     Set,
 )
 from filelock import SoftFileLock
+import attr
 import attrs.exceptions
 from fileformats.core import FileSet
 from . import user_cache_dir
@@ -69,6 +85,253 @@ def location_converter(path: ty.Union[Path, str, None]) -> Path:
     return path
 
 
+def local_cache_key(key: CacheKey) -> str:
+    """Cheaply hash a "locally unique" cache key (e.g. file-system path + mtime) into
+    the hex string used to name its entry in the persistent store"""
+    return blake2b(str(key).encode()).hexdigest()
+
+
+@attrs.define
+class FilesBackend:
+    """Persistent-cache backend that stores each hash in its own file, named by the
+    local hash of its key, within the cache location. Lookups of keys that aren't
+    present are guarded by a lock file so concurrent processes don't calculate the
+    same hash twice.
+
+    Parameters
+    ----------
+    location: Path
+        the directory in which to store the hash files
+    """
+
+    location: Path
+
+    def get_or_calculate(self, local_key: str, calculate_hash: ty.Callable) -> Hash:
+        key_path = self.location / local_key
+        with SoftFileLock(key_path.with_suffix(".lock")):
+            if key_path.exists():
+                return Hash(key_path.read_bytes())
+            hsh = calculate_hash()
+            key_path.write_bytes(hsh)
+        return Hash(hsh)
+
+    def get_many(self, local_keys: ty.Iterable[str]) -> ty.Dict[str, Hash]:
+        hashes = {}
+        for local_key in local_keys:
+            try:
+                hashes[local_key] = Hash((self.location / local_key).read_bytes())
+            except FileNotFoundError:
+                pass
+        return hashes
+
+    def set_many(self, hashes: ty.Mapping[str, Hash]):
+        for local_key, hsh in hashes.items():
+            (self.location / local_key).write_bytes(hsh)
+
+    def clean_up(self, period: int, max_entries: ty.Optional[int] = None):
+        """Removes the hash files that haven't been accessed in the last `period` days.
+        If `max_entries` is provided, the least recently accessed entries above that
+        number are also removed"""
+        now = datetime.now()
+        entries = []
+        for path in self.location.iterdir():
+            # Skip lock files and any files that don't belong to this backend
+            if path.suffix:
+                continue
+            atime = path.lstat().st_atime
+            if (now - datetime.fromtimestamp(atime)).days > period:
+                path.unlink()
+            elif max_entries is not None:
+                entries.append((atime, path))
+        if max_entries is not None and len(entries) > max_entries:
+            for _, path in sorted(entries)[: len(entries) - max_entries]:
+                path.unlink()
+
+
+@attrs.define
+class SqliteBackend:
+    """Persistent-cache backend that stores the hashes in a single, indexed SQLite
+    database within the cache location (opened in write-ahead-log mode). Avoids the
+    creation of a file and a lock file per entry, supports batched lookups/inserts and
+    tracks the last access time of each entry in an indexed column, so stale entries
+    can be evicted in bounded batches without scanning the whole store.
+
+    Parameters
+    ----------
+    location: Path
+        the directory in which to create the database
+    cleanup_batch: int
+        the maximum number of entries to remove in a single call to `clean_up`
+    """
+
+    location: Path
+    cleanup_batch: int = 10000
+    _connection: ty.Optional[sqlite3.Connection] = attrs.field(
+        default=None, init=False, eq=False, repr=False
+    )
+    _pid: ty.Optional[int] = attrs.field(default=None, init=False, eq=False, repr=False)
+    _lock: threading.Lock = attrs.field(
+        factory=threading.Lock, init=False, eq=False, repr=False
+    )
+
+    DB_NAME = "hashes.sqlite"
+    # Access times are only updated when they are older than this (in seconds) to
+    # avoid a write for every hit
+    ACCESS_RESOLUTION = 3600
+    # Number of keys to look up in a single query (well below SQLITE_MAX_VARIABLE_NUMBER)
+    QUERY_CHUNK = 500
+
+    @property
+    def db_path(self) -> Path:
+        return self.location / self.DB_NAME
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared with forked child processes
+        if self._connection is None or self._pid != os.getpid():
+            conn = sqlite3.connect(
+                self.db_path, timeout=60, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hashes "
+                "(key TEXT PRIMARY KEY, hash BLOB NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS hashes_accessed ON hashes (accessed)"
+            )
+            self._connection = conn
+            self._pid = os.getpid()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def __getstate__(self):
+        return {"location": self.location, "cleanup_batch": self.cleanup_batch}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_or_calculate(self, local_key: str, calculate_hash: ty.Callable) -> Hash:
+        try:
+            return self.get_many([local_key])[local_key]
+        except KeyError:
+            pass
+        hsh = Hash(calculate_hash())
+        self.set_many({local_key: hsh})
+        return hsh
+
+    def get_many(self, local_keys: ty.Iterable[str]) -> ty.Dict[str, Hash]:
+        local_keys = list(local_keys)
+        now = time.time()
+        hashes = {}
+        stale = []
+        with self._lock:
+            for i in range(0, len(local_keys), self.QUERY_CHUNK):
+                chunk = local_keys[i : i + self.QUERY_CHUNK]
+                rows = self.connection.execute(
+                    "SELECT key, hash, accessed FROM hashes WHERE key IN "
+                    f"({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                for key, hsh, accessed in rows:
+                    hashes[key] = Hash(bytes(hsh))
+                    if now - accessed > self.ACCESS_RESOLUTION:
+                        stale.append((now, key))
+            if stale:
+                self.connection.executemany(
+                    "UPDATE hashes SET accessed = ? WHERE key = ?", stale
+                )
+        return hashes
+
+    def set_many(self, hashes: ty.Mapping[str, Hash]):
+        now = time.time()
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO hashes (key, hash, accessed) "
+                    "VALUES (?, ?, ?)",
+                    ((k, bytes(h), now) for k, h in hashes.items()),
+                )
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def clean_up(self, period: int, max_entries: ty.Optional[int] = None):
+        """Removes up to `cleanup_batch` entries that haven't been accessed in the last
+        `period` days, or that are the least recently accessed entries above
+        `max_entries`. Only the index on the access time is traversed, so the cost is
+        bounded by the size of the batch rather than the size of the store."""
+        cutoff = time.time() - period * 86400
+        with self._lock:
+            conn = self.connection
+            removed = conn.execute(
+                "DELETE FROM hashes WHERE key IN (SELECT key FROM hashes "
+                "WHERE accessed < ? ORDER BY accessed LIMIT ?)",
+                (cutoff, self.cleanup_batch),
+            ).rowcount
+            if max_entries is not None and removed < self.cleanup_batch:
+                (num_entries,) = conn.execute("SELECT COUNT(*) FROM hashes").fetchone()
+                excess = min(num_entries - max_entries, self.cleanup_batch - removed)
+                if excess > 0:
+                    conn.execute(
+                        "DELETE FROM hashes WHERE key IN (SELECT key FROM hashes "
+                        "ORDER BY accessed LIMIT ?)",
+                        (excess,),
+                    )
+
+    def migrate(self, location: ty.Union[Path, str], remove: bool = False) -> int:
+        """Imports the entries of a one-file-per-key (i.e. `FilesBackend`) cache
+        directory into the database, preserving their access times.
+
+        Parameters
+        ----------
+        location : Path or str
+            the directory containing the hash files to import
+        remove : bool, optional
+            whether to delete the hash files (and stale lock files) once they have
+            been imported, by default False
+
+        Returns
+        -------
+        int
+            the number of entries imported
+        """
+        location = Path(location)
+        rows = []
+        imported = []
+        for path in location.iterdir():
+            if path.suffix or not path.is_file():
+                continue
+            rows.append((path.name, path.read_bytes(), path.lstat().st_atime))
+            imported.append(path)
+        with self._lock:
+            conn = self.connection
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO hashes (key, hash, accessed) "
+                    "VALUES (?, ?, ?)",
+                    rows,
+                )
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        if remove:
+            for path in imported:
+                path.unlink()
+                path.with_suffix(".lock").unlink(missing_ok=True)
+        return len(rows)
+
+
 @attrs.define
 class PersistentCache:
     """Persistent cache in which to store computationally expensive hashes between nodes
@@ -78,24 +341,44 @@ class PersistentCache:
 
     The locally unique key is hashed (cheaply) using hashlib cryptography and this
     "local hash" is use to name the entry of the (potentially expensive) hash of the
-    object itself (e.g. the contents of a file). This entry is saved as a text file
-    within a user-specific cache directory (see `platformdirs.user_cache_dir`), with
-    the name of the file being the "local hash" of the key and the contents of the
-    file being the "globally unique hash" of the object itself.
+    object itself (e.g. the contents of a file). How the entries are stored within
+    the user-specific cache directory (see `platformdirs.user_cache_dir`) is determined
+    by the backend, either one text file per entry named by the "local hash" of the key
+    ("files", the default), or a single indexed SQLite database ("sqlite").
 
     Parameters
     ----------
     location: Path
         the directory in which to store the hashes cache
+    cleanup_period: int
+        the number of days after which entries that haven't been accessed are removed
+    max_entries: int, optional
+        the maximum number of entries to retain in the store on clean-up
+    backend: str or FilesBackend or SqliteBackend
+        the backend used to store the hashes, either the name of the backend or an
+        instance of it
     """
 
     location: Path = attrs.field(converter=location_converter)  # type: ignore[misc]
     cleanup_period: int = attrs.field()
+    max_entries: ty.Optional[int] = attrs.field()
+    backend: ty.Union[str, FilesBackend, SqliteBackend] = attrs.field()
     _hashes: ty.Dict[CacheKey, Hash] = attrs.field(factory=dict)
 
     # Set the location of the persistent hash cache
     LOCATION_ENV_VAR = "PYDRA_HASH_CACHE"
     CLEANUP_ENV_VAR = "PYDRA_HASH_CACHE_CLEANUP_PERIOD"
+    MAX_ENTRIES_ENV_VAR = "PYDRA_HASH_CACHE_MAX_ENTRIES"
+    BACKEND_ENV_VAR = "PYDRA_HASH_CACHE_BACKEND"
+
+    BACKENDS = {
+        "files": FilesBackend,
+        "sqlite": SqliteBackend,
+    }
+
+    # Process-wide default caches, keyed by the environment variables they were
+    # configured by (see `default`)
+    _defaults: ty.ClassVar[ty.Dict[tuple, "PersistentCache"]] = {}
 
     @classmethod
     def location_default(cls):
@@ -114,6 +397,26 @@ class PersistentCache:
     def cleanup_period_default(self):
         return int(os.environ.get(self.CLEANUP_ENV_VAR, 30))
 
+    @max_entries.default
+    def max_entries_default(self):
+        max_entries = os.environ.get(self.MAX_ENTRIES_ENV_VAR)
+        return int(max_entries) if max_entries else None
+
+    @backend.default
+    def backend_default(self):
+        return os.environ.get(self.BACKEND_ENV_VAR, "files")
+
+    def __attrs_post_init__(self):
+        if isinstance(self.backend, str):
+            try:
+                backend_cls = self.BACKENDS[self.backend]
+            except KeyError:
+                raise ValueError(
+                    f"Unrecognised persistent hash cache backend '{self.backend}', "
+                    f"valid options are {list(self.BACKENDS)}"
+                ) from None
+            self.backend = backend_cls(self.location)
+
     def get_or_calculate_hash(self, key: CacheKey, calculate_hash: ty.Callable) -> Hash:
         """Check whether key is present in the persistent cache store and return it if so.
         Otherwise use `calculate_hash` to generate the hash and save it in the persistent
@@ -137,24 +440,100 @@ class PersistentCache:
             return self._hashes[key]
         except KeyError:
             pass
-        key_path = self.location / blake2b(str(key).encode()).hexdigest()
-        with SoftFileLock(key_path.with_suffix(".lock")):
-            if key_path.exists():
-                return Hash(key_path.read_bytes())
-            hsh = calculate_hash()
-            key_path.write_bytes(hsh)
-            self._hashes[key] = Hash(hsh)
-        return Hash(hsh)
+        hsh = self.backend.get_or_calculate(local_cache_key(key), calculate_hash)
+        self._hashes[key] = hsh
+        return hsh
+
+    def get_hashes(self, keys: ty.Iterable[CacheKey]) -> ty.Dict[CacheKey, Hash]:
+        """Look up multiple keys in the persistent store in a single batch
+
+        Parameters
+        ----------
+        keys : Iterable[CacheKey]
+            the locally unique keys to look up
+
+        Returns
+        -------
+        dict[CacheKey, Hash]
+            the hashes of the keys that were present in the store
+        """
+        hashes = {}
+        missing = {}
+        for key in keys:
+            try:
+                hashes[key] = self._hashes[key]
+            except KeyError:
+                missing[local_cache_key(key)] = key
+        if missing:
+            for local_key, hsh in self.backend.get_many(missing).items():
+                hashes[missing[local_key]] = self._hashes[missing[local_key]] = hsh
+        return hashes
+
+    def set_hashes(self, hashes: ty.Mapping[CacheKey, Hash]):
+        """Save multiple hashes to the persistent store in a single batch
+
+        Parameters
+        ----------
+        hashes : Mapping[CacheKey, Hash]
+            the hashes to save, keyed by their locally unique keys
+        """
+        self.backend.set_many({local_cache_key(k): h for k, h in hashes.items()})
+        self._hashes.update(hashes)
 
     def clean_up(self):
-        """Cleans up old hash caches that haven't been accessed in the last 30 days"""
-        now = datetime.now()
-        for path in self.location.iterdir():
-            if path.name.endswith(".lock"):
-                continue
-            days = (now - datetime.fromtimestamp(path.lstat().st_atime)).days
-            if days > self.cleanup_period:
-                path.unlink()
+        """Cleans up old hash caches that haven't been accessed in the last
+        `cleanup_period` days (and the least recently accessed entries above
+        `max_entries` if set)"""
+        self.backend.clean_up(self.cleanup_period, max_entries=self.max_entries)
+
+    def migrate(self, location: ty.Union[Path, str, None] = None, remove: bool = False):
+        """Import the entries of a one-file-per-key hash cache directory into the
+        backend of this cache (only supported by the "sqlite" backend).
+
+        Parameters
+        ----------
+        location : Path or str, optional
+            the directory to import, by default the location of this cache
+        remove : bool, optional
+            whether to delete the imported hash files, by default False
+
+        Returns
+        -------
+        int
+            the number of entries imported
+        """
+        if not isinstance(self.backend, SqliteBackend):
+            raise ValueError(
+                f"Cannot migrate hash files into {type(self.backend).__name__} backend"
+            )
+        return self.backend.migrate(
+            self.location if location is None else location, remove=remove
+        )
+
+    @classmethod
+    def default(cls) -> "PersistentCache":
+        """Return the persistent cache configured by the environment variables, which
+        is shared within the process so that its location isn't recreated and the
+        hashes it has already loaded aren't discarded every time an object is hashed"""
+        settings = tuple(
+            os.environ.get(v)
+            for v in (
+                cls.LOCATION_ENV_VAR,
+                cls.CLEANUP_ENV_VAR,
+                cls.MAX_ENTRIES_ENV_VAR,
+                cls.BACKEND_ENV_VAR,
+            )
+        )
+        try:
+            cache = cls._defaults[settings]
+        except KeyError:
+            pass
+        else:
+            # recreate the cache if its location has been removed in the meantime
+            if cache.location.exists():
+                return cache
+        cache = cls._defaults[settings] = cls()
+        return cache
 
     @classmethod
     def from_path(
@@ -162,9 +541,118 @@ class PersistentCache:
     ) -> "PersistentCache":
         if isinstance(path, PersistentCache):
             return path
+        if path is None:
+            return cls.default()
         return PersistentCache(path)
 
 
+FILE_HASH_STRATEGIES = ("content", "mmap", "sampled", "metadata")
+
+
+def _strategy_validator(_, attribute, value):
+    if value not in FILE_HASH_STRATEGIES:
+        raise ValueError(
+            f"Unrecognised file hash strategy '{value}' for {attribute.name}, valid "
+            f"options are {list(FILE_HASH_STRATEGIES)}"
+        )
+
+
+def _locations_converter(
+    locations: ty.Union[ty.Mapping, ty.Iterable[ty.Tuple[ty.Any, str]]]
+) -> ty.Tuple[ty.Tuple[str, str], ...]:
+    if isinstance(locations, Mapping):
+        locations = locations.items()
+    converted = []
+    for location, strategy in locations:
+        if strategy not in FILE_HASH_STRATEGIES:
+            raise ValueError(
+                f"Unrecognised file hash strategy '{strategy}' for location "
+                f"{location}, valid options are {list(FILE_HASH_STRATEGIES)}"
+            )
+        converted.append((os.path.abspath(location), strategy))
+    # Sort so that the most specific (i.e. longest) locations are matched first
+    return tuple(sorted(converted, key=lambda x: len(x[0]), reverse=True))
+
+
+@attrs.define(frozen=True)
+class FileHashPolicy:
+    """Selects the strategy used to hash the file-sets within the objects being hashed.
+
+    * "content" - the full contents of the files are hashed via
+      `FileSet.__bytes_repr__` (the default)
+    * "mmap" - the full contents of the files are hashed via memory-maps in large
+      chunks, producing the same digests as "content"
+    * "sampled" - the size of each file and samples of `sample_len` bytes from the
+      head, middle and tail of its contents are hashed
+    * "metadata" - only the path, size, inode and modification time of each file are
+      hashed, which should only be used for trusted (e.g. read-only) locations
+
+    Strategies other than "content" are recorded in the persistent-cache key of the
+    file-set, so hashes calculated with different strategies never collide.
+
+    Parameters
+    ----------
+    default : str
+        the strategy to use for file-sets outside of the specified locations
+    locations : dict[Path, str] or list[tuple[Path, str]]
+        strategies to use for the file-sets stored within particular directories
+    chunk_len : int
+        the length of the chunks the memory-mapped files are read in
+    sample_len : int
+        the length of the head, middle and tail samples read by the "sampled" strategy
+    """
+
+    default: str = attrs.field(default="content", validator=_strategy_validator)
+    locations: ty.Tuple[ty.Tuple[str, str], ...] = attrs.field(
+        factory=tuple, converter=_locations_converter
+    )
+    chunk_len: int = 2**24
+    sample_len: int = 2**20
+
+    def strategy(self, fileset: FileSet) -> str:
+        """Returns the strategy to hash the file-set with"""
+        for location, strategy in self.locations:
+            if all(
+                os.path.commonpath([os.path.abspath(p), location]) == location
+                for p in fileset.fspaths
+            ):
+                return strategy
+        return self.default
+
+    @classmethod
+    def from_value(
+        cls, value: ty.Union[str, "FileHashPolicy", None]
+    ) -> ty.Optional["FileHashPolicy"]:
+        if value is None or isinstance(value, FileHashPolicy):
+            return value
+        return FileHashPolicy(default=value)
+
+
+HASH_SCHEME_ENV_VAR = "PYDRA_HASH_SCHEME"
+HASH_SCHEMES = (1, 2)
+
+
+def hash_scheme_default() -> int:
+    """The version of the scheme used to serialize objects, as set by the
+    PYDRA_HASH_SCHEME environment variable
+
+    * 1 - every item of a container is hashed separately (the default)
+    * 2 - lists, tuples, sets and dicts of primitive values (int, float, bool and str)
+      of a single type are packed in bulk (see `pack_primitives`), which is much
+      faster for large containers but produces different hashes for them
+
+    Since the schemes produce different hashes, switching scheme invalidates the
+    hashes of the existing cache directories.
+    """
+    scheme = int(os.environ.get(HASH_SCHEME_ENV_VAR, 1))
+    if scheme not in HASH_SCHEMES:
+        raise ValueError(
+            f"Unrecognised {HASH_SCHEME_ENV_VAR} value {scheme}, can be one of "
+            f"{HASH_SCHEMES}"
+        )
+    return scheme
+
+
 @attrs.define
 class Cache:
     """Cache for hashing objects, used to avoid infinite recursion caused by circular
@@ -180,9 +668,26 @@ class Cache:
 
     persistent: ty.Optional[PersistentCache] = attrs.field(
         default=None,
-        converter=PersistentCache.from_path,  # type: ignore[misc]
+        converter=attrs.converters.optional(
+            PersistentCache.from_path  # type: ignore[misc]
+        ),
+    )
+    file_hash_policy: ty.Optional[FileHashPolicy] = attrs.field(
+        default=None,
+        converter=FileHashPolicy.from_value,  # type: ignore[misc]
     )
     _hashes: ty.Dict[int, Hash] = attrs.field(factory=dict)
+    scheme: int = attrs.field(
+        factory=hash_scheme_default, validator=attrs.validators.in_(HASH_SCHEMES)
+    )
+
+    @property
+    def persistent_cache(self) -> PersistentCache:
+        """The persistent cache, which defaults to the one configured by the environment
+        (only looked up when first required, as most objects don't use it)"""
+        if self.persistent is None:
+            self.persistent = PersistentCache.default()
+        return self.persistent
 
     def __getitem__(self, object_id: int) -> Hash:
         return self._hashes[object_id]
@@ -198,6 +703,300 @@ class UnhashableError(ValueError):
     """Error for objects that cannot be hashed"""
 
 
+@attrs.define
+class HashStats:
+    """Time spent and bytes processed hashing a category of objects"""
+
+    calls: int = 0
+    hits: int = 0  # number of calls served from a memo/cache
+    seconds: float = 0.0
+    nbytes: int = 0
+
+    def add(self, seconds: float = 0.0, nbytes: int = 0, hit: bool = False):
+        self.calls += 1
+        self.hits += hit
+        self.seconds += seconds
+        self.nbytes += nbytes
+
+
+@attrs.define
+class HashProfile:
+    """Profile of the time spent and the bytes processed while hashing objects, broken
+    down by the top-level input field they belong to, by the type dispatched to
+    `bytes_repr` (excluding the time spent hashing nested objects) and by whether the
+    hash was retrieved from the persistent cache or had to be calculated.
+
+    Hashes are only recorded in a profile while it is activated (see `activate`). When
+    the PYDRA_HASH_PROFILE environment variable is set, a profile is recorded for every
+    task that is run and saved in its output directory, from where it can be read back
+    with `HashProfile.load`.
+    """
+
+    fields: ty.Dict[str, HashStats] = attrs.field(factory=dict)
+    types: ty.Dict[str, HashStats] = attrs.field(factory=dict)
+    persistent_hits: HashStats = attrs.field(factory=HashStats)
+    persistent_misses: HashStats = attrs.field(factory=HashStats)
+    nbytes: int = attrs.field(default=0, eq=False, repr=False)
+    _child_seconds: ty.List[float] = attrs.field(
+        factory=list, init=False, eq=False, repr=False
+    )
+
+    ENV_VAR = "PYDRA_HASH_PROFILE"
+    REPORT_NAME = "_hash_profile.json"
+    # pseudo-field the hashing of files across the thread pool is recorded under
+    CONCURRENT_FILES_FIELD = "<concurrent file hashing>"
+
+    @classmethod
+    def enabled(cls) -> bool:
+        """Whether hash profiling of tasks has been enabled by the environment"""
+        return os.environ.get(cls.ENV_VAR, "").lower() not in ("", "0", "false", "no")
+
+    @contextmanager
+    def activate(self):
+        """Record the hashes calculated within the context in this profile"""
+        token = _active_hash_profile.set(self)
+        try:
+            yield self
+        finally:
+            _active_hash_profile.reset(token)
+
+    def record_field(
+        self, name: str, seconds: float = 0.0, nbytes: int = 0, hit: bool = False
+    ):
+        """Record the hashing of a top-level input field"""
+        self.fields.setdefault(name, HashStats()).add(seconds, nbytes, hit)
+
+    def _start(self) -> float:
+        self._child_seconds.append(0.0)
+        return time.perf_counter()
+
+    def _stop(
+        self,
+        obj: object,
+        start: float,
+        nbytes: int,
+        persistent_hit: ty.Optional[bool] = None,
+    ):
+        seconds = time.perf_counter() - start
+        child_seconds = self._child_seconds.pop()
+        if self._child_seconds:
+            self._child_seconds[-1] += seconds
+        tp = type(obj)
+        self.types.setdefault(f"{tp.__module__}.{tp.__name__}", HashStats()).add(
+            seconds - child_seconds, nbytes
+        )
+        self.nbytes += nbytes
+        if persistent_hit is not None:
+            stats = self.persistent_hits if persistent_hit else self.persistent_misses
+            stats.add(seconds, nbytes, persistent_hit)
+
+    def asdict(self) -> ty.Dict[str, ty.Any]:
+        # the running total of bytes is only used to attribute them to fields
+        excluded = attrs.fields(HashProfile).nbytes
+        return attrs.asdict(self, filter=lambda a, _: a.init and a is not excluded)
+
+    def save(self, output_dir: ty.Union[Path, str]) -> Path:
+        """Save the profile as a JSON report in the (task output) directory"""
+        path = Path(output_dir) / self.REPORT_NAME
+        path.write_text(json.dumps(self.asdict(), indent=2))
+        return path
+
+    @classmethod
+    def load(cls, output_dir: ty.Union[Path, str]) -> "HashProfile":
+        """Load the profile report saved in the (task output) directory"""
+        dct = json.loads((Path(output_dir) / cls.REPORT_NAME).read_text())
+        return cls(
+            fields={k: HashStats(**v) for k, v in dct["fields"].items()},
+            types={k: HashStats(**v) for k, v in dct["types"].items()},
+            persistent_hits=HashStats(**dct["persistent_hits"]),
+            persistent_misses=HashStats(**dct["persistent_misses"]),
+        )
+
+    def summary(self, top: int = 10) -> str:
+        """A table of the fields and types that took the longest to hash"""
+        lines = []
+        for title, stats in (("Field", self.fields), ("Type", self.types)):
+            lines.append(
+                f"{title:<50} {'calls':>8} {'hits':>8} {'secs':>10} {'MB':>10}"
+            )
+            for name, st in sorted(stats.items(), key=lambda i: -i[1].seconds)[:top]:
+                lines.append(
+                    f"{name:<50} {st.calls:>8} {st.hits:>8} {st.seconds:>10.4f} "
+                    f"{st.nbytes / 1e6:>10.2f}"
+                )
+            lines.append("")
+        for title, st in (
+            ("persistent-cache hits", self.persistent_hits),
+            ("persistent-cache misses", self.persistent_misses),
+        ):
+            lines.append(
+                f"{title}: {st.calls} ({st.seconds:.4f} secs, "
+                f"{st.nbytes / 1e6:.2f} MB)"
+            )
+        return "\n".join(lines)
+
+
+_active_hash_profile: ContextVar[ty.Optional[HashProfile]] = ContextVar(
+    "pydra_hash_profile", default=None
+)
+
+
+def active_hash_profile() -> ty.Optional[HashProfile]:
+    """The hash profile that is currently being recorded, if any"""
+    return _active_hash_profile.get()
+
+
+@contextmanager
+def activate_hash_profile(profile: ty.Optional[HashProfile]):
+    """Record the hashes calculated within the context in the profile, if provided"""
+    if profile is None:
+        yield None
+    else:
+        with profile.activate():
+            yield profile
+
+
+_IMMUTABLE_SCALARS = (str, bytes, int, float, complex, bool, type(None), PurePath)
+# common types that are never memoized, which are skipped without further checks
+_NEVER_MEMOIZED = frozenset((int, float, complex, bool, type(None), list, dict, set))
+
+
+class IdentityHashMemo:
+    """Process-wide memo of the hashes of large immutable objects keyed by their
+    identity, so that objects shared between many tasks (e.g. a large string or a
+    frozen configuration object) are only serialized once per process.
+
+    Strings and bytes of at least `min_size` bytes, and tuples and frozensets of at
+    least `min_size` / 8 items, are memoized if all the objects nested within them are
+    immutable. As they can't be weakly referenced, they are held in the memo (which
+    also guarantees that their ids aren't reused) until they are evicted, least
+    recently used first, once their total estimated size exceeds `max_size`. Instances
+    of frozen attrs classes and dataclasses, which are serialized via the generic
+    `bytes_repr`, are memoized regardless of their size if their fields hold immutable
+    values. They are weakly referenced, so their entries are removed with them.
+
+    Since the memo is only consulted for immutable objects, and the hashes are keyed
+    by the version of the hash scheme, the hashes of the objects are unchanged.
+    """
+
+    def __init__(
+        self, min_size: int = 2**16, max_size: int = 2**28, max_entries: int = 2**16
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.size = 0
+        self.hits = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._frozen_types: ty.Dict[type, bool] = {}
+        self._lock = threading.RLock()
+
+    def get(self, obj: object, cache: Cache) -> ty.Optional[Hash]:
+        """Return the memoized hash of the object, if present"""
+        with self._lock:
+            try:
+                ref, size, hsh = self._entries[(id(obj), cache.scheme)]
+            except KeyError:
+                return None
+            if (ref() if isinstance(ref, weakref.ref) else ref) is not obj:
+                return None
+            self._entries.move_to_end((id(obj), cache.scheme))
+            self.hits += 1
+        return hsh
+
+    def set(self, obj: object, cache: Cache, hsh: Hash):
+        """Memoize the hash of the object (if it is eligible)"""
+        key = (id(obj), cache.scheme)
+        if type(obj) in (str, bytes, tuple, frozenset):
+            size = self._immutable_size(obj)
+            if size is None:
+                return
+            ref = obj
+        else:
+            if self._immutable_size(obj) is None:
+                return
+            try:
+                ref = weakref.ref(obj, lambda _, key=key: self._remove(key))
+            except TypeError:
+                return
+            size = 0
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (ref, size, hsh)
+            self.size += size
+            while self._entries and (
+                self.size > self.max_size or len(self._entries) > self.max_entries
+            ):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def eligible(self, obj: object) -> bool:
+        """Whether the object is of a type and size that could be memoized (i.e. before
+        checking the objects nested within it are immutable)"""
+        tp = type(obj)
+        if tp is str or tp is bytes:
+            return len(obj) >= self.min_size  # type: ignore[arg-type]
+        if tp is tuple or tp is frozenset:
+            return len(obj) * 8 >= self.min_size  # type: ignore[arg-type]
+        try:
+            return self._frozen_types[tp]
+        except KeyError:
+            pass
+        if attrs.has(tp):
+            frozen = tp.__setattr__ is attr._make._frozen_setattrs
+        elif dataclasses.is_dataclass(tp):
+            frozen = tp.__dataclass_params__.frozen  # type: ignore[attr-defined]
+        else:
+            frozen = False
+        frozen = frozen and bytes_repr.dispatch(tp) is bytes_repr.dispatch(object)
+        self._frozen_types[tp] = frozen
+        return frozen
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key: tuple):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def _immutable_size(self, obj: object) -> ty.Optional[int]:
+        """The estimated size of the object if it and all the objects nested within it
+        are immutable, otherwise None"""
+        size = 0
+        stack = [obj]
+        while stack:
+            item = stack.pop()
+            tp = type(item)
+            if tp is str or tp is bytes:
+                size += len(item)  # type: ignore[arg-type]
+            elif isinstance(item, _IMMUTABLE_SCALARS):
+                size += 8
+            elif tp is tuple or tp is frozenset:
+                size += 8
+                stack.extend(item)  # type: ignore[call-overload]
+            elif self.eligible(item):
+                size += 8
+                stack.extend(getattr(item, f.name) for f in _fields(tp))
+            else:
+                return None
+        return size
+
+
+def _fields(tp: type) -> ty.Sequence[ty.Any]:
+    return attrs.fields(tp) if attrs.has(tp) else dataclasses.fields(tp)
+
+
+identity_hash_memo = IdentityHashMemo()
+"""The identity-keyed memo of the hashes of large immutable objects of the process"""
+
+
 def hash_function(obj, **kwargs):
     """Generate hash of object."""
     return hash_object(obj, **kwargs).hex()
@@ -232,56 +1031,405 @@ def hash_single(obj: object, cache: Cache) -> Hash:
     """
     objid = id(obj)
     if objid not in cache:
-        # Handle recursion by putting a dummy value in the cache
-        cache[objid] = Hash(b"\x00")
+        if type(obj) not in _NEVER_MEMOIZED and identity_hash_memo.eligible(obj):
+            hsh = identity_hash_memo.get(obj, cache)
+            if hsh is None:
+                hsh = _hash_single(obj, cache)
+                identity_hash_memo.set(obj, cache, hsh)
+            cache[objid] = hsh
+        else:
+            _hash_single(obj, cache)
+    return cache[objid]
+
+
+def _hash_single(obj: object, cache: Cache) -> Hash:
+    """Serialize and hash an object that isn't in the cache and store its hash in it"""
+    objid = id(obj)
+    profile = _active_hash_profile.get()
+    if profile is not None:
+        return _profiled_hash_single(obj, cache, profile)
+    # Handle recursion by putting a dummy value in the cache
+    cache[objid] = Hash(b"\x00")
+    bytes_it = bytes_repr(obj, cache)
+    # Pop first element from the bytes_repr iterator and check whether it is a
+    # "local cache key" (e.g. file-system path + mtime tuple) or the first bytes
+    # chunk
+
+    def calc_hash(first: ty.Optional[bytes] = None) -> Hash:
+        """
+        Calculate the hash of the object
+
+        Parameters
+        ----------
+        first : ty.Optional[bytes]
+            the first bytes chunk from the bytes_repr iterator, passed if the first
+            chunk wasn't a local cache key
+        """
+        h = blake2b(digest_size=16, person=b"pydra-hash")
+        # We want to use the first chunk that was popped to check for a cache-key
+        # if present
+        if first is not None:
+            h.update(first)
+        for chunk in bytes_it:  # Note that `bytes_it` is in outer scope
+            h.update(chunk)
+        return Hash(h.digest())
+
+    # Read the first item of the bytes_repr iterator and check to see whether it yields
+    # a "cache-key" tuple instead of a bytes chunk for the type of the object to be cached
+    # (e.g. file-system path + mtime for fileformats.core.FileSet objects). If it
+    # does, use that key to check the persistent cache for a precomputed hash and
+    # return it if it is, otherwise calculate the hash and store it in the persistent
+    # cache with that hash of that key (not to be confused with the hash of the
+    # object that is saved/retrieved).
+    first = next(bytes_it)
+    if isinstance(first, tuple):
+        key = persistent_cache_key(obj, first)
+        hsh = cache.persistent_cache.get_or_calculate_hash(key, calc_hash)
+    else:
+        # If the first item is a bytes chunk (i.e. the object type doesn't have an
+        # associated 'cache-key'), then simply calculate the hash of the object,
+        # passing the first chunk to the `calc_hash` function so it can be included
+        # in the hash calculation
+        hsh = calc_hash(first=first)
+    logger.debug("Hash of %s object is %s", obj, hsh)
+    cache[objid] = hsh
+    return hsh
+
+
+def _profiled_hash_single(obj: object, cache: Cache, profile: HashProfile) -> Hash:
+    """Version of `hash_single` that records the time spent and bytes processed in
+    the profile"""
+    objid = id(obj)
+    cache[objid] = Hash(b"\x00")
+    start = profile._start()
+    nbytes = 0
+    persistent_hit = None
+    try:
         bytes_it = bytes_repr(obj, cache)
-        # Pop first element from the bytes_repr iterator and check whether it is a
-        # "local cache key" (e.g. file-system path + mtime tuple) or the first bytes
-        # chunk
 
         def calc_hash(first: ty.Optional[bytes] = None) -> Hash:
-            """
-            Calculate the hash of the object
-
-            Parameters
-            ----------
-            first : ty.Optional[bytes]
-                the first bytes chunk from the bytes_repr iterator, passed if the first
-                chunk wasn't a local cache key
-            """
+            nonlocal nbytes, persistent_hit
+            if persistent_hit:
+                persistent_hit = False
             h = blake2b(digest_size=16, person=b"pydra-hash")
-            # We want to use the first chunk that was popped to check for a cache-key
-            # if present
             if first is not None:
                 h.update(first)
-            for chunk in bytes_it:  # Note that `bytes_it` is in outer scope
+                nbytes += len(first)
+            for chunk in bytes_it:
                 h.update(chunk)
+                nbytes += memoryview(chunk).nbytes
             return Hash(h.digest())
 
-        # Read the first item of the bytes_repr iterator and check to see whether it yields
-        # a "cache-key" tuple instead of a bytes chunk for the type of the object to be cached
-        # (e.g. file-system path + mtime for fileformats.core.FileSet objects). If it
-        # does, use that key to check the persistent cache for a precomputed hash and
-        # return it if it is, otherwise calculate the hash and store it in the persistent
-        # cache with that hash of that key (not to be confused with the hash of the
-        # object that is saved/retrieved).
         first = next(bytes_it)
         if isinstance(first, tuple):
-            tp = type(obj)
-            key = (
-                tp.__module__,
-                tp.__name__,
-            ) + first
-            hsh = cache.persistent.get_or_calculate_hash(key, calc_hash)
+            key = persistent_cache_key(obj, first)
+            persistent_hit = True
+            hsh = cache.persistent_cache.get_or_calculate_hash(key, calc_hash)
         else:
-            # If the first item is a bytes chunk (i.e. the object type doesn't have an
-            # associated 'cache-key'), then simply calculate the hash of the object,
-            # passing the first chunk to the `calc_hash` function so it can be included
-            # in the hash calculation
             hsh = calc_hash(first=first)
-        logger.debug("Hash of %s object is %s", obj, hsh)
-        cache[objid] = hsh
-    return cache[objid]
+    finally:
+        profile._stop(obj, start, nbytes, persistent_hit)
+    logger.debug("Hash of %s object is %s", obj, hsh)
+    cache[objid] = hsh
+    return hsh
+
+
+def persistent_cache_key(obj: object, local_key: tuple) -> CacheKey:
+    """Prefix the "local cache key" yielded by the `bytes_repr` of an object with its
+    type to form the key used to look up its hash in the persistent cache"""
+    tp = type(obj)
+    return CacheKey((tp.__module__, tp.__name__) + local_key)
+
+
+HASH_THREADS_ENV_VAR = "PYDRA_HASH_THREADS"
+
+
+def hash_threads_default() -> int:
+    """The number of threads used to hash file-sets concurrently, as set by the
+    PYDRA_HASH_THREADS environment variable (0, the default, hashes them serially)"""
+    return int(os.environ.get(HASH_THREADS_ENV_VAR, 0))
+
+
+HASH_CHANGE_CHECK_ENV_VAR = "PYDRA_HASH_CHANGE_CHECK"
+HASH_CHANGE_CHECK_MODES = ("snapshot", "strict")
+
+
+def hash_change_check_default() -> str:
+    """The mode used to check whether the inputs of a task have changed during its
+    execution, as set by the PYDRA_HASH_CHANGE_CHECK environment variable
+
+    * "snapshot" - cheap snapshots of the inputs (see `value_snapshot`) are compared,
+      and only the fields that differ or couldn't be snapshotted are rehashed (the
+      default)
+    * "strict" - all fields are rehashed
+    """
+    mode = os.environ.get(HASH_CHANGE_CHECK_ENV_VAR, "snapshot").lower()
+    if mode not in HASH_CHANGE_CHECK_MODES:
+        raise ValueError(
+            f"Unrecognised {HASH_CHANGE_CHECK_ENV_VAR} value '{mode}', can be one of "
+            f"{HASH_CHANGE_CHECK_MODES}"
+        )
+    return mode
+
+
+def precompute_fileset_hashes(
+    objs: ty.Iterable[object], cache: Cache, n_threads: ty.Optional[int] = None
+) -> int:
+    """Calculate the hashes of all file-sets nested within the given objects (i.e. in
+    lists, tuples, sets and dicts) that aren't present in the persistent cache
+    concurrently across a pool of threads, and store them in the persistent cache so
+    they are picked up by subsequent calls to `hash_single` with the same cache.
+
+    Since the hashes are calculated in exactly the same way as `hash_single` and only
+    the order of their calculation is changed, the hashes of the objects are unchanged.
+
+    Parameters
+    ----------
+    objs : Iterable[object]
+        the objects to search for file-sets
+    cache : Cache
+        the cache that will be used to hash the objects
+    n_threads : int, optional
+        the maximum number of threads to use, by default the value returned by
+        `hash_threads_default` (or the number of CPUs if that isn't > 0)
+
+    Returns
+    -------
+    int
+        the number of file-set hashes that were calculated
+    """
+    if n_threads is None:
+        n_threads = hash_threads_default() or os.cpu_count()
+    pending = {}
+    for fileset in _iter_filesets(objs):
+        # A separate cache is used for each file-set as they will be consumed in
+        # different threads
+        bytes_it = bytes_repr(
+            fileset,
+            Cache(
+                persistent=cache.persistent_cache,
+                file_hash_policy=cache.file_hash_policy,
+            ),
+        )
+        first = next(bytes_it)
+        if not isinstance(first, tuple):
+            continue
+        key = persistent_cache_key(fileset, first)
+        pending.setdefault(key, bytes_it)
+    if not pending:
+        return 0
+    for key in cache.persistent_cache.get_hashes(pending):
+        del pending[key]
+    if not pending:
+        return 0
+
+    def calc_hash(bytes_it: ty.Iterator[bytes]) -> Hash:
+        h = blake2b(digest_size=16, person=b"pydra-hash")
+        for chunk in bytes_it:
+            h.update(chunk)
+        return Hash(h.digest())
+
+    with ThreadPoolExecutor(max_workers=min(n_threads, len(pending))) as pool:
+        hashes = dict(zip(pending, pool.map(calc_hash, pending.values())))
+    cache.persistent_cache.set_hashes(hashes)
+    return len(hashes)
+
+
+def fileset_identity(obj: object) -> ty.Tuple[ty.Tuple[str, int, int, int], ...]:
+    """Cheap identity keys (path, mtime, size and inode) of all files and directories
+    of the file-sets nested within an object (i.e. in lists, tuples, sets and dicts),
+    which can be compared to detect whether they may have changed without rehashing
+    them"""
+    if isinstance(obj, (str, bytes, int, float)) or obj is None:
+        return ()
+    keys = []
+    for fileset in _iter_filesets([obj], default_serializer_only=False):
+        for path in sorted(fileset.fspaths):
+            try:
+                stat = path.lstat()
+            except FileNotFoundError:
+                keys.append((str(path), -1, -1, -1))
+            else:
+                keys.append((str(path), stat.st_mtime_ns, stat.st_size, stat.st_ino))
+                if S_ISDIR(stat.st_mode):
+                    # the contents of nested directories can be modified without
+                    # changing the mtime of the top-level directory
+                    for dpath, dnames, fnames in os.walk(path):
+                        for name in dnames + fnames:
+                            entry = os.path.join(dpath, name)
+                            try:
+                                st = os.lstat(entry)
+                            except FileNotFoundError:
+                                continue
+                            keys.append((entry, st.st_mtime_ns, st.st_size, st.st_ino))
+    return tuple(sorted(keys))
+
+
+def _iter_filesets(
+    objs: ty.Iterable[object], default_serializer_only: bool = True
+) -> ty.Iterator[FileSet]:
+    """Recursively iterate over the file-sets nested within containers, by default
+    only those that would be hashed via the default `bytes_repr_fileset` serializer"""
+    seen = set()
+    stack = list(objs)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, FileSet):
+            if (
+                not default_serializer_only
+                or bytes_repr.dispatch(type(obj)) is bytes_repr_fileset
+            ):
+                yield obj
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, Mapping):
+            stack.extend(obj.values())
+
+
+def value_snapshot(obj: object) -> ty.Optional[tuple]:
+    """A cheap snapshot of an object that can be compared to a snapshot taken
+    previously to detect whether it may have been modified without rehashing it.
+
+    Immutable values are included as is, containers by their identity, length and
+    the snapshots of their items, file-sets by the identity keys of their files (see
+    `fileset_identity`) and objects supporting the buffer protocol (e.g. numpy arrays)
+    by the format, shape and a digest of their memory. Returns None if the object, or
+    an object nested within it, is of a type that can't be snapshotted, which
+    therefore needs to be rehashed.
+    """
+    return _value_snapshot(obj, set())
+
+
+def _value_snapshot(obj: object, seen: ty.Set[int]) -> ty.Optional[tuple]:
+    if isinstance(obj, (str, bytes, int, float, complex, PurePath)) or obj is None:
+        return (obj,)
+    if id(obj) in seen:
+        return (id(obj),)
+    seen.add(id(obj))
+    if isinstance(obj, FileSet):
+        if bytes_repr.dispatch(type(obj)) is not bytes_repr_fileset:
+            return None
+        return (id(obj), fileset_identity(obj))
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        items = obj
+    elif isinstance(obj, Mapping):
+        items = [i for key_value in obj.items() for i in key_value]
+    else:
+        if HAVE_NUMPY and isinstance(obj, numpy.ndarray) and obj.dtype == "object":
+            return None
+        try:
+            view = memoryview(obj)
+        except TypeError:
+            return None
+        h = blake2b(digest_size=16)
+        h.update(view.cast("B") if view.c_contiguous else view.tobytes())
+        return (id(obj), view.format, view.shape, view.nbytes, h.digest())
+    snapshots = []
+    for item in items:
+        snapshot = _value_snapshot(item, seen)
+        if snapshot is None:
+            return None
+        snapshots.append(snapshot)
+    return (id(obj), len(obj), tuple(snapshots))
+
+
+_SCALAR_TYPES = frozenset([str, bytes, int, float, complex, bool, type(None)])
+_SCALAR_CLASSES = (str, bytes, int, float, complex, PurePath) + (
+    (numpy.generic,) if HAVE_NUMPY else ()
+)
+
+
+@attr.s(auto_attribs=True, eq=False, frozen=True)
+class ValueFingerprint:
+    """A fingerprint of a value that can be taken and compared in a fraction of the
+    time it takes to hash the value, as it only references the mutable objects nested
+    within the value, which are compared by identity, along with the metadata that
+    can change when they are modified in place (see `value_fingerprint`)"""
+
+    objects: list
+    """The mutable objects nested within the value"""
+    metadata: list
+    """The lengths of the containers, the scalars and the layouts of the arrays"""
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ValueFingerprint)
+            and len(self.objects) == len(other.objects)
+            and all(map(operator.is_, self.objects, other.objects))
+            and self.metadata == other.metadata
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def value_fingerprint(obj: object) -> ty.Optional[ValueFingerprint]:
+    """A cheap fingerprint of a value that changes when the value is modified in
+    place, which, unlike `value_snapshot`, doesn't read the memory of buffers.
+
+    Scalars are included by value and containers by their identity, length and the
+    fingerprints of their items. As they can't be checked without reading their
+    memory, numpy arrays are only included if they (and the arrays they are views of)
+    are read-only, by their identity and layout. File-sets are included by the
+    identity keys of their files (see `fileset_identity`). Returns None if the value,
+    or an object nested within it, is of any other type, e.g. a writeable array,
+    which therefore needs to be rehashed.
+
+    As the fingerprint references the objects nested within the value, the objects
+    can't be garbage collected and their identities reused while the fingerprint is
+    held, and the fingerprint stays valid when it is pickled along with the value.
+    """
+    objects, metadata = [], []
+    if not _value_fingerprint(obj, objects, metadata, set()):
+        return None
+    return ValueFingerprint(objects, metadata)
+
+
+def _value_fingerprint(
+    obj: object, objects: list, metadata: list, seen: ty.Set[int]
+) -> bool:
+    if obj is None or isinstance(obj, _SCALAR_CLASSES):
+        metadata.append(obj)
+        return True
+    objects.append(obj)
+    if id(obj) in seen:
+        return True
+    seen.add(id(obj))
+    if isinstance(obj, FileSet):
+        if bytes_repr.dispatch(type(obj)) is not bytes_repr_fileset:
+            return False
+        metadata.append(fileset_identity(obj))
+        return True
+    if isinstance(obj, (list, tuple)):
+        items = obj
+    elif isinstance(obj, (set, frozenset)):
+        if set(map(type, obj)) <= _SCALAR_TYPES:
+            metadata.append(frozenset(obj))
+            return True
+        items = sorted(obj, key=id)
+    elif isinstance(obj, Mapping):
+        items = [i for key_value in obj.items() for i in key_value]
+    elif HAVE_NUMPY and isinstance(obj, numpy.ndarray):
+        if obj.dtype == "object":
+            return False
+        base = obj
+        while isinstance(base, numpy.ndarray):
+            if base.flags.writeable:
+                return False
+            base = base.base
+        metadata.append((obj.dtype.str, obj.shape, obj.strides))
+        return True
+    else:
+        return False
+    metadata.append(len(items))
+    if set(map(type, items)) <= _SCALAR_TYPES:
+        # all scalars, e.g. a long list of numbers
+        metadata.append(tuple(items))
+        return True
+    return all(_value_fingerprint(i, objects, metadata, seen) for i in items)
 
 
 @runtime_checkable
@@ -309,6 +1457,16 @@ def bytes_repr(obj: object, cache: Cache) -> Iterator[bytes]:
         unique representation of the object in a series of bytes
     """
     cls = obj.__class__
+    if not hasattr(obj, "__dict__") and not hasattr(obj, "__slots__"):
+        # Objects without attributes that support the buffer protocol (e.g. from
+        # extension modules) are serialized from their memory
+        try:
+            view = memoryview(obj)
+        except TypeError:
+            pass
+        else:
+            yield from bytes_repr_buffer(view, cache, cls=cls)
+            return
     yield f"{cls.__module__}.{cls.__name__}:{{".encode()
     dct: Dict[str, ty.Any]
     if attrs.has(type(obj)):
@@ -357,6 +1515,28 @@ should be called with the same cache object.
 """
 
 
+@register_serializer(bytearray)
+@register_serializer(memoryview)
+@register_serializer(array.array)
+def bytes_repr_buffer(
+    obj: ty.Any, cache: Cache, cls: ty.Optional[type] = None
+) -> Iterator[bytes]:
+    """Serialize an object that supports the buffer protocol directly from its memory,
+    which is only copied (in chunks) if it isn't contiguous"""
+    if cls is None:
+        cls = obj.__class__
+    view = memoryview(obj)
+    yield (
+        f"{cls.__module__}.{cls.__name__}:{view.format}:{view.shape}:{view.nbytes}:"
+    ).encode()
+    if view.c_contiguous:
+        yield view.cast("B")
+    elif HAVE_NUMPY:
+        yield from _iter_numpy_chunks(numpy.asarray(view))
+    else:
+        yield view.tobytes(order="C")
+
+
 @register_serializer
 def bytes_repr_dunder(obj: HasBytesRepr, cache: Cache) -> Iterator[bytes]:
     yield from obj.__bytes_repr__(cache)
@@ -426,6 +1606,18 @@ def bytes_repr_complex(obj: complex, cache: Cache) -> Iterator[bytes]:
 
 @register_serializer
 def bytes_repr_dict(obj: dict, cache: Cache) -> Iterator[bytes]:
+    if cache.scheme >= 2 and obj:
+        keys = sorted(obj)
+        packed_keys = pack_primitives(keys)
+        if packed_keys is not None:
+            packed_values = pack_primitives([obj[k] for k in keys])
+            if packed_values is not None:
+                yield b"dict:primitives:{"
+                yield from packed_keys
+                yield b"="
+                yield from packed_values
+                yield b"}"
+                return
     yield b"dict:{"
     yield from bytes_repr_mapping_contents(obj, cache)
     yield b"}"
@@ -465,17 +1657,120 @@ def bytes_repr_type(klass: type, cache: Cache) -> Iterator[bytes]:
 def bytes_repr_fileset(
     fileset: FileSet, cache: Cache
 ) -> Iterator[ty.Union[CacheKey, bytes]]:
+    policy = cache.file_hash_policy
+    strategy = policy.strategy(fileset) if policy else "content"
+    # Bespoke __bytes_repr__ methods of file-set subclasses may not simply hash the
+    # contents of the files, so they are always used instead of the other strategies
+    if type(fileset).__bytes_repr__ is not FileSet.__bytes_repr__:
+        strategy = "content"
+    if strategy == "metadata":
+        # Cheap enough to compute each time so no cache key is yielded
+        yield from _bytes_repr_fileset_metadata(fileset)
+        return
     fspaths = sorted(fileset.fspaths)
-    yield CacheKey(
-        tuple(repr(p) for p in fspaths)  # type: ignore[arg-type]
-        + tuple(p.lstat().st_mtime_ns for p in fspaths)
+    key = tuple(repr(p) for p in fspaths) + tuple(  # type: ignore[arg-type]
+        p.lstat().st_mtime_ns for p in fspaths
     )
-    yield from fileset.__bytes_repr__(cache)
+    if strategy == "content":
+        yield CacheKey(key)
+        yield from fileset.__bytes_repr__(cache)
+    elif strategy == "mmap":
+        yield CacheKey((strategy, policy.chunk_len) + key)
+        yield from _bytes_repr_fileset_mmap(fileset, policy.chunk_len)
+    else:
+        yield CacheKey((strategy, policy.sample_len) + key)
+        yield from _bytes_repr_fileset_sampled(fileset, policy.sample_len)
+
+
+def _fileset_files(fileset: FileSet) -> Iterator[ty.Tuple[str, Path]]:
+    """Yields the keys and paths of the files within a file-set in the same order as
+    `FileSet.byte_chunks`, without reading their contents"""
+    fspaths = [Path(p) for p in fileset.fspaths]
+    # Determine the prefix the keys are relative to as `FileSet.byte_chunks` does
+    relative_to = Path(os.path.commonpath(fspaths))
+    if all(p.is_file() and p.parent == relative_to for p in fspaths):
+        relative_to /= os.path.commonprefix([p.name for p in fspaths]).rstrip(".")
+    prefix = str(relative_to)
+    if relative_to.is_dir() and not prefix.endswith(os.path.sep):
+        prefix += os.path.sep
+    for key, chunks in fileset.byte_chunks():
+        chunks.close()  # the generator hasn't started so no file has been opened
+        yield key, Path(prefix + key)
+
+
+def _bytes_repr_fileset_mmap(fileset: FileSet, chunk_len: int) -> Iterator[bytes]:
+    """Yields the same bytes as `FileSet.__bytes_repr__`, but reads the contents of the
+    files via memory-maps in (large) chunks of `chunk_len` bytes"""
+    cls = type(fileset)
+    yield f"{cls.__module__}.{cls.__name__}:".encode()
+    for key, fspath in _fileset_files(fileset):
+        yield (",'" + key + "'=").encode()
+        if not fspath.is_file():
+            yield b"\x00"  # broken symlink
+            continue
+        size = fspath.stat().st_size
+        if not size:
+            continue
+        with open(fspath, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The memory-map is closed when the last view onto it is garbage-collected
+        view = memoryview(mm)
+        for offset in range(0, size, chunk_len):
+            yield view[offset : offset + chunk_len]
+
+
+def _bytes_repr_fileset_sampled(fileset: FileSet, sample_len: int) -> Iterator[bytes]:
+    """Yields the size and samples from the head, middle and tail of each file within
+    the file-set (or its full contents if it is smaller than three samples)"""
+    cls = type(fileset)
+    yield f"{cls.__module__}.{cls.__name__}:sampled:{sample_len}:".encode()
+    for key, fspath in _fileset_files(fileset):
+        yield (",'" + key + "'=").encode()
+        if not fspath.is_file():
+            yield b"\x00"  # broken symlink
+            continue
+        size = fspath.stat().st_size
+        yield struct.pack("<q", size)
+        with open(fspath, "rb") as f:
+            if size <= 3 * sample_len:
+                yield f.read()
+            else:
+                for offset in (0, (size - sample_len) // 2, size - sample_len):
+                    f.seek(offset)
+                    yield f.read(sample_len)
+
+
+def _bytes_repr_fileset_metadata(fileset: FileSet) -> Iterator[bytes]:
+    """Yields the path, size, inode and modification time of each file (and directory)
+    within the file-set"""
+    cls = type(fileset)
+    yield f"{cls.__module__}.{cls.__name__}:metadata:".encode()
+    for fspath in sorted(Path(p) for p in fileset.fspaths):
+        paths = [fspath]
+        if fspath.is_dir():
+            for dpath, _, filenames in sorted(os.walk(fspath)):
+                paths.extend(Path(dpath) / f for f in sorted(filenames))
+        for path in paths:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                yield f"{path}:broken-link,".encode()
+            else:
+                yield (
+                    f"{path}:{stat.st_size}:{stat.st_ino}:{stat.st_mtime_ns},"
+                ).encode()
 
 
 @register_serializer(list)
 @register_serializer(tuple)
 def bytes_repr_seq(obj: Sequence, cache: Cache) -> Iterator[bytes]:
+    if cache.scheme >= 2:
+        packed = pack_primitives(obj)
+        if packed is not None:
+            yield f"{obj.__class__.__name__}:primitives:(".encode()
+            yield from packed
+            yield b")"
+            return
     yield f"{obj.__class__.__name__}:(".encode()
     yield from bytes_repr_sequence_contents(obj, cache)
     yield b")"
@@ -484,11 +1779,65 @@ def bytes_repr_seq(obj: Sequence, cache: Cache) -> Iterator[bytes]:
 @register_serializer(set)
 @register_serializer(frozenset)
 def bytes_repr_set(obj: Set, cache: Cache) -> Iterator[bytes]:
+    items = sorted(obj)
+    if cache.scheme >= 2:
+        packed = pack_primitives(items)
+        if packed is not None:
+            yield f"{obj.__class__.__name__}:primitives:{{".encode()
+            yield from packed
+            yield b"}"
+            return
     yield f"{obj.__class__.__name__}:{{".encode()
-    yield from bytes_repr_sequence_contents(sorted(obj), cache)
+    yield from bytes_repr_sequence_contents(items, cache)
     yield b"}"
 
 
+def pack_primitives(seq: Sequence) -> ty.Optional[ty.List[bytes]]:
+    """Pack a sequence of primitive values of a single type (int, float, bool or str)
+    into bytes chunks in bulk, as used by version 2 of the hash scheme (see
+    `hash_scheme_default`), or return None if it is empty or contains values of other
+    or multiple types
+
+    .. code-block:: python
+
+        >>> from pydra.utils.hash import pack_primitives
+        >>> b"".join(pack_primitives([True, False]))
+        b'bool[2]:\\x01\\x00'
+    """
+    if not seq:
+        return None
+    types = set(map(type, seq))
+    if len(types) != 1:
+        return None
+    (tp,) = types
+    if tp is int:
+        try:
+            packed = array.array("q", seq)
+        except OverflowError:  # ints that don't fit in 64 bits
+            return None
+        return [f"int64[{len(seq)}]:".encode(), _little_endian(packed)]
+    if tp is float:
+        packed = array.array("d", seq)
+        return [f"float64[{len(seq)}]:".encode(), _little_endian(packed)]
+    if tp is bool:
+        return [f"bool[{len(seq)}]:".encode(), bytes(seq)]
+    if tp is str:
+        encoded = [s.encode() for s in seq]
+        lengths = array.array("q", map(len, encoded))
+        return [
+            f"str[{len(seq)}]:".encode(),
+            _little_endian(lengths),
+            b"".join(encoded),
+        ]
+    return None
+
+
+def _little_endian(arr: array.array) -> memoryview:
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return memoryview(arr).cast("B")
+
+
 def bytes_repr_mapping_contents(mapping: Mapping, cache: Cache) -> Iterator[bytes]:
     """Serialize the contents of a mapping
 
@@ -531,8 +1880,44 @@ if HAVE_NUMPY:
         yield f"{obj.__class__.__module__}{obj.__class__.__name__}:{obj.size}:".encode()
         if obj.dtype == "object":
             yield from bytes_repr_sequence_contents(iter(obj.ravel()), cache)
+        elif isinstance(obj, numpy.generic):
+            yield obj.tobytes()
+        else:
+            yield from _iter_numpy_chunks(obj)
+
+    @register_serializer(numpy.memmap)
+    def bytes_repr_numpy_memmap(obj: numpy.memmap, cache: Cache) -> Iterator[bytes]:
+        # Read-only maps of the backing file (i.e. not views of them) are keyed by the
+        # file and their layout within it (e.g. C or F order), so their hashes are
+        # stored in the persistent cache
+        if obj.mode == "r" and obj.filename and isinstance(obj.base, mmap.mmap):
+            stat = os.stat(obj.filename)
+            yield CacheKey(
+                (
+                    str(obj.filename),
+                    obj.offset,
+                    obj.shape,
+                    obj.strides,
+                    obj.dtype.str,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                )
+            )
+        yield from bytes_repr_numpy(obj, cache)
+
+    def _iter_numpy_chunks(obj: numpy.ndarray) -> Iterator[bytes]:
+        """Iterate over the data of an array in C order, directly from its memory if
+        it is C-contiguous, otherwise copying NUMPY_CHUNK_LEN elements at a time"""
+        if obj.flags.c_contiguous:
+            yield memoryview(obj.reshape(-1).view(numpy.uint8))
         else:
-            yield obj.tobytes(order="C")
+            for chunk in numpy.nditer(
+                obj,
+                flags=["external_loop", "buffered", "zerosize_ok"],
+                buffersize=NUMPY_CHUNK_LEN,
+                order="C",
+            ):
+                yield chunk.tobytes()
 
 
 NUMPY_CHUNK_LEN = 8192
@@ -1,5 +1,9 @@
 import re
+from copy import copy
+import array
 import os
+import mmap
+import sqlite3
 from hashlib import blake2b
 from pathlib import Path
 import time
@@ -7,15 +11,25 @@ from unittest import mock
 import attrs
 import pytest
 import typing as ty
+import cloudpickle as cp
 from fileformats.application import Zip, Json
 from fileformats.text import TextFile
+from fileformats.generic import Directory, File
 from ..hash import (
     Cache,
     UnhashableError,
     bytes_repr,
     hash_object,
     register_serializer,
+    FileHashPolicy,
     PersistentCache,
+    SqliteBackend,
+    precompute_fileset_hashes,
+    HashProfile,
+    fileset_identity,
+    value_fingerprint,
+    value_snapshot,
+    identity_hash_memo,
 )
 
 
@@ -252,6 +266,199 @@ def test_multi_object():
     assert re.match(rb"list:\((.{16})(.{16})\2\)$", reprB)
 
 
+def test_bytes_repr_buffers():
+    assert join_bytes_repr(bytearray(b"abc")) == b"builtins.bytearray:B:(3,):3:abc"
+    assert join_bytes_repr(memoryview(b"abc")) == b"builtins.memoryview:B:(3,):3:abc"
+    arr = array.array("h", [1, 2])
+    assert join_bytes_repr(arr) == b"array.array:h:(2,):4:" + arr.tobytes()
+    # Non-contiguous buffers are serialized in C order
+    view = memoryview(bytearray(b"abcdef"))[::2]
+    assert join_bytes_repr(view) == b"builtins.memoryview:B:(3,):3:ace"
+
+
+def test_hash_numpy_non_contiguous():
+    np = pytest.importorskip("numpy")
+    arr = np.arange(3000, dtype="float64").reshape(3, 1000)
+    # Hashed in chunks rather than via a copy of the whole array, but gives the same
+    # hash as the equivalent contiguous array
+    assert hash_object(arr[:, ::3]) == hash_object(np.ascontiguousarray(arr[:, ::3]))
+    assert hash_object(arr.T) == hash_object(np.ascontiguousarray(arr.T))
+    assert hash_object(arr.T) != hash_object(arr)
+
+
+def test_hash_numpy_memmap(tmp_path):
+    np = pytest.importorskip("numpy")
+    fname = tmp_path / "array.dat"
+    np.arange(100, dtype="int32").tofile(fname)
+    cache_path = tmp_path / "hash-cache"
+    memmap = np.memmap(fname, dtype="int32", mode="r")
+    hsh = hash_object(memmap, persistent_cache=cache_path)
+    # Read-only memory maps are stored in the persistent cache
+    assert len(list(cache_path.iterdir())) == 1
+    assert hash_object(memmap, persistent_cache=cache_path) == hsh
+    # Views of the map are hashed from their contents
+    assert hash_object(memmap[::2], persistent_cache=cache_path) != hsh
+    assert len(list(cache_path.iterdir())) == 1
+    # A different offset into the file is a different entry
+    hash_object(
+        np.memmap(fname, dtype="int32", mode="r", offset=8), persistent_cache=cache_path
+    )
+    assert len(list(cache_path.iterdir())) == 2
+
+
+def test_hash_numpy_memmap_order(tmp_path):
+    np = pytest.importorskip("numpy")
+    fname = tmp_path / "array.dat"
+    np.arange(12, dtype="int32").tofile(fname)
+    cache_path = tmp_path / "hash-cache"
+    c_order = np.memmap(fname, dtype="int32", mode="r", shape=(3, 4), order="C")
+    f_order = np.memmap(fname, dtype="int32", mode="r", shape=(3, 4), order="F")
+    c_hash = hash_object(c_order, persistent_cache=cache_path)
+    f_hash = hash_object(f_order, persistent_cache=cache_path)
+    # The same file, offset, shape and dtype, but a different layout of the contents
+    assert c_hash != f_hash
+    assert f_hash == hash_object(f_order)
+    assert len(list(cache_path.iterdir())) == 2
+
+
+def test_value_snapshot(tmp_path):
+    np = pytest.importorskip("numpy")
+    lst = [1, "a", {"b": [2.0]}]
+    snapshot = value_snapshot(lst)
+    assert value_snapshot(lst) == snapshot
+    lst[2]["b"].append(3.0)
+    assert value_snapshot(lst) != snapshot
+
+    arr = np.zeros(10)
+    snapshot = value_snapshot(arr)
+    assert value_snapshot(arr) == snapshot
+    arr[5] = 1
+    assert value_snapshot(arr) != snapshot
+    assert value_snapshot(np.array([object()])) is None
+
+    # objects of other types can't be snapshotted
+    class MyClass:
+        pass
+
+    assert value_snapshot([1, MyClass()]) is None
+
+    text_file = tmp_path / "file.txt"
+    text_file.write_text("foo")
+    fileset = File(text_file)
+    snapshot = value_snapshot(fileset)
+    text_file.write_text("foobar")
+    assert value_snapshot(fileset) != snapshot
+
+
+def test_value_fingerprint():
+    np = pytest.importorskip("numpy")
+    lst = [1, "a", {"b": [2.0]}, (3, 4)]
+    fingerprint = value_fingerprint(lst)
+    assert value_fingerprint(lst) == fingerprint
+    lst[2]["b"].append(3.0)
+    assert value_fingerprint(lst) != fingerprint
+    fingerprint = value_fingerprint(lst)
+    lst[2]["b"] = [2.0, 3.0]  # an equal, but different, object
+    assert value_fingerprint(lst) != fingerprint
+    # still valid when pickled along with the value
+    lst2, fingerprint2 = cp.loads(cp.dumps((lst, value_fingerprint(lst))))
+    assert value_fingerprint(lst2) == fingerprint2
+    # writeable arrays can't be fingerprinted without reading their memory
+    arr = np.arange(10)
+    assert value_fingerprint(arr) is None
+    assert value_fingerprint(arr[::2]) is None
+    arr.flags.writeable = False
+    fingerprint = value_fingerprint(arr)
+    assert fingerprint == value_fingerprint(arr)
+    assert value_fingerprint(arr[::2]) is not None
+    assert value_fingerprint(arr.reshape(2, 5)) != fingerprint
+    assert value_fingerprint([1, object()]) is None
+
+
+def test_fileset_identity_nested_dir(tmp_path):
+    sub_dir = tmp_path / "dir" / "sub"
+    sub_dir.mkdir(parents=True)
+    (sub_dir / "file.txt").write_text("foo")
+    directory = Directory(tmp_path / "dir")
+    identity = fileset_identity(directory)
+    assert fileset_identity(directory) == identity
+    (sub_dir / "file.txt").write_text("foobar")
+    assert fileset_identity(directory) != identity
+
+
+def test_hash_scheme_primitives(monkeypatch):
+    def hash2(obj):
+        return hash_object(obj, cache=Cache(scheme=2))
+
+    for obj in (
+        [1, 2, 3],
+        (1.0, 2.5),
+        [True, False],
+        ["a", "bc", ""],
+        {"a": 1, "b": 2},
+        {1.0, 2.0},
+    ):
+        # a separate scheme, so existing hashes remain valid
+        assert hash2(obj) != hash_object(obj, cache=Cache(scheme=1))
+        assert hash2(obj) == hash2(copy(obj))
+    assert len({hash2(o) for o in ([1, 0], [1.0, 0.0], [True, False], ["1", "0"])}) == 4
+    assert hash2([1, 2]) != hash2([2, 1])
+    assert hash2([1, 2]) != hash2((1, 2))
+    assert hash2(["ab", "c"]) != hash2(["a", "bc"])
+    assert hash2({"a": 1, "b": 2}) != hash2({"a": 2, "b": 1})
+    assert hash2({1, 2}) == hash2({2, 1})
+    # containers of mixed types, or of ints too large to pack, are hashed item by item
+    for obj in ([1, "a"], [2**64, 1], [], [[1, 2], [3]]):
+        assert hash2(obj) == hash2(copy(obj))
+    assert hash2([1, "a"]) == hash_object([1, "a"], cache=Cache(scheme=1))
+    assert hash2([[1, 2], [3]]) != hash2([[1], [2, 3]])
+
+    monkeypatch.setenv("PYDRA_HASH_SCHEME", "2")
+    assert hash_object([1, 2, 3]) == hash2([1, 2, 3])
+    monkeypatch.setenv("PYDRA_HASH_SCHEME", "3")
+    with pytest.raises(ValueError, match="Unrecognised PYDRA_HASH_SCHEME"):
+        hash_object([1, 2, 3])
+
+
+def test_identity_hash_memo(monkeypatch):
+    monkeypatch.setattr(identity_hash_memo, "min_size", 100)
+    monkeypatch.setattr(identity_hash_memo, "max_size", 1000)
+    identity_hash_memo.clear()
+
+    big_str = "a" * 500
+    hsh = hash_object(big_str)
+    assert len(identity_hash_memo) == 1
+    assert hash_object(big_str) == hsh
+    assert identity_hash_memo.hits == 1
+    # equal objects have the same hash
+    assert hash_object("".join(["a"] * 500)) == hsh
+    assert hash_object([big_str, big_str]) == hash_object(["a" * 500, "a" * 500])
+
+    # only immutable objects are memoized
+    hash_object(tuple(range(20)) + ([1],))
+    assert len(identity_hash_memo) == 2
+
+    # least recently used objects are evicted once the maximum size is exceeded
+    other_str = "b" * 600
+    hash_object(other_str)
+    assert identity_hash_memo.get(big_str, Cache()) is None
+    assert identity_hash_memo.get(other_str, Cache()) is not None
+
+    @attrs.frozen
+    class Config:
+        name: str
+        values: ty.Tuple[int, ...]
+
+    config = Config("a", (1, 2))
+    hsh = hash_object(config)
+    assert identity_hash_memo.get(config, Cache()) == hsh
+    assert hash_object(Config("a", (1, 2))) == hsh
+    n_entries = len(identity_hash_memo)
+    del config
+    assert len(identity_hash_memo) == n_entries - 1
+    identity_hash_memo.clear()
+
+
 def test_magic_method():
     class MyClass:
         def __init__(self, x):
@@ -380,9 +587,254 @@ def test_persistent_hash_cache_cleanup2(cache_path, text_file):
     assert len(list(cache_path.iterdir())) == 0
 
 
+def test_persistent_hash_cache_default(cache_path, tmp_path):
+    """
+    Test the default persistent cache is shared within the process while the
+    environment variables configuring it are unchanged
+    """
+    with mock.patch.dict(os.environ, {"PYDRA_HASH_CACHE": str(cache_path)}):
+        persistent_cache = PersistentCache.default()
+        assert persistent_cache.location == cache_path
+        assert Cache().persistent_cache is persistent_cache
+    with mock.patch.dict(os.environ, {"PYDRA_HASH_CACHE": str(tmp_path / "other")}):
+        assert PersistentCache.default() is not persistent_cache
+    # recreated if the location has been removed
+    cache_path.rmdir()
+    with mock.patch.dict(os.environ, {"PYDRA_HASH_CACHE": str(cache_path)}):
+        assert PersistentCache.default() is not persistent_cache
+        assert cache_path.exists()
+
+
+def test_hash_profile(cache_path, text_file, tmp_path):
+    """
+    Test the hash profile records the time and bytes per type, and the persistent-cache
+    hits and misses, while it is activated and can be read back from a directory
+    """
+    obj = {"a": [1, 2.0], "file": text_file}
+    hsh = hash_object(obj, persistent_cache=cache_path)
+    profile = HashProfile()
+    with profile.activate():
+        assert hash_object(obj, persistent_cache=cache_path) == hsh
+        hash_object(b"x" * 1000)
+    assert profile.types["builtins.dict"].calls == 1
+    assert profile.types["builtins.list"].calls == 1
+    assert profile.types["builtins.bytes"].nbytes > 1000
+    assert profile.types["fileformats.text.TextFile"].calls == 1
+    assert profile.persistent_hits.calls == 1
+    assert profile.persistent_misses.calls == 0
+    # not recorded once deactivated
+    hash_object(b"x")
+    assert profile.types["builtins.bytes"].calls == 1
+
+    text_file.fspath.write_text("bar")
+    with profile.activate():
+        hash_object(text_file, persistent_cache=cache_path)
+    assert profile.persistent_misses.calls == 1
+    assert profile.persistent_misses.nbytes > 0
+
+    profile.record_field("a", 0.5, 100)
+    profile.save(tmp_path)
+    assert HashProfile.load(tmp_path) == profile
+    assert "builtins.dict" in profile.summary()
+
+
 def test_persistent_hash_cache_not_dir(text_file):
     """
     Test that an error is raised if the provided cache path is not a directory
     """
     with pytest.raises(ValueError, match="not a directory"):
         PersistentCache(text_file.fspath)
+
+
+def test_persistent_hash_cache_sqlite(cache_path, text_file):
+    """
+    Test the SQLite backend of the persistent hash cache stores the hashes in a single
+    database file and retrieves them when the file is unchanged
+    """
+    persistent_cache = PersistentCache(cache_path, backend="sqlite")
+    hsh = hash_object(text_file, persistent_cache=persistent_cache)
+    # Only the database (and its write-ahead-log files) are created
+    assert all(p.name.startswith("hashes.sqlite") for p in cache_path.iterdir())
+    # A fresh cache object (i.e. without in-memory entries) reads it from the database
+    assert hsh == hash_object(
+        text_file, persistent_cache=PersistentCache(cache_path, backend="sqlite")
+    )
+    with mock.patch.dict(
+        os.environ,
+        {"PYDRA_HASH_CACHE": str(cache_path), "PYDRA_HASH_CACHE_BACKEND": "sqlite"},
+    ):
+        persistent_cache = PersistentCache()
+    assert isinstance(persistent_cache.backend, SqliteBackend)
+    key = next(iter(persistent_cache.backend.get_many(_all_sqlite_keys(cache_path))))
+    persistent_cache.backend.set_many({key: b"modified"})
+    assert hash_object(text_file, persistent_cache=persistent_cache) == b"modified"
+
+
+def _all_sqlite_keys(cache_path):
+    conn = sqlite3.connect(cache_path / SqliteBackend.DB_NAME)
+    try:
+        return [k for (k,) in conn.execute("SELECT key FROM hashes")]
+    finally:
+        conn.close()
+
+
+def test_persistent_hash_cache_batched(cache_path):
+    for backend in ("files", "sqlite"):
+        persistent_cache = PersistentCache(cache_path / backend, backend=backend)
+        hashes = {("a", i): i.to_bytes(16, "little") for i in range(1200)}
+        persistent_cache.set_hashes(hashes)
+        reloaded = PersistentCache(cache_path / backend, backend=backend)
+        assert reloaded.get_hashes(list(hashes) + [("b", 0)]) == hashes
+
+
+def test_persistent_hash_cache_sqlite_cleanup(cache_path):
+    persistent_cache = PersistentCache(
+        cache_path, backend=SqliteBackend(cache_path, cleanup_batch=3)
+    )
+    persistent_cache.set_hashes({("a", i): b"x" * 16 for i in range(10)})
+    # Bounded by the maximum number of entries, removing at most a batch at a time
+    persistent_cache.max_entries = 5
+    persistent_cache.clean_up()
+    assert len(_all_sqlite_keys(cache_path)) == 7
+    persistent_cache.clean_up()
+    assert len(_all_sqlite_keys(cache_path)) == 5
+    persistent_cache.clean_up()
+    assert len(_all_sqlite_keys(cache_path)) == 5
+    # Bounded by the access time
+    persistent_cache.max_entries = None
+    persistent_cache.cleanup_period = -100
+    persistent_cache.clean_up()
+    assert len(_all_sqlite_keys(cache_path)) == 2
+
+
+def test_persistent_hash_cache_migrate(cache_path, text_file):
+    files_cache = PersistentCache(cache_path, backend="files")
+    hsh = hash_object(text_file, persistent_cache=files_cache)
+    sqlite_cache = PersistentCache(cache_path, backend="sqlite")
+    assert sqlite_cache.migrate(remove=True) == 1
+    assert all(p.name.startswith("hashes.sqlite") for p in cache_path.iterdir())
+    # Check the migrated entry is used by modifying the file without changing its mtime
+    stat = text_file.fspath.stat()
+    text_file.fspath.write_text("bar")
+    os.utime(text_file.fspath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert hash_object(text_file, persistent_cache=sqlite_cache) == hsh
+    with pytest.raises(ValueError, match="Cannot migrate"):
+        files_cache.migrate()
+
+
+def test_persistent_hash_cache_unknown_backend(cache_path):
+    with pytest.raises(ValueError, match="Unrecognised persistent hash cache backend"):
+        PersistentCache(cache_path, backend="unknown")
+
+
+def test_precompute_fileset_hashes(tmp_path, cache_path):
+    """
+    Test that file-sets nested within containers are hashed concurrently and that the
+    resulting hash of the containing object is identical to the one calculated serially
+    """
+    text_files = []
+    for i in range(10):
+        fspath = tmp_path / f"text-file-{i}.txt"
+        fspath.write_text(f"contents {i}" * 1000)
+        text_files.append(TextFile(fspath))
+    obj = {
+        "a": text_files[:4],
+        "b": (text_files[4], {"c": [text_files[5:8]]}),
+        "d": {"g": {"h": text_files[8]}},
+        "e": text_files[9],
+        # Repeated file-sets are only hashed once
+        "f": text_files[0],
+    }
+    serial_hash = hash_object(obj, persistent_cache=tmp_path / "serial-cache")
+    cache = Cache(persistent=cache_path)
+    assert precompute_fileset_hashes([obj], cache, n_threads=4) == 10
+    with mock.patch("pydra.utils.hash.ThreadPoolExecutor", side_effect=AssertionError):
+        # All file-set hashes are now stored in the persistent cache
+        assert precompute_fileset_hashes([obj], Cache(persistent=cache_path)) == 0
+    assert hash_object(obj, cache=cache) == serial_hash
+    assert hash_object(obj, persistent_cache=cache_path) == serial_hash
+
+
+@pytest.fixture
+def fileset_dir(tmp_path):
+    dpath = tmp_path / "a-dir"
+    (dpath / "sub").mkdir(parents=True)
+    (dpath / "large.bin").write_bytes(os.urandom(100000))
+    (dpath / "sub" / "small.txt").write_text("foo")
+    (dpath / "empty.txt").touch()
+    return Directory(dpath)
+
+
+def test_file_hash_strategy_mmap(cache_path, text_file, fileset_dir):
+    """
+    Test that hashing files via memory maps produces identical hashes to the default
+    strategy, but is stored under a different persistent cache key
+    """
+    for fileset in (text_file, fileset_dir):
+        content_hash = hash_object(fileset, persistent_cache=cache_path)
+        cache = Cache(
+            persistent=cache_path,
+            file_hash_policy=FileHashPolicy("mmap", chunk_len=mmap.PAGESIZE),
+        )
+        assert hash_object(fileset, cache=cache) == content_hash
+    assert len(list(cache_path.iterdir())) == 4
+
+
+def test_file_hash_strategy_sampled(cache_path, tmp_path, fileset_dir):
+    policy = FileHashPolicy("sampled", sample_len=100)
+    large_file = File(fileset_dir.fspath / "large.bin")
+    sampled_hash = hash_object(
+        large_file, cache=Cache(persistent=cache_path, file_hash_policy=policy)
+    )
+    assert sampled_hash != hash_object(large_file, persistent_cache=cache_path)
+    # Changing bytes outside of the samples doesn't change the hash
+    with open(large_file.fspath, "r+b") as f:
+        f.seek(1000)
+        f.write(b"changed")
+    assert (
+        hash_object(
+            large_file, cache=Cache(persistent=tmp_path, file_hash_policy=policy)
+        )
+        == sampled_hash
+    )
+    # But changes to its size do
+    with open(large_file.fspath, "ab") as f:
+        f.write(b"appended")
+    assert (
+        hash_object(
+            large_file, cache=Cache(persistent=tmp_path, file_hash_policy=policy)
+        )
+        != sampled_hash
+    )
+    hash_object(fileset_dir, cache=Cache(persistent=tmp_path, file_hash_policy=policy))
+
+
+def test_file_hash_strategy_metadata(cache_path, text_file):
+    """
+    Test that the metadata strategy is only applied within trusted locations, doesn't
+    read the file contents and isn't stored in the persistent cache
+    """
+    policy = FileHashPolicy(locations={text_file.fspath.parent: "metadata"})
+    assert policy.strategy(text_file) == "metadata"
+    assert FileHashPolicy(locations={cache_path: "metadata"}).strategy(text_file) == (
+        "content"
+    )
+    with mock.patch.object(
+        TextFile, "byte_chunks", side_effect=AssertionError("contents read")
+    ):
+        metadata_hash = hash_object(
+            text_file, cache=Cache(persistent=cache_path, file_hash_policy=policy)
+        )
+    assert not list(cache_path.iterdir())
+    assert metadata_hash != hash_object(text_file, persistent_cache=cache_path)
+    os.utime(text_file.fspath, ns=(0, 0))
+    assert metadata_hash != hash_object(
+        text_file, cache=Cache(persistent=cache_path, file_hash_policy=policy)
+    )
+
+
+def test_file_hash_policy_invalid():
+    with pytest.raises(ValueError, match="Unrecognised file hash strategy"):
+        FileHashPolicy("unknown")
+    with pytest.raises(ValueError, match="Unrecognised file hash strategy"):
+        FileHashPolicy(locations={"/archive": "unknown"})